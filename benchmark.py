@@ -0,0 +1,899 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-29 10:31:27
+#   Description : 后处理等环节的正确性对比和测速
+#
+# ================================================================
+import os
+import glob
+import time
+import argparse
+import cv2
+import numpy as np
+
+from tools.postprocess_np import multiclass_nms, fast_nms, matrix_nms
+from model.decode_np import nms_candidates
+from tools.preprocess import INTERPS, BatchPreprocessor
+
+
+def _nms_boxes_loop(boxes, scores, nms_thresh):
+    '''
+    原来逐个保留框的while循环，作为对比的基准。
+    '''
+    x = boxes[:, 0]
+    y = boxes[:, 1]
+    w = boxes[:, 2]
+    h = boxes[:, 3]
+
+    areas = w * h
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+
+        xx1 = np.maximum(x[i], x[order[1:]])
+        yy1 = np.maximum(y[i], y[order[1:]])
+        xx2 = np.minimum(x[i] + w[i], x[order[1:]] + w[order[1:]])
+        yy2 = np.minimum(y[i] + h[i], y[order[1:]] + h[order[1:]])
+
+        w1 = np.maximum(0.0, xx2 - xx1 + 1)
+        h1 = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w1 * h1
+
+        ovr = inter / (areas[i] + areas[order[1:]] - inter)
+        inds = np.where(ovr <= nms_thresh)[0]
+        order = order[inds + 1]
+
+    keep = np.array(keep)
+
+    return keep
+
+
+def _multiclass_nms_loop(boxes, scores, classes, nms_thresh):
+    '''
+    原来Python里逐类别循环的nms，作为对比的基准。
+    '''
+    nboxes, nclasses, nscores = [], [], []
+    for c in set(classes):
+        inds = np.where(classes == c)
+        b = boxes[inds]
+        c = classes[inds]
+        s = scores[inds]
+
+        keep = _nms_boxes_loop(b, s, nms_thresh)
+
+        nboxes.append(b[keep])
+        nclasses.append(c[keep])
+        nscores.append(s[keep])
+
+    if not nclasses and not nscores:
+        return None, None, None
+
+    boxes = np.concatenate(nboxes)
+    classes = np.concatenate(nclasses)
+    scores = np.concatenate(nscores)
+
+    # 换坐标
+    boxes[:, [2, 3]] = boxes[:, [0, 1]] + boxes[:, [2, 3]]
+
+    return boxes, scores, classes
+
+
+def _iou_row(box, boxes):
+    '''
+    一个框与多个框的iou，算法与model/fastnms.py里的_iou()一样。
+    '''
+    area_a = (box[2] - box[0]) * (box[3] - box[1])
+    area_b = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    inter = np.maximum(np.minimum(box[2:], boxes[:, 2:]) - np.maximum(box[:2], boxes[:, :2]), 0.0)
+    inter = inter[:, 0] * inter[:, 1]
+    union = area_a + area_b - inter
+    return inter / (union + np.float32(1e-9))
+
+
+def _to_cxcywh_and_back(boxes):
+    boxes = np.concatenate([(boxes[:, :2] + boxes[:, 2:]) * np.float32(0.5), boxes[:, 2:] - boxes[:, :2]], axis=-1)
+    return np.concatenate([boxes[:, :2] - boxes[:, 2:] * np.float32(0.5),
+                           boxes[:, :2] + boxes[:, 2:] * np.float32(0.5)], axis=-1)
+
+
+def _fast_nms_loop(boxes, scores, conf_thresh, nms_thresh, keep_top_k, nms_top_k):
+    '''
+    逐类别、逐个框计算的Fast-NMS，作为对比的基准。与model/fastnms.py的流程一样：
+    每个类别取前keep_top_k个框，丢弃与分数比它高的框的最大iou超过nms_thresh的框，最后按分数取前nms_top_k个。
+    '''
+    boxes = _to_cxcywh_and_back(boxes)
+    keep = np.where(scores.max(axis=1) > conf_thresh)[0]
+    boxes, scores = boxes[keep], scores[keep]
+    nboxes, nscores, nclasses = [], [], []
+    for c in range(scores.shape[1]):
+        order = np.argsort(-scores[:, c], kind='stable')[:keep_top_k]
+        b, s = boxes[order], scores[order, c]
+        for j in range(len(order)):
+            if s[j] <= conf_thresh:
+                break
+            if j > 0 and _iou_row(b[j], b[:j]).max() > nms_thresh:
+                continue
+            nboxes.append(b[j])
+            nscores.append(s[j])
+            nclasses.append(c)
+    if not nscores:
+        return None, None, None
+    nscores = np.array(nscores, np.float32)
+    order = np.argsort(-nscores, kind='stable')[:nms_top_k]
+    return np.array(nboxes)[order], nscores[order], np.array(nclasses, np.int32)[order]
+
+
+def _matrix_nms_loop(boxes, scores, conf_thresh, post_thresh, nms_top_k, keep_top_k,
+                     use_gaussian=False, gaussian_sigma=2.0):
+    '''
+    逐类别、逐个框计算的Matrix-NMS（与Paddle的matrix_nms算子的C++实现一样的循环），作为对比的基准。
+    '''
+    nboxes, nscores, nclasses = [], [], []
+    for c in range(scores.shape[1]):
+        order = np.argsort(-scores[:, c], kind='stable')
+        order = order[scores[order, c] > conf_thresh][:nms_top_k]
+        b, s = boxes[order], scores[order, c]
+        iou_max = np.zeros((len(order), ), np.float32)
+        ious = []
+        for i in range(len(order)):
+            iou = _iou_row(b[i], b[:i])
+            ious.append(iou)
+            if i > 0:
+                iou_max[i] = iou.max()
+        for i in range(len(order)):
+            min_decay = np.float32(1.0)
+            for j in range(i):
+                if use_gaussian:
+                    decay = np.exp((iou_max[j] ** 2 - ious[i][j] ** 2) * np.float32(gaussian_sigma))
+                else:
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        decay = (1 - ious[i][j]) / (1 - iou_max[j])
+                min_decay = min(min_decay, decay) if not np.isnan(decay) else min_decay
+            ds = min_decay * s[i]
+            if ds <= post_thresh:
+                continue
+            nboxes.append(b[i])
+            nscores.append(ds)
+            nclasses.append(c)
+    if not nscores:
+        return None, None, None
+    nscores = np.array(nscores, np.float32)
+    order = np.argsort(-nscores, kind='stable')[:keep_top_k]
+    return np.array(nboxes)[order], nscores[order], np.array(nclasses, np.int32)[order]
+
+
+def _fastnms_graph(boxes, scores, conf_thresh, nms_thresh, keep_top_k, nms_top_k):
+    '''
+    model/fastnms.py里静态图版本的fastnms()，装了paddle才能跑。返回的是一个可以反复调用的函数。
+    '''
+    import paddle.fluid as fluid
+    import paddle.fluid.layers as P
+    from model.fastnms import fastnms
+
+    startup_prog = fluid.Program()
+    prog = fluid.Program()
+    with fluid.program_guard(prog, startup_prog):
+        with fluid.unique_name.guard():
+            all_pred_boxes = P.data(name='boxes', shape=[1, -1, 4], append_batch_size=False, dtype='float32')
+            all_pred_scores = P.data(name='scores', shape=[1, -1, scores.shape[1]], append_batch_size=False, dtype='float32')
+            shape = P.data(name='shape', shape=[1, 2], append_batch_size=False, dtype='int32')
+            # 与yolo_decode()一样，把yolo_box()输出的x0y0x1y1格式转换成cx_cy_w_h格式
+            cxcywh = P.concat([(all_pred_boxes[:, :, :2] + all_pred_boxes[:, :, 2:]) * 0.5,
+                               all_pred_boxes[:, :, 2:] - all_pred_boxes[:, :, :2]], axis=-1)
+            fetch_list = fastnms(cxcywh, all_pred_scores, shape, shape, conf_thresh, nms_thresh, keep_top_k, nms_top_k, True)
+    exe = fluid.Executor(fluid.CPUPlace())
+    exe.run(startup_prog)
+    feed = {'boxes': boxes[np.newaxis], 'scores': scores[np.newaxis], 'shape': np.array([[1, 1]], np.int32)}
+
+    def run():
+        b, s, c, n = exe.run(prog, feed=feed, fetch_list=fetch_list)
+        n = int(n[0])
+        if n == 0:
+            return None, None, None
+        return b[0][:n], s[0][:n], c[0][:n]
+    return run
+
+
+def random_dense_candidates(num, num_classes=80, num_objects=30, seed=0):
+    '''
+    模拟yolo_box()的输出：每个框在自己的类别上分数高，另有一部分框在第二个类别上也有分数，其余类别是很小的噪声。
+    :return:  boxes [num, 4]（左上角坐标、右下角坐标，float32）, scores [num, num_classes]（float32）
+    '''
+    boxes, scores, classes = random_candidates(num, num_classes, num_objects, seed)
+    rng = np.random.RandomState(seed + 1000)
+    boxes[:, 2:] += boxes[:, :2]
+    dense = rng.uniform(0, 0.01, (num, num_classes)).astype(np.float32)
+    dense[np.arange(num), classes] = scores
+    second = np.where(rng.rand(num) < 0.1)[0]
+    dense[second, rng.randint(0, num_classes, len(second))] = scores[second] * np.float32(0.5)
+    return boxes.astype(np.float32), dense
+
+
+def _close(a, b):
+    if a[0] is None or b[0] is None:
+        return a[0] is None and b[0] is None
+    return len(a[1]) == len(b[1]) and np.array_equal(a[2], b[2]) and \
+           np.allclose(a[0], b[0], rtol=1e-5, atol=1e-3) and np.allclose(a[1], b[1], rtol=1e-5, atol=1e-6)
+
+
+def random_candidates(num, num_classes=80, num_objects=30, seed=0):
+    '''
+    模拟nms之前的候选框：围绕num_objects个物体抖动的框，类别偏向少数几类，分数是float32，有少量同分。
+    :return:  boxes（原图上的xywh，float64）, scores（float32）, classes（int64）
+    '''
+    rng = np.random.RandomState(seed)
+    centers = np.stack([rng.uniform(0, 640, num_objects), rng.uniform(0, 480, num_objects),
+                        rng.uniform(10, 300, num_objects), rng.uniform(10, 300, num_objects)], axis=1)
+    obj = rng.randint(0, num_objects, num)
+    boxes = centers[obj] * (1 + rng.normal(0, 0.1, (num, 4)))
+    boxes[:, 2:] = np.abs(boxes[:, 2:]) + 1
+    boxes[:, :2] -= boxes[:, 2:] / 2
+    probs = rng.dirichlet(np.ones(num_classes) * 0.3)
+    classes = rng.choice(num_classes, num, p=probs).astype(np.int64)
+    scores = rng.uniform(0, 1, num).astype(np.float32)
+    ties = rng.rand(num) < 0.05
+    scores[ties] = np.round(scores[ties], 2)
+    return boxes, scores, classes
+
+
+def _timeit(fn, repeat):
+    fn()
+    t0 = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - t0) * 1000.0 / repeat
+
+
+def _same(a, b):
+    if a[0] is None or b[0] is None:
+        return a[0] is None and b[0] is None
+    return all(np.array_equal(x, y) and x.dtype == y.dtype for x, y in zip(a, b))
+
+
+def bench_nms(args):
+    print('%10s %10s %8s %14s %14s %8s %8s' % ('candidates', 'nms_thresh', 'kept', 'loop (ms)', 'vector (ms)', 'speedup', 'same'))
+    for num in args.num_candidates:
+        for nms_thresh in args.nms_threshs:
+            same = True
+            t_loop, t_vec = 0.0, 0.0
+            for seed in range(args.seeds):
+                boxes, scores, classes = random_candidates(num, seed=seed)
+                ref = _multiclass_nms_loop(boxes, scores, classes, nms_thresh)
+                out = multiclass_nms(boxes, scores, classes, nms_thresh)
+                same = same and _same(ref, out)
+                t_loop += _timeit(lambda: _multiclass_nms_loop(boxes, scores, classes, nms_thresh), args.repeat)
+                t_vec += _timeit(lambda: multiclass_nms(boxes, scores, classes, nms_thresh), args.repeat)
+            t_loop /= args.seeds
+            t_vec /= args.seeds
+            print('%10d %10.2f %8d %14.2f %14.2f %7.1fx %8s' % (num, nms_thresh, len(out[1]), t_loop, t_vec,
+                                                               t_loop / t_vec, same))
+
+
+def bench_parallel_nms(args):
+    '''
+    Fast-NMS、Matrix-NMS与逐框循环的基准对比结果，并与贪心nms（multiclass_nms()）对比速度。
+    装了paddle时再与静态图版本的fastnms()对比。
+    '''
+    try:
+        import paddle.fluid
+        has_paddle = True
+    except ImportError:
+        has_paddle = False
+        print('paddle is not installed, skip the graph version of fastnms.')
+    print('%10s %10s %8s %8s %12s %12s %12s %12s %6s %6s %6s' % ('candidates', 'nms_thresh', 'fast', 'matrix', 'greedy (ms)',
+                                                               'fast (ms)', 'matrix (ms)', 'graph (ms)', 'loop', 'graph', 'matrix'))
+    for num in args.num_candidates:
+        for nms_thresh in args.nms_threshs:
+            same_loop, same_graph, same_matrix = True, True, True
+            t_greedy, t_fast, t_matrix, t_graph = 0.0, 0.0, 0.0, 0.0
+            for seed in range(args.seeds):
+                boxes, scores = random_dense_candidates(num, seed=seed)
+                fast_args = (boxes, scores, args.conf_thresh, nms_thresh, args.keep_top_k, args.nms_top_k)
+                matrix_args = (boxes, scores, args.conf_thresh, args.post_thresh, args.keep_top_k, args.nms_top_k,
+                               args.use_gaussian, args.gaussian_sigma)
+                out = fast_nms(*fast_args)
+                out_matrix = matrix_nms(*matrix_args)
+                same_loop = same_loop and _close(_fast_nms_loop(*fast_args), out)
+                same_matrix = same_matrix and _close(_matrix_nms_loop(*matrix_args), out_matrix)
+
+                # 贪心nms的输入：每个框只取最高分的类别
+                pos = np.where(scores.max(axis=1) > args.conf_thresh)[0]
+                xywh = np.concatenate([boxes[pos, :2], boxes[pos, 2:] - boxes[pos, :2]], axis=-1).astype(np.float64)
+                greedy_args = (xywh, scores[pos].max(axis=1), scores[pos].argmax(axis=1), nms_thresh, args.nms_top_k)
+                t_greedy += _timeit(lambda: multiclass_nms(*greedy_args), args.repeat)
+                t_fast += _timeit(lambda: fast_nms(*fast_args), args.repeat)
+                t_matrix += _timeit(lambda: matrix_nms(*matrix_args), args.repeat)
+                if has_paddle:
+                    run = _fastnms_graph(*fast_args)
+                    same_graph = same_graph and _close(run(), out)
+                    t_graph += _timeit(run, args.repeat)
+            n = float(args.seeds)
+            kept = 0 if out[1] is None else len(out[1])
+            kept_matrix = 0 if out_matrix[1] is None else len(out_matrix[1])
+            print('%10d %10.2f %8d %8d %12.2f %12.2f %12.2f %12s %6s %6s %6s' % (
+                num, nms_thresh, kept, kept_matrix, t_greedy / n, t_fast / n, t_matrix / n,
+                '%.2f' % (t_graph / n) if has_paddle else '-', same_loop, same_graph if has_paddle else '-', same_matrix))
+
+
+def bench_batch_fastnms(args):
+    '''
+    model/fastnms.py的fastnms()一次处理一批图片与逐张处理的对比（CPU）：每张图片的结果是否一样、每张图片的耗时。
+    '''
+    import paddle.fluid as fluid
+    import paddle.fluid.layers as P
+    from model.fastnms import fastnms
+
+    startup_prog = fluid.Program()
+    prog = fluid.Program()
+    with fluid.program_guard(prog, startup_prog):
+        with fluid.unique_name.guard():
+            all_pred_boxes = P.data(name='boxes', shape=[-1, -1, 4], append_batch_size=False, dtype='float32')
+            all_pred_scores = P.data(name='scores', shape=[-1, -1, args.num_classes], append_batch_size=False,
+                                     dtype='float32')
+            shape = P.data(name='shape', shape=[-1, 2], append_batch_size=False, dtype='int32')
+            cxcywh = P.concat([(all_pred_boxes[:, :, :2] + all_pred_boxes[:, :, 2:]) * 0.5,
+                               all_pred_boxes[:, :, 2:] - all_pred_boxes[:, :, :2]], axis=-1)
+            fetch_list = fastnms(cxcywh, all_pred_scores, shape, shape, args.conf_thresh, args.nms_thresh,
+                                 args.keep_top_k, args.nms_top_k, True)
+    exe = fluid.Executor(fluid.CPUPlace())
+    exe.run(startup_prog)
+
+    def run(boxes, scores):
+        feed = {'boxes': boxes, 'scores': scores, 'shape': np.ones((len(boxes), 2), np.int32)}
+        b, s, c, n = exe.run(prog, feed=feed, fetch_list=fetch_list)
+        return [(b[i][:n[i]], s[i][:n[i]], c[i][:n[i]]) for i in range(len(boxes))]
+
+    print('%10s %10s %16s %16s %8s %6s' % ('candidates', 'batch_size', 'single (ms/img)', 'batch (ms/img)', 'speedup',
+                                           'same'))
+    for num in args.num_candidates:
+        for batch_size in args.batch_sizes:
+            cands = [random_dense_candidates(num, args.num_classes, seed=seed) for seed in range(batch_size)]
+            boxes = np.stack([b for b, _ in cands])
+            scores = np.stack([s for _, s in cands])
+            singles = [run(boxes[i:i + 1], scores[i:i + 1])[0] for i in range(batch_size)]
+            batched = run(boxes, scores)
+            same = all(all(np.array_equal(x, y) for x, y in zip(a, b)) for a, b in zip(singles, batched))
+            t_single = _timeit(lambda: [run(boxes[i:i + 1], scores[i:i + 1]) for i in range(batch_size)], args.repeat)
+            t_batch = _timeit(lambda: run(boxes, scores), args.repeat)
+            print('%10d %10d %16.2f %16.2f %7.2fx %6s' % (num, batch_size, t_single / batch_size, t_batch / batch_size,
+                                                          t_single / t_batch, same))
+
+
+def bench_pre_nms(args):
+    '''
+    conf_thresh很低时候选框集中在少数几个类别，对比nms之前限制候选框个数前后的后处理耗时（模拟nms_candidates()的输入）。
+    '''
+    print('%10s %12s %10s %8s %8s %14s %14s' % ('candidates', 'class_top_k', 'top_k', 'kept', 'capped', 'no cap (ms)', 'capped (ms)'))
+    for num in args.num_candidates:
+        boxes, scores, classes = random_candidates(num, num_classes=80, num_objects=10, seed=0)
+        boxes /= 640.0
+        shape = (480, 640, 3)
+        full = nms_candidates(boxes, scores, classes, shape, args.nms_thresh, args.max_dets)
+        capped = nms_candidates(boxes, scores, classes, shape, args.nms_thresh, args.max_dets,
+                                args.class_top_k, args.top_k)
+        t_full = _timeit(lambda: nms_candidates(boxes, scores, classes, shape, args.nms_thresh, args.max_dets), args.repeat)
+        t_capped = _timeit(lambda: nms_candidates(boxes, scores, classes, shape, args.nms_thresh, args.max_dets,
+                                                  args.class_top_k, args.top_k), args.repeat)
+        print('%10d %12d %10d %8d %8d %14.2f %14.2f' % (num, args.class_top_k, args.top_k, len(full[1]), len(capped[1]),
+                                                        t_full, t_capped))
+
+
+def random_coco(num_images, num_classes=20, seed=0):
+    '''
+    随机的COCO标注和检测结果（参考数据）：各种大小的gt（small、medium、large都有），少量iscrowd，
+    检测框是gt加扰动、以及随机的误检，一部分分数取2位小数制造相同的分数。类别id不连续，与COCO一样。
+    :return:  (COCO标注的dict, [N, 7]的检测结果)
+    '''
+    rng = np.random.RandomState(seed)
+    cat_ids = sorted(rng.choice(np.arange(1, 3 * num_classes), num_classes, replace=False).tolist())
+    images, annotations, dets = [], [], []
+    for i in range(num_images):
+        img_id = 1000 + 7 * i
+        w, h = 640, 480
+        images.append({'id': img_id, 'width': w, 'height': h, 'file_name': '%012d.jpg' % img_id})
+        for _ in range(rng.randint(0, 15)):
+            size = np.exp(rng.uniform(np.log(8), np.log(300)))
+            bw, bh = size * rng.uniform(0.5, 1.5), size * rng.uniform(0.5, 1.5)
+            x, y = rng.uniform(0, w - bw / 2), rng.uniform(0, h - bh / 2)
+            cat = cat_ids[rng.randint(num_classes)]
+            annotations.append({'id': len(annotations) + 1, 'image_id': img_id, 'category_id': cat,
+                                'bbox': [x, y, bw, bh], 'area': bw * bh * rng.uniform(0.6, 1.0),
+                                'iscrowd': int(rng.rand() < 0.03)})
+            for _ in range(rng.randint(0, 3)):
+                j = rng.normal(0, 0.1 * size, 4)
+                dets.append([img_id, x + j[0], y + j[1], max(bw + j[2], 1.0), max(bh + j[3], 1.0), rng.rand(), cat])
+        for _ in range(rng.randint(0, 20)):
+            bw, bh = rng.uniform(4, 200, 2)
+            dets.append([img_id, rng.uniform(0, w - bw), rng.uniform(0, h - bh), bw, bh, rng.rand() * 0.5,
+                         cat_ids[rng.randint(num_classes)]])
+    dets = np.array(dets, dtype=np.float64).reshape((-1, 7))
+    ties = rng.rand(len(dets)) < 0.2
+    dets[ties, 5] = np.round(dets[ties, 5], 2)
+    anno = {'images': images, 'annotations': annotations,
+            'categories': [{'id': c, 'name': str(c)} for c in cat_ids]}
+    return anno, dets
+
+
+def bench_cocoeval(args):
+    '''
+    tools/fast_cocoeval.py的FastCOCOeval与pycocotools的COCOeval的对比：12个指标的最大绝对差（超过args.atol就报错）、耗时。
+    指定--anno_file、--dets（bbox.json）时用真实数据，否则用random_coco()的参考数据。
+    '''
+    import contextlib
+    import io
+    import json
+    from pycocotools.coco import COCO
+    from pycocotools.cocoeval import COCOeval
+    from tools.fast_cocoeval import FastCOCOeval
+
+    cases = []
+    if args.anno_file:
+        coco_gt = COCO(args.anno_file)
+        with open(args.dets, 'r') as f:
+            records = json.load(f)
+        dets = np.array([[r['image_id']] + r['bbox'] + [r['score'], r['category_id']] for r in records],
+                        dtype=np.float64).reshape((-1, 7))
+        cases.append((os.path.basename(args.dets), coco_gt, dets))
+    else:
+        for seed in range(args.seeds):
+            anno, dets = random_coco(args.num_images, seed=seed)
+            coco_gt = COCO()
+            coco_gt.dataset = anno
+            with contextlib.redirect_stdout(io.StringIO()):
+                coco_gt.createIndex()
+            cases.append(('random seed %d' % seed, coco_gt, dets))
+
+    def run(evaluator):
+        # 不打印12行指标
+        with contextlib.redirect_stdout(io.StringIO()):
+            evaluator.evaluate()
+            evaluator.accumulate()
+            evaluator.summarize()
+        return np.array(evaluator.stats)
+
+    print('%16s %10s %14s %14s %8s %10s' % ('data', 'dets', 'COCOeval (s)', 'fast (s)', 'speedup', 'max diff'))
+    for name, coco_gt, dets in cases:
+        t0 = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            coco_dt = coco_gt.loadRes(dets)
+        ref = run(COCOeval(coco_gt, coco_dt, 'bbox'))
+        t1 = time.time()
+        fast = run(FastCOCOeval(coco_gt, dets, num_workers=args.num_workers))
+        t2 = time.time()
+        diff = np.abs(ref - fast).max()
+        print('%16s %10d %14.2f %14.2f %7.1fx %10.2e' % (name, len(dets), t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), diff))
+        if diff > args.atol:
+            raise AssertionError('FastCOCOeval differs from COCOeval on {}: {} vs {}'.format(name, fast.tolist(),
+                                                                                           ref.tolist()))
+
+
+def _process_image_old(img, input_shape, algorithm, interp):
+    '''
+    原来Decode.process_image()的做法：np.copy、cvtColor、resize、转float、归一化、transpose、expand_dims
+    '''
+    img = cv2.cvtColor(np.copy(img), cv2.COLOR_BGR2RGB)
+    h, w = img.shape[:2]
+    scale_x = float(input_shape[1]) / w
+    scale_y = float(input_shape[0]) / h
+    img = cv2.resize(img, None, None, fx=scale_x, fy=scale_y, interpolation=interp)
+    if algorithm == 'YOLOv4':
+        pimage = img.astype(np.float32) / 255.
+    elif algorithm == 'YOLOv3':
+        mean = np.array([0.485, 0.456, 0.406])[np.newaxis, np.newaxis, :]
+        std = np.array([0.229, 0.224, 0.225])[np.newaxis, np.newaxis, :]
+        pimage = (img.astype(np.float32) - mean) / std
+        pimage = pimage.astype(np.float32)
+    pimage = pimage.transpose(2, 0, 1)
+    return np.expand_dims(pimage, axis=0)
+
+
+def _load_images(image_dir, num):
+    paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')) + glob.glob(os.path.join(image_dir, '*.png')))[:num]
+    if paths:
+        return [cv2.imread(p) for p in paths]
+    # 没有图片时用平滑的随机图片（COCO常见的640x480）
+    rng = np.random.RandomState(0)
+    images = []
+    for _ in range(num):
+        small = rng.randint(0, 256, (30, 40, 3)).astype(np.uint8)
+        images.append(cv2.resize(small, (640, 480), interpolation=cv2.INTER_LINEAR))
+    return images
+
+
+def _interp_aps(args, input_shape):
+    '''
+    用config.py里YOLOv4_Config_1的模型（cfg.infer_model_path）在验证集前args.eval_images张图片上，
+    分别用args.interps里的插值方式预处理，得到各自的AP（需要paddle、模型和验证集）。
+    :return:  {插值方式: AP}
+    '''
+    import copy
+    import paddle.fluid as fluid
+    import paddle.fluid.layers as P
+    from config import YOLOv4_Config_1
+    from model.yolov4 import YOLOv4
+    from model.decode_np import Decode
+    from tools.cocotools import get_classes, clsid2catid, load_coco_gt, bbox_eval, collect_detections
+    from tools.prune import load_channels
+
+    cfg = YOLOv4_Config_1()
+    all_classes = get_classes(cfg.classes_path)
+    num_classes = len(all_classes)
+    _clsid2catid = copy.deepcopy(clsid2catid)
+    if num_classes != 80:   # 如果不是COCO数据集，而是自定义数据集
+        _clsid2catid = {k: k for k in range(num_classes)}
+    images = load_coco_gt(cfg.val_path, cfg.eval_cache_dir).dataset['images'][:args.eval_images]
+
+    startup_prog = fluid.Program()
+    eval_prog = fluid.Program()
+    with fluid.program_guard(eval_prog, startup_prog):
+        with fluid.unique_name.guard():
+            inputs = P.data(name='input_1', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
+            output_l, output_m, output_s = YOLOv4(inputs, num_classes, len(cfg.anchor_masks[0]), is_test=False,
+                                                  trainable=True, width_mult=cfg.width_mult, depth_mult=cfg.depth_mult,
+                                                  tiny=cfg.tiny, channels=load_channels(cfg.prune_channels))
+            eval_fetch_list = [output_l, output_m, output_s]
+    eval_prog = eval_prog.clone(for_test=True)
+    place = fluid.CUDAPlace(0) if fluid.is_compiled_with_cuda() else fluid.CPUPlace()
+    exe = fluid.Executor(place)
+    exe.run(startup_prog)
+    fluid.load(eval_prog, cfg.infer_model_path, executor=exe)
+
+    # 后处理进程池与插值方式无关，只启动一次，每种插值方式只换Decode的预处理
+    _decode = Decode(cfg.algorithm, cfg.anchors, cfg.conf_thresh, cfg.nms_thresh, input_shape, exe, eval_prog,
+                     all_classes, cfg.pre_nms_class_top_k, cfg.pre_nms_top_k, cfg.max_dets, cfg.interp, cfg.letterbox)
+    _decode.start_post_pool(cfg.post_workers)
+    aps = {}
+    try:
+        for name in args.interps:
+            _decode.preprocessor = BatchPreprocessor(input_shape, cfg.algorithm, name, cfg.letterbox)
+            dets = collect_detections(_decode, eval_fetch_list, images, cfg.val_pre_path, cfg.eval_batch_size,
+                                      _clsid2catid, False)
+            aps[name] = bbox_eval(cfg.val_path, dets, fast_eval=cfg.fast_eval,
+                                  img_ids=[im['id'] for im in images])[0] if len(dets) > 0 else 0.0
+    finally:
+        _decode.close_post_pool()
+    return aps
+
+
+def bench_preprocess(args):
+    '''
+    原来逐张np.copy、cvtColor、resize、转float、归一化、transpose、expand_dims再np.concatenate的预处理，
+    与tools/preprocess.py直接写进复用的批缓冲区的预处理对比：结果是否一样、每批耗时、每秒图片数。
+    diff是网络输入与cubic插值的平均绝对差（归一化之后），反映各插值方式对输入的影响；
+    --eval_images大于0时AP是各插值方式在验证集子集上的精度（见_interp_aps()），否则显示'-'。
+    '''
+    images = _load_images(args.image_dir, args.batch_size)
+    input_shape = (args.input_size, args.input_size)
+    aps = _interp_aps(args, input_shape) if args.eval_images > 0 else {}
+    print('%d images, input_shape %s, %s' % (len(images), input_shape, args.algorithm))
+    if aps:
+        print('AP on the first %d val images' % args.eval_images)
+    print('%8s %12s %12s %10s %10s %8s %10s %8s %8s' % ('interp', 'old (ms)', 'fused (ms)', 'old img/s', 'fused img/s',
+                                                        'speedup', 'diff', 'same', 'AP'))
+    ref = BatchPreprocessor(input_shape, args.algorithm, 'cubic').process(images).copy()
+    for name in args.interps:
+        interp = INTERPS[name]
+        pre = BatchPreprocessor(input_shape, args.algorithm, name)
+        old = np.concatenate([_process_image_old(img, input_shape, args.algorithm, interp) for img in images], axis=0)
+        new = pre.process(images)
+        same = old.shape == new.shape and np.allclose(old, new, atol=1e-5)
+        diff = np.abs(new - ref).mean()
+        t_old = _timeit(lambda: np.concatenate([_process_image_old(img, input_shape, args.algorithm, interp)
+                                                for img in images], axis=0), args.repeat)
+        t_new = _timeit(lambda: pre.process(images), args.repeat)
+        n = len(images) * 1000.0
+        ap = '%.4f' % aps[name] if name in aps else '-'
+        print('%8s %12.2f %12.2f %10.1f %10.1f %7.1fx %10.5f %8s %8s' % (name, t_old, t_new, n / t_old, n / t_new,
+                                                                         t_old / t_new, diff, same, ap))
+
+
+def _yolov4_infer_prog(num_classes, **kwargs):
+    '''
+    导出用的YOLOv4推理program（不后处理，输出3个输出层）。参数名都是固定的，多次构建的program可以共用同一份权重。
+    :param kwargs:  传给YOLOv4()的width_mult、depth_mult、tiny
+    '''
+    import paddle.fluid as fluid
+    import paddle.fluid.layers as P
+    from model.yolov4 import YOLOv4
+
+    startup_prog = fluid.Program()
+    infer_prog = fluid.Program()
+    with fluid.program_guard(infer_prog, startup_prog):
+        with fluid.unique_name.guard():
+            image = P.data(name='image', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
+            fetch_list = list(YOLOv4(image, num_classes, 3, is_test=False, trainable=True, export=True,
+                                     postprocess='numpy_nms', **kwargs))
+    return infer_prog.clone(for_test=True), startup_prog, fetch_list
+
+
+def _build_infer_prog(args):
+    '''
+    _yolov4_infer_prog()，并初始化权重。没有--model_path时用随机权重，batch_norm的统计量也随机，
+    这样融合前后的对比不是scale=1、mean=0、var=1的平凡情况。
+    '''
+    import paddle.fluid as fluid
+    from export_model import load_params
+
+    infer_prog, startup_prog, fetch_list = _yolov4_infer_prog(args.num_classes)
+    place = fluid.CPUPlace()
+    exe = fluid.Executor(place)
+    exe.run(startup_prog)
+    scope = fluid.global_scope()
+    if args.model_path:
+        load_params(exe, infer_prog, args.model_path)
+    else:
+        rng = np.random.RandomState(0)
+        for var in infer_prog.list_vars():
+            if not var.persistable or scope.find_var(var.name) is None:
+                continue
+            tensor = scope.find_var(var.name).get_tensor()
+            shape = np.array(tensor).shape
+            if var.name.endswith('.bn.scale'):
+                tensor.set(rng.uniform(0.5, 1.5, shape).astype(np.float32), place)
+            elif var.name.endswith('.bn.offset') or var.name.endswith('.bn.mean'):
+                tensor.set(rng.normal(0, 0.1, shape).astype(np.float32), place)
+            elif var.name.endswith('.bn.var'):
+                tensor.set(rng.uniform(0.5, 1.5, shape).astype(np.float32), place)
+    return exe, infer_prog, fetch_list, scope, place
+
+
+def bench_fold_bn(args):
+    '''
+    tools/fold_bn.py把batch_norm融合进卷积前后的对比（CPU）：3个输出层的最大绝对差、每张图片的耗时。
+    '''
+    from tools.fold_bn import fold_batch_norm
+
+    exe, infer_prog, fetch_list, scope, place = _build_infer_prog(args)
+    rng = np.random.RandomState(1)
+    feeds = [rng.uniform(0, 1, (args.batch_size, 3, size, size)).astype(np.float32) for size in args.input_sizes]
+
+    def run(x):
+        return exe.run(infer_prog, feed={'image': x}, fetch_list=fetch_list)
+
+    # 融合会覆盖scope里的卷积权重，所以先跑完没融合的
+    ref = [run(x) for x in feeds]
+    t_ref = [_timeit(lambda: run(x), args.repeat) for x in feeds]
+    num_bn = len([op for op in infer_prog.global_block().ops if op.type == 'batch_norm'])
+    num_folded = fold_batch_norm(infer_prog, scope, place)
+    num_left = len([op for op in infer_prog.global_block().ops if op.type == 'batch_norm'])
+    print('batch_norm: %d -> %d (folded %d)' % (num_bn, num_left, num_folded))
+    print('%10s %14s %14s %8s %14s' % ('input_size', 'unfolded (ms)', 'folded (ms)', 'speedup', 'max abs diff'))
+    for size, x, outs, t_unfolded in zip(args.input_sizes, feeds, ref, t_ref):
+        folded = run(x)
+        t_folded = _timeit(lambda: run(x), args.repeat)
+        diff = max(np.abs(a - b).max() for a, b in zip(outs, folded))
+        n = float(args.batch_size)
+        print('%10d %14.2f %14.2f %7.2fx %14.6f' % (size, t_unfolded / n, t_folded / n, t_unfolded / t_folded, diff))
+
+
+def bench_mish(args):
+    '''
+    model/yolov4.py里各种Mish实现的对比（CPU）：YOLOv4每个stage的特征图上单个Mish层的耗时，与'default'的最大绝对差。
+    '''
+    import paddle.fluid as fluid
+    import paddle.fluid.layers as P
+    import model.yolov4 as yolov4
+
+    impls = [impl for impl in yolov4.MISH_IMPLS if impl != 'fused' or hasattr(fluid.layers, 'mish')]
+    exe = fluid.Executor(fluid.CPUPlace())
+    progs = {}
+    for impl in impls:
+        yolov4.set_mish_impl(impl)
+        prog = fluid.Program()
+        with fluid.program_guard(prog, fluid.Program()):
+            with fluid.unique_name.guard():
+                x = P.data(name='x', shape=[-1, -1, -1, -1], append_batch_size=False, dtype='float32')
+                y = yolov4._mish(x)
+        progs[impl] = (prog, y)
+    yolov4.set_mish_impl('default')
+    print('impls: %s, ops: %s' % (impls, ['%s=%d' % (impl, len(progs[impl][0].global_block().ops)) for impl in impls]))
+    print('%20s' % 'shape' + ''.join(['%14s' % (impl + ' (ms)') for impl in impls]) + '%14s' % 'max abs diff')
+    rng = np.random.RandomState(0)
+    # cspdarknet53每个stage的输出（conv001，以及s2、s4、s8、s16、s32）
+    size = args.input_size
+    for c, stride in [(32, 1), (64, 2), (128, 4), (256, 8), (512, 16), (1024, 32)]:
+        shape = (args.batch_size, c, size // stride, size // stride)
+        # 批归一化之后的数值范围，再加上一些很大、很小的值
+        x = rng.normal(0, 3, shape).astype(np.float32)
+        x.flat[:100] = np.linspace(-300, 300, 100)
+        outs, times = {}, []
+        for impl in impls:
+            prog, y = progs[impl]
+            run = lambda: exe.run(prog, feed={'x': x}, fetch_list=[y])[0]
+            outs[impl] = run()
+            times.append(_timeit(run, args.repeat))
+        diff = max(np.abs(outs[impl] - outs['default']).max() for impl in impls)
+        print('%20s' % str(shape) + ''.join(['%14.2f' % t for t in times]) + '%14.6f' % diff)
+
+
+def bench_spp(args):
+    '''
+    SPP的两种实现（model/custom_layers.py的spp_max_pools()）在CPU上的对比：单独的SPP模块（conv075的输出，
+    512通道、input_size / 32大小的特征图）和整个YOLOv4。same是结果是否逐位相同。
+    '''
+    import paddle.fluid as fluid
+    import paddle.fluid.layers as P
+    import model.custom_layers as custom_layers
+    from model.yolov4 import _spp
+
+    exe = fluid.Executor(fluid.CPUPlace())
+    rng = np.random.RandomState(0)
+    blocks = {}
+    for impl in custom_layers.SPP_IMPLS:
+        custom_layers.set_spp_impl(impl)
+        prog = fluid.Program()
+        with fluid.program_guard(prog, fluid.Program()):
+            with fluid.unique_name.guard():
+                x = P.data(name='x', shape=[-1, 512, -1, -1], append_batch_size=False, dtype='float32')
+                y = _spp(x)
+        blocks[impl] = (prog, y)
+    print('SPP block')
+    print('%20s %16s %12s %8s %6s' % ('shape', 'parallel (ms)', 'sppf (ms)', 'speedup', 'same'))
+    for size in args.input_sizes:
+        shape = (args.batch_size, 512, size // 32, size // 32)
+        x = rng.normal(0, 1, shape).astype(np.float32)
+        outs, times = [], []
+        for impl in custom_layers.SPP_IMPLS:
+            prog, y = blocks[impl]
+            run = lambda: exe.run(prog, feed={'x': x}, fetch_list=[y])[0]
+            outs.append(run())
+            times.append(_timeit(run, args.repeat))
+        print('%20s %16.3f %12.3f %7.2fx %6s' % (str(shape), times[0], times[1], times[0] / times[1],
+                                                 np.array_equal(outs[0], outs[1])))
+
+    # 两个program的参数名一样，共用_build_infer_prog()初始化的权重
+    custom_layers.set_spp_impl('parallel')
+    exe, parallel_prog, parallel_fetch, _, _ = _build_infer_prog(args)
+    custom_layers.set_spp_impl('sppf')
+    sppf_prog, _, sppf_fetch = _yolov4_infer_prog(args.num_classes)
+    custom_layers.set_spp_impl('parallel')
+    print('YOLOv4')
+    print('%20s %16s %12s %8s %6s' % ('shape', 'parallel (ms)', 'sppf (ms)', 'speedup', 'same'))
+    for size in args.input_sizes:
+        shape = (args.batch_size, 3, size, size)
+        x = rng.uniform(0, 1, shape).astype(np.float32)
+        outs, times = [], []
+        for prog, fetch_list in [(parallel_prog, parallel_fetch), (sppf_prog, sppf_fetch)]:
+            run = lambda: exe.run(prog, feed={'image': x}, fetch_list=fetch_list)
+            outs.append(run())
+            times.append(_timeit(run, args.repeat))
+        same = all(np.array_equal(a, b) for a, b in zip(outs[0], outs[1]))
+        print('%20s %16.2f %12.2f %7.2fx %6s' % (str(shape), times[0], times[1], times[0] / times[1], same))
+
+
+# benchmark.py variants对比的模型：(名字, width_mult, depth_mult, tiny)
+VARIANTS = [('yolov4', 1.0, 1.0, False),
+            ('yolov4-w0.75-d0.67', 0.75, 0.67, False),
+            ('yolov4-w0.5-d0.33', 0.5, 0.33, False),
+            ('yolov4-tiny-3l', 1.0, 1.0, True)]
+
+
+def bench_variants(args):
+    '''
+    不同宽度、深度倍数的YOLOv4，以及YOLOv4-tiny（3个输出层）在CPU上每张图片的耗时、参数量（随机权重）。
+    精度要训练之后用eval.py得到（config.py里设置width_mult、depth_mult、tiny）。
+    '''
+    import paddle.fluid as fluid
+
+    exe = fluid.Executor(fluid.CPUPlace())
+    rng = np.random.RandomState(0)
+    feeds = [rng.uniform(0, 1, (args.batch_size, 3, size, size)).astype(np.float32) for size in args.input_sizes]
+    print('%20s %12s' % ('model', 'params (M)') + ''.join(['%14s' % ('%d (ms)' % size) for size in args.input_sizes]))
+    for name, width_mult, depth_mult, tiny in VARIANTS:
+        # 各个模型的参数名一样、形状不一样，每个模型用自己的scope
+        with fluid.scope_guard(fluid.Scope()):
+            infer_prog, startup_prog, fetch_list = _yolov4_infer_prog(args.num_classes, width_mult=width_mult,
+                                                                      depth_mult=depth_mult, tiny=tiny)
+            exe.run(startup_prog)
+            params = sum([int(np.prod(p.shape)) for p in infer_prog.all_parameters()])
+            times = []
+            for x in feeds:
+                run = lambda: exe.run(infer_prog, feed={'image': x}, fetch_list=fetch_list)
+                times.append(_timeit(run, args.repeat) / args.batch_size)
+        print('%20s %12.2f' % (name, params / 1e6) + ''.join(['%14.2f' % t for t in times]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('nms', help='向量化的multiclass_nms()与原来逐类别while循环的nms对比：保留的框是否一样、速度')
+    p.add_argument('--num_candidates', type=int, nargs='+', default=[1000, 10000])
+    p.add_argument('--nms_threshs', type=float, nargs='+', default=[0.45, 0.6])
+    p.add_argument('--seeds', type=int, default=3)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_nms)
+
+    p = subparsers.add_parser('parallel_nms', help='numpy版Fast-NMS、Matrix-NMS与逐框循环、静态图fastnms()的结果对比，以及与贪心nms的速度对比')
+    p.add_argument('--num_candidates', type=int, nargs='+', default=[1000, 10000])
+    p.add_argument('--nms_threshs', type=float, nargs='+', default=[0.45, 0.6])
+    p.add_argument('--conf_thresh', type=float, default=0.05)
+    p.add_argument('--keep_top_k', type=int, default=100)
+    p.add_argument('--nms_top_k', type=int, default=100)
+    p.add_argument('--post_thresh', type=float, default=0.05)
+    p.add_argument('--use_gaussian', action='store_true')
+    p.add_argument('--gaussian_sigma', type=float, default=2.0)
+    p.add_argument('--seeds', type=int, default=3)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_parallel_nms)
+
+    p = subparsers.add_parser('batch_fastnms', help='静态图fastnms()一次处理一批图片与逐张处理的结果对比、每张图片的耗时（需要paddle）')
+    p.add_argument('--num_candidates', type=int, nargs='+', default=[2000, 10000])
+    p.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 8])
+    p.add_argument('--num_classes', type=int, default=80)
+    p.add_argument('--conf_thresh', type=float, default=0.05)
+    p.add_argument('--nms_thresh', type=float, default=0.45)
+    p.add_argument('--keep_top_k', type=int, default=100)
+    p.add_argument('--nms_top_k', type=int, default=100)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_batch_fastnms)
+
+    p = subparsers.add_parser('pre_nms', help='nms之前限制每个类别、所有类别的候选框个数前后，后处理耗时的对比')
+    p.add_argument('--num_candidates', type=int, nargs='+', default=[2000, 10000, 20000])
+    p.add_argument('--class_top_k', type=int, default=1000)
+    p.add_argument('--top_k', type=int, default=5000)
+    p.add_argument('--max_dets', type=int, default=100)
+    p.add_argument('--nms_thresh', type=float, default=0.45)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_pre_nms)
+
+    p = subparsers.add_parser('cocoeval', help='FastCOCOeval与pycocotools的COCOeval的12个指标是否一致（相差超过--atol就报错）、耗时')
+    p.add_argument('--anno_file', type=str, default='', help='不指定时用随机生成的参考数据')
+    p.add_argument('--dets', type=str, default='', help='与--anno_file一起指定，检测结果的bbox.json')
+    p.add_argument('--num_images', type=int, default=500)
+    p.add_argument('--seeds', type=int, default=3)
+    p.add_argument('--num_workers', type=int, default=0)
+    p.add_argument('--atol', type=float, default=1e-4)
+    p.set_defaults(func=bench_cocoeval)
+
+    p = subparsers.add_parser('preprocess', help='逐张预处理再拼接与直接写进批缓冲区的预处理对比，以及各插值方式的速度、精度')
+    p.add_argument('--image_dir', type=str, default='images/test/')
+    p.add_argument('--batch_size', type=int, default=8)
+    p.add_argument('--input_size', type=int, default=608)
+    p.add_argument('--algorithm', type=str, default='YOLOv4', choices=['YOLOv4', 'YOLOv3'])
+    p.add_argument('--interps', type=str, nargs='+', default=['nearest', 'linear', 'area', 'cubic', 'lanczos'])
+    p.add_argument('--repeat', type=int, default=10)
+    p.add_argument('--eval_images', type=int, default=0,
+                   help='大于0时用config.py里YOLOv4_Config_1的模型在验证集前这么多张图片上评测每种插值方式的AP（需要paddle）')
+    p.set_defaults(func=bench_preprocess)
+
+    p = subparsers.add_parser('fold_bn', help='batch_norm融合进卷积前后，YOLOv4推理的输出是否一致、CPU上的耗时（需要paddle）')
+    p.add_argument('--model_path', type=str, default='', help='不指定时用随机权重和随机的batch_norm统计量')
+    p.add_argument('--num_classes', type=int, default=80)
+    p.add_argument('--input_sizes', type=int, nargs='+', default=[320, 416, 608])
+    p.add_argument('--batch_size', type=int, default=1)
+    p.add_argument('--repeat', type=int, default=10)
+    p.set_defaults(func=bench_fold_bn)
+
+    p = subparsers.add_parser('mish', help='各种Mish实现在YOLOv4各stage特征图上的耗时、结果是否一致（需要paddle）')
+    p.add_argument('--input_size', type=int, default=608)
+    p.add_argument('--batch_size', type=int, default=1)
+    p.add_argument('--repeat', type=int, default=10)
+    p.set_defaults(func=bench_mish)
+
+    p = subparsers.add_parser('spp', help='并行的3个最大池化与连续3次5x5最大池化（SPPF）的SPP对比：单独的SPP模块和整个YOLOv4（需要paddle）')
+    p.add_argument('--model_path', type=str, default='', help='不指定时用随机权重')
+    p.add_argument('--num_classes', type=int, default=80)
+    p.add_argument('--input_sizes', type=int, nargs='+', default=[320, 416, 608])
+    p.add_argument('--batch_size', type=int, default=1)
+    p.add_argument('--repeat', type=int, default=10)
+    p.set_defaults(func=bench_spp)
+
+    p = subparsers.add_parser('variants', help='不同宽度、深度倍数的YOLOv4和YOLOv4-tiny在CPU上的耗时、参数量（需要paddle）')
+    p.add_argument('--num_classes', type=int, default=80)
+    p.add_argument('--input_sizes', type=int, nargs='+', default=[320, 416, 608])
+    p.add_argument('--batch_size', type=int, default=1)
+    p.add_argument('--repeat', type=int, default=10)
+    p.set_defaults(func=bench_variants)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+    else:
+        args.func(args)
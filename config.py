@@ -15,6 +15,16 @@ class YOLOv4_Config_1(object):
     """
     def __init__(self):
         self.algorithm = 'YOLOv4'
+        # 通道数、重复次数的倍数（见model/yolov4.py的YOLOv4()）。1.0、1.0是原版YOLOv4，
+        # 例如0.5、0.33的模型小很多，适合只有CPU的机器，但要从头训练（self.pattern = 0）
+        # depth_mult > 1时原版的重复块仍用原来的名字，多出来的重复块另外命名（见model/yolov4.py的repeat_name()）
+        self.width_mult = 1.0
+        self.depth_mult = 1.0
+        # 是否用YOLOv4-tiny（3个输出层，见model/yolov4.py的YOLOv4_tiny_3l()）
+        self.tiny = False
+        # prune.py剪枝后的模型每个卷积的通道数（例如'pruned_yolov4.channels.json'），None表示没有剪枝。
+        # 读取剪枝后的模型（model_path、infer_model_path设为'pruned_yolov4'）时要同时设置
+        self.prune_channels = None
 
         # 自定义数据集
         # self.train_path = 'annotation_json/voc2012_train.json'
@@ -57,13 +67,33 @@ class YOLOv4_Config_1(object):
         # self.input_shape = (320, 320)
         # self.input_shape = (416, 416)
         self.input_shape = (608, 608)
+        # 预处理缩放图片的插值方式：'nearest'、'linear'、'area'、'cubic'、'lanczos'。
+        # 各自的速度、与cubic的差异、在验证集子集上的AP用python benchmark.py preprocess --eval_images 500对比
+        self.interp = 'cubic'
+        # 是否保持宽高比缩放（letterbox），只填充到32的倍数，不拉伸成input_shape。宽图、高图的网络输入更小
+        self.letterbox = False
         # 验证时的分数阈值和nms_iou阈值
         self.conf_thresh = 0.001
         self.nms_thresh = 0.45
+        # nms之前每个类别、所有类别一共最多保留的候选框数（按分数，-1表示不限制）。conf_thresh很低时用来限制每张图片后处理耗时的上限
+        self.pre_nms_class_top_k = 1000
+        self.pre_nms_top_k = 5000
+        # nms之后每张图片最多保留的框数，与COCO评测的maxDets=100一致。-1表示不限制
+        self.max_dets = 100
         # 是否画出验证集图片
         self.draw_image = False
         # 验证时的批大小
         self.eval_batch_size = 4
+        # 训练时验证集预处理结果（缩放后的图片）、验证集标注索引（pickle）的缓存目录，第一次验证时写入，之后的验证直接读取。设置为None表示不缓存。
+        self.eval_cache_dir = './eval_cache'
+        # 是否用向量化的评测（tools/fast_cocoeval.py）代替pycocotools的COCOeval，12个指标与COCOeval相同，速度快10倍左右。
+        # 默认还是用COCOeval。与COCOeval的一致性用python benchmark.py cocoeval检查（12个指标相差不超过1e-4）
+        self.fast_eval = False
+        # fast_eval时按类别并行评测的进程数，0表示不开进程。
+        self.fast_eval_workers = 0
+        # 验证时后处理（解码、nms）的常驻进程数（tools/post_pool.py），网络的输出通过共享内存传给子进程。0表示在线程里后处理。
+        # 每个子进程都会重新import主脚本（包括paddle），启动慢、占内存，所以默认不开；整个验证集评测时可以设成4左右
+        self.post_workers = 0
 
 
         # ============= 训练时预处理相关 =============
@@ -94,6 +124,12 @@ class YOLOv4_Config_1(object):
         self.infer_nms_thresh = 0.45
         self.infer_keep_top_k = 100
         self.infer_nms_top_k = 100
+        # demo.py的批大小。Decode.detect_stream()按这个批大小自动凑批
+        self.infer_batch_size = 4
+        # demo.py预处理缩放图片的插值方式，与导出的infer_cfg.yml（cubic）一致。要更快可以显式改成'linear'
+        self.infer_interp = 'cubic'
+        # demo.py、导出的模型是否保持宽高比缩放（letterbox）。例如16:9的图片在608下是608x352而不是608x608
+        self.infer_letterbox = False
 
         # 是否给图片画框。
         self.infer_draw_image = True
@@ -102,6 +138,27 @@ class YOLOv4_Config_1(object):
 
 
 
+class YOLOv4_Tiny_Config_1(YOLOv4_Config_1):
+    """
+    YOLOv4-tiny（3个输出层）配置，没有列出的与YOLOv4_Config_1相同
+    """
+    def __init__(self):
+        super(YOLOv4_Tiny_Config_1, self).__init__()
+        self.tiny = True
+
+        # 没有预训练模型，从头训练
+        self.pattern = 0
+        self.lr = 0.001
+        self.batch_size = 32
+        self.model_path = None
+
+        self.input_shape = (416, 416)
+
+        # 读取的模型
+        self.infer_model_path = './weights/best_model'
+        self.infer_input_shape = (320, 320)
+
+
 class YOLOv3_Config_1(object):
     """
     YOLOv3默认配置
@@ -150,13 +207,33 @@ class YOLOv3_Config_1(object):
         # self.input_shape = (320, 320)
         # self.input_shape = (416, 416)
         self.input_shape = (608, 608)
+        # 预处理缩放图片的插值方式：'nearest'、'linear'、'area'、'cubic'、'lanczos'。
+        # 各自的速度、与cubic的差异用python benchmark.py preprocess对比，精度用eval.py对比
+        self.interp = 'cubic'
+        # 是否保持宽高比缩放（letterbox），只填充到32的倍数，不拉伸成input_shape。宽图、高图的网络输入更小
+        self.letterbox = False
         # 验证时的分数阈值和nms_iou阈值
         self.conf_thresh = 0.001
         self.nms_thresh = 0.45
+        # nms之前每个类别、所有类别一共最多保留的候选框数（按分数，-1表示不限制）。conf_thresh很低时用来限制每张图片后处理耗时的上限
+        self.pre_nms_class_top_k = 1000
+        self.pre_nms_top_k = 5000
+        # nms之后每张图片最多保留的框数，与COCO评测的maxDets=100一致。-1表示不限制
+        self.max_dets = 100
         # 是否画出验证集图片
         self.draw_image = False
         # 验证时的批大小
         self.eval_batch_size = 4
+        # 训练时验证集预处理结果（缩放后的图片）、验证集标注索引（pickle）的缓存目录，第一次验证时写入，之后的验证直接读取。设置为None表示不缓存。
+        self.eval_cache_dir = './eval_cache'
+        # 是否用向量化的评测（tools/fast_cocoeval.py）代替pycocotools的COCOeval，12个指标与COCOeval相同，速度快10倍左右。
+        # 默认还是用COCOeval。与COCOeval的一致性用python benchmark.py cocoeval检查（12个指标相差不超过1e-4）
+        self.fast_eval = False
+        # fast_eval时按类别并行评测的进程数，0表示不开进程。
+        self.fast_eval_workers = 0
+        # 验证时后处理（解码、nms）的常驻进程数（tools/post_pool.py），网络的输出通过共享内存传给子进程。0表示在线程里后处理。
+        # 每个子进程都会重新import主脚本（包括paddle），启动慢、占内存，所以默认不开；整个验证集评测时可以设成4左右
+        self.post_workers = 0
 
 
         # ============= 训练时预处理相关 =============
@@ -187,12 +264,34 @@ class YOLOv3_Config_1(object):
         self.infer_nms_thresh = 0.45
         self.infer_keep_top_k = 100
         self.infer_nms_top_k = 100
+        # demo.py的批大小。Decode.detect_stream()按这个批大小自动凑批
+        self.infer_batch_size = 4
+        # demo.py预处理缩放图片的插值方式，与导出的infer_cfg.yml（cubic）一致。要更快可以显式改成'linear'
+        self.infer_interp = 'cubic'
+        # demo.py、导出的模型是否保持宽高比缩放（letterbox）。例如16:9的图片在608下是608x352而不是608x608
+        self.infer_letterbox = False
 
         # 是否给图片画框。
         self.infer_draw_image = True
         # self.infer_draw_image = False
 
 
+class ExportConfig(object):
+    """
+    export_model.py、export_serving_model.py导出推理模型时的图优化，只改导出的program，权重不变。
+    这3项默认都打开，导出的模型与以前不同：batch_norm被融合，Mish、SPP换成更快的实现（输出只差float32的舍入误差）。
+    要导出与以前一样的program，设置fold_bn = False、mish_impl = 'default'、spp_impl = 'parallel'。
+    """
+    def __init__(self):
+        # 是否把batch_norm融合进前面的卷积（权重乘上scale / std，batch_norm换成加偏移），推理时每一层少一个batch_norm
+        self.fold_bn = True
+        # Mish的实现（见model/yolov4.py的set_mish_impl()）。'softplus'与训练时的结果一致，op少一半；
+        # 'fused'是一个op，需要paddle版本有mish op；'default'是训练时的实现
+        self.mish_impl = 'softplus'
+        # SPP的实现（见model/custom_layers.py的set_spp_impl()）。'sppf'连续做3次5x5的最大池化，与'parallel'的结果逐位相同
+        self.spp_impl = 'sppf'
+
+
 class PostprocessNumpyNMSConfig(object):
     """
     deploy_infer.py后处理配置
@@ -205,7 +304,10 @@ class PostprocessNumpyNMSConfig(object):
         self.nms_thresh = 0.45
         self.keep_top_k = 100
         self.nms_top_k = 100
-        self.nms_top_k = 100
+        # numpy_matrixnms：衰减后分数的阈值、是否用高斯衰减、高斯衰减的sigma
+        self.post_thresh = 0.05
+        self.use_gaussian = False
+        self.gaussian_sigma = 2.0
 
 
 class TrainConfig_2(object):
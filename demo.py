@@ -22,6 +22,7 @@ from model.resnet import Resnet50Vd
 from model.head import YOLOv3Head
 from model.yolov3 import YOLOv3
 from model.yolov4 import YOLOv4
+from tools.prune import load_channels
 from model.decode_np import Decode
 
 import logging
@@ -39,6 +40,7 @@ use_gpu = True
 if __name__ == '__main__':
     # 选择配置
     cfg = YOLOv4_Config_1()
+    # cfg = YOLOv4_Tiny_Config_1()
     # cfg = YOLOv3_Config_1()
 
 
@@ -71,7 +73,9 @@ if __name__ == '__main__':
             # 多尺度训练
             inputs = P.data(name='input_1', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
             if algorithm == 'YOLOv4':
-                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True)
+                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True,
+                                                      width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                                      channels=load_channels(cfg.prune_channels))
             elif algorithm == 'YOLOv3':
                 backbone = Resnet50Vd()
                 head = YOLOv3Head(keep_prob=1.0)   # 一定要设置keep_prob=1.0, 为了得到一致的推理结果
@@ -85,7 +89,11 @@ if __name__ == '__main__':
     exe.run(startup_prog)
 
     fluid.load(eval_prog, model_path, executor=exe)
-    _decode = Decode(algorithm, anchors, conf_thresh, nms_thresh, input_shape, exe, eval_prog, all_classes)
+    # 与导出的模型一样：nms之前每个类别最多infer_nms_top_k个候选框，nms之后最多infer_keep_top_k个框
+    _decode = Decode(algorithm, anchors, conf_thresh, nms_thresh, input_shape, exe, eval_prog, all_classes,
+                     pre_nms_class_top_k=cfg.infer_nms_top_k, max_dets=cfg.infer_keep_top_k, interp=cfg.infer_interp,
+                     letterbox=cfg.infer_letterbox)
+    _decode.start_post_pool(cfg.post_workers)
 
     if not os.path.exists('images/res/'): os.mkdir('images/res/')
 
@@ -105,9 +113,10 @@ if __name__ == '__main__':
     end_time = time.time()
     num_imgs = len(path_dir)
     start = time.time()
-    for k, filename in enumerate(path_dir):
-        image = cv2.imread('images/test/' + filename)
-        image, boxes, scores, classes = _decode.detect_image(image, eval_fetch_list, draw_image)
+    # 读图、网络、后处理同时进行，按path_dir的顺序产出结果
+    paths = ['images/test/' + filename for filename in path_dir]
+    for k, (path, image, boxes, scores, classes) in enumerate(_decode.detect_stream(paths, eval_fetch_list, cfg.infer_batch_size, draw_image)):
+        filename = os.path.basename(path)
 
         # 估计剩余时间
         start_time = end_time
@@ -124,5 +133,4 @@ if __name__ == '__main__':
     cost = time.time() - start
     logger.info('total time: {0:.6f}s'.format(cost))
     logger.info('Speed: %.6fs per image,  %.1f FPS.'%((cost / num_imgs), (num_imgs / cost)))
-
-
+    _decode.close_post_pool()
@@ -25,7 +25,8 @@ import numpy as np
 import paddle.fluid as fluid
 
 from config import PostprocessNumpyNMSConfig
-from tools.postprocess_np import _yolo_out
+from tools.postprocess_np import _yolo_out, yolo_box, fast_nms, matrix_nms
+from tools.preprocess import letterbox_shape, letterbox_box_shape
 from tools.visualize import visualize_box_mask, get_colors, draw
 
 
@@ -62,6 +63,7 @@ class Resize(object):
         use_cv2 (bool): whether us cv2
         image_shape (list): input shape of model
         interp (int): method of resize
+        keep_ratio (bool): 保持宽高比缩放到target_size以内（letterbox），之后由PadStride填充到32的倍数
     """
 
     def __init__(self,
@@ -70,7 +72,9 @@ class Resize(object):
                  max_size,
                  use_cv2=True,
                  image_shape=None,
-                 interp=cv2.INTER_LINEAR):
+                 interp=cv2.INTER_LINEAR,
+                 keep_ratio=False):
+        self.keep_ratio = keep_ratio
         self.target_size = target_size
         self.max_size = max_size
         self.image_shape = image_shape,
@@ -90,7 +94,11 @@ class Resize(object):
         """
         im_channel = im.shape[2]
         im_scale_x, im_scale_y = self.generate_scale(im)
-        if self.use_cv2:
+        if self.keep_ratio:
+            # 与Decode的letterbox一样的缩放后大小
+            resize_h, resize_w = letterbox_shape(im.shape, (self.target_size, self.target_size))
+            im = cv2.resize(im, (resize_w, resize_h), interpolation=self.interp)
+        elif self.use_cv2:
             im = cv2.resize(
                 im,
                 None,
@@ -216,10 +224,14 @@ class PadStride(object):
     """ padding image for model with FPN
     Args:
         stride (bool): model with FPN need image shape % stride == 0
+        channel_first (bool): image shape is CHW or HWC
+        pad_value (tuple): 每个通道填充的值。图片已经归一化时是像素值0归一化之后的值（见create_preprocess_ops()）
     """
 
-    def __init__(self, stride=0):
+    def __init__(self, stride=0, channel_first=True, pad_value=(0., 0., 0.)):
         self.coarsest_stride = stride
+        self.channel_first = channel_first
+        self.pad_value = np.array(pad_value)
 
     def __call__(self, im, im_info):
         """
@@ -232,13 +244,24 @@ class PadStride(object):
         """
         coarsest_stride = self.coarsest_stride
         if coarsest_stride == 0:
-            return im
-        im_c, im_h, im_w = im.shape
+            return im, im_info
+        if self.channel_first:
+            im_c, im_h, im_w = im.shape
+        else:
+            im_h, im_w, im_c = im.shape
         pad_h = int(np.ceil(float(im_h) / coarsest_stride) * coarsest_stride)
         pad_w = int(np.ceil(float(im_w) / coarsest_stride) * coarsest_stride)
-        padding_im = np.zeros((im_c, pad_h, pad_w), dtype=np.float32)
-        padding_im[:, :im_h, :im_w] = im
-        im_info['resize_shape'] = padding_im.shape[1:]
+        # 右边、下边填pad_value，框的坐标不用平移
+        if self.channel_first:
+            padding_im = np.empty((im_c, pad_h, pad_w), dtype=im.dtype)
+            padding_im[:] = self.pad_value[:, np.newaxis, np.newaxis]
+            padding_im[:, :im_h, :im_w] = im
+        else:
+            padding_im = np.empty((pad_h, pad_w, im_c), dtype=im.dtype)
+            padding_im[:] = self.pad_value[np.newaxis, np.newaxis, :]
+            padding_im[:im_h, :im_w, :] = im
+        im_info['unpad_shape'] = (im_h, im_w)
+        im_info['resize_shape'] = (pad_h, pad_w)
         return padding_im, im_info
 
 
@@ -257,8 +280,8 @@ def create_inputs(im, im_info, model_arch='YOLO'):
     resize_shape = list(im_info['resize_shape'])
     scale = im_info['scale']
     if 'YOLO' in model_arch:
-        # 先h再w
-        origin_shape = np.array([origin_shape]).astype('int32')
+        # 先h再w。图里的yolo_box()把坐标乘上origin_shape，letterbox时喂box_shape，直接得到原图上的坐标
+        origin_shape = np.array([np.round(im_info['box_shape'])]).astype('int32')
         resize_shape = np.array([resize_shape]).astype('int32')
         inputs['origin_shape'] = origin_shape
         inputs['resize_shape'] = resize_shape
@@ -293,6 +316,8 @@ class Config():
         self.mode = yml_conf['mode']
         self.postprocess = yml_conf['postprocess']
         self.draw_threshold = yml_conf['draw_threshold']
+        # 导出时uint8_input=True的模型在图里归一化，直接喂uint8图片。以前导出的infer_cfg.yml没有这一项
+        self.input_dtype = yml_conf.get('input_dtype', 'float32')
         self.labels = yml_conf['label_list']
         self.mask_resolution = None
         if 'mask_resolution' in yml_conf:
@@ -319,27 +344,80 @@ class Config():
         print('%s: %s' % ('mode', self.mode))
         print('%s: %s' % ('postprocess', self.postprocess))
         print('%s: %f' % ('draw_threshold', self.draw_threshold))
+        print('%s: %s' % ('input_dtype', self.input_dtype))
         print('%s: ' % ('Transform Order'))
         for op_info in self.preprocess_infos:
             print('--%s: %s' % ('transform op', op_info['type']))
         print('--------------------------------------------')
 
 
+def create_preprocess_ops(config):
+    preprocess_ops = []
+    normalize = None
+    for op_info in config.preprocess_infos:
+        op_info = dict(op_info)
+        op_type = op_info.pop('type')
+        if op_type == 'Normalize' and config.input_dtype == 'uint8':
+            # 归一化在图里做
+            continue
+        if op_type == 'Resize':
+            op_info['arch'] = config.arch
+        if op_type == 'PadStride' and normalize is not None:
+            # 已经归一化了，填像素值0归一化之后的值，与uint8输入（填0，在图里归一化）、Decode的letterbox一样
+            op_info['pad_value'] = -np.array(normalize.mean) / np.array(normalize.std)
+        op = eval(op_type)(**op_info)
+        if op_type == 'Normalize':
+            normalize = op
+        preprocess_ops.append(op)
+    return preprocess_ops
+
+
+def preprocess(im, preprocess_ops, config):
+    # process image by preprocess_ops
+    im_info = {
+        'scale': 1.,
+        'origin_shape': None,
+        'resize_shape': None,
+    }
+    im, im_info = decode_image(im, im_info)
+    for operator in preprocess_ops:
+        im, im_info = operator(im, im_info)
+    # letterbox时网络输入的右边、下边是填充的，框坐标换算到原图时用box_shape代替原图的shape
+    im_info['box_shape'] = im_info['origin_shape']
+    if 'unpad_shape' in im_info:
+        im_info['box_shape'] = letterbox_box_shape(im_info['origin_shape'], im_info['unpad_shape'],
+                                                   im_info['resize_shape'])
+    im = np.array((im, )).astype(config.input_dtype)
+    inputs = create_inputs(im, im_info, config.arch)
+    return inputs, im_info
+
+
+# 只能在CPU上用的模式。mkldnn_int8是quant.py量化后的模型（已经转换成MKLDNN的int8 op），mkldnn是原来的float32模型
+CPU_MODES = ['mkldnn', 'mkldnn_int8']
+
+
 def load_predictor(model_dir,
                    run_mode='fluid',
                    batch_size=1,
                    use_gpu=False,
-                   min_subgraph_size=3):
+                   min_subgraph_size=3,
+                   cpu_threads=1):
     """set AnalysisConfig, generate AnalysisPredictor
     Args:
         model_dir (str): root path of __model__ and __params__
         use_gpu (bool): whether use gpu
+        cpu_threads (int): number of math library threads when predict on CPU
     Returns:
         predictor (PaddlePredictor): AnalysisPredictor
     Raises:
         ValueError: predict by TensorRT need use_gpu == True.
+        ValueError: predict by MKLDNN need use_gpu == False.
     """
-    if not use_gpu and not run_mode == 'fluid':
+    if use_gpu and run_mode in CPU_MODES:
+        raise ValueError(
+            "Predict by MKLDNN mode: {}, expect use_gpu==False, but use_gpu == {}"
+            .format(run_mode, use_gpu))
+    if not use_gpu and run_mode not in ['fluid'] + CPU_MODES:
         raise ValueError(
             "Predict by TensorRT mode: {}, expect use_gpu==True, but use_gpu == {}"
             .format(run_mode, use_gpu))
@@ -361,6 +439,10 @@ def load_predictor(model_dir,
         config.switch_ir_optim(True)
     else:
         config.disable_gpu()
+        config.set_cpu_math_library_num_threads(cpu_threads)
+        if run_mode in CPU_MODES:
+            config.enable_mkldnn()
+            config.switch_ir_optim(True)
 
     if run_mode in precision_map.keys():
         config.enable_tensorrt_engine(
@@ -405,7 +487,9 @@ class Detector():
                  model_dir,
                  config,
                  use_gpu=False,
-                 run_mode='fluid'):
+                 run_mode='fluid',
+                 cpu_threads=1,
+                 batch_size=1):
         self.config = config
         if self.config.use_python_inference:
             self.executor, self.program, self.fecth_targets = load_executor(
@@ -414,28 +498,14 @@ class Detector():
             self.predictor = load_predictor(
                 model_dir,
                 run_mode=run_mode,
+                batch_size=batch_size,
                 min_subgraph_size=self.config.min_subgraph_size,
-                use_gpu=use_gpu)
-        self.preprocess_ops = []
-        for op_info in self.config.preprocess_infos:
-            op_type = op_info.pop('type')
-            if op_type == 'Resize':
-                op_info['arch'] = self.config.arch
-            self.preprocess_ops.append(eval(op_type)(**op_info))
+                use_gpu=use_gpu,
+                cpu_threads=cpu_threads)
+        self.preprocess_ops = create_preprocess_ops(self.config)
 
     def preprocess(self, im):
-        # process image by preprocess_ops
-        im_info = {
-            'scale': 1.,
-            'origin_shape': None,
-            'resize_shape': None,
-        }
-        im, im_info = decode_image(im, im_info)
-        for operator in self.preprocess_ops:
-            im, im_info = operator(im, im_info)
-        im = np.array((im, )).astype('float32')
-        inputs = create_inputs(im, im_info, self.config.arch)
-        return inputs, im_info
+        return preprocess(im, self.preprocess_ops, self.config)
 
     def postprocess(self, boxes, scores, classes, im_info, threshold):
         # postprocess output of predictor
@@ -451,6 +521,21 @@ class Detector():
         results['classes'] = classes
         return results
 
+    def predict_image(self, image, threshold=-1.0, pcfg=None):
+        '''
+        根据infer_cfg.yml里的postprocess调用predict_with_fastnms()、predict_with_multiclass_nms()或者predict_with_numpy_nms()。
+        Args:
+            pcfg (PostprocessNumpyNMSConfig): numpy_*后处理时的配置，None时用默认配置
+        '''
+        postprocess = self.config.postprocess
+        if postprocess == 'fastnms':
+            return self.predict_with_fastnms(image, threshold)
+        if postprocess == 'multiclass_nms':
+            return self.predict_with_multiclass_nms(image, threshold)
+        if postprocess.startswith('numpy'):
+            return self.predict_with_numpy_nms(image, threshold, pcfg if pcfg is not None else PostprocessNumpyNMSConfig())
+        raise ValueError("Unsupported postprocess: {}".format(postprocess))
+
     def predict_with_fastnms(self, image, threshold=-1.0):
         '''
         Args:
@@ -462,23 +547,31 @@ class Detector():
                             MaskRCNN's results include 'masks': np.ndarray:
                             shape:[N, class_num, mask_resolution, mask_resolution]
         '''
-        inputs, im_info = self.preprocess(image)
-        np_boxes, np_masks = None, None
+        return self.predict_batch_with_fastnms([image], threshold)[0]
+
+    def predict_batch_with_fastnms(self, images, threshold=-1.0):
+        '''
+        一次预测一批图片（fastnms后处理的图支持批大小大于1）。预处理之后的图片大小要一样（Resize的target_size是固定的）。
+        Args:
+            images (list): paths of images/ np.ndarray read by cv2
+            threshold (float): threshold of predicted box' score
+        Returns:
+            results (list): 每张图片的结果，与predict_with_fastnms()的一样
+        '''
+        batch = [self.preprocess(image) for image in images]
+        im_infos = [im_info for _, im_info in batch]
+        inputs = {}
+        for name in batch[0][0].keys():
+            if len(set([b[0][name].shape for b in batch])) > 1:
+                raise ValueError('Images in a batch must have the same input shape, got {}.'.format(
+                    [b[0][name].shape for b in batch]))
+            inputs[name] = np.concatenate([b[0][name] for b in batch], axis=0)
 
         # 如果用python预测。
         if self.config.use_python_inference:
             outs = self.executor.run(self.program,
                                      feed=inputs,
-                                     fetch_list=self.fecth_targets,
-                                     return_numpy=False)
-            np_boxes = np.array(outs[0][0])
-            np_boxes2 = np.array(outs[1][0])
-            np_boxes3 = np.array(outs[2][0])
-            print(np_boxes.shape)
-            print(np_boxes2.shape)
-            print(np_boxes3.shape)
-            if self.config.mask_resolution is not None:
-                np_masks = np.array(outs[1])
+                                     fetch_list=self.fecth_targets)
 
         # 如果用C++预测。
         else:
@@ -490,30 +583,35 @@ class Detector():
 
             self.predictor.zero_copy_run()
             output_names = self.predictor.get_output_names()
-
-            # 根据output_names看不出哪个输出是boxes 哪个输出是scores 哪个输出是classes
-            outs0 = self.predictor.get_output_tensor(output_names[0])
-            outs1 = self.predictor.get_output_tensor(output_names[1])
-            outs2 = self.predictor.get_output_tensor(output_names[2])
-            outs0 = outs0.copy_to_cpu()[0]   # fastnms后处理时通过reshape()腾出第0维是批大小，这里因为默认批大小是1，故取0
-            outs1 = outs1.copy_to_cpu()[0]   # fastnms后处理时通过reshape()腾出第0维是批大小，这里因为默认批大小是1，故取0
-            outs2 = outs2.copy_to_cpu()[0]   # fastnms后处理时通过reshape()腾出第0维是批大小，这里因为默认批大小是1，故取0
-            # 识别哪个输出是boxes 哪个输出是scores 哪个输出是classes
-            for o in [outs0, outs1, outs2]:
-                if len(o.shape) == 2:
-                    boxes = o
-                else:
-                    if o.dtype == np.float32:
-                        scores = o
-                    else:
-                        classes = o
-        # 后处理那里，一定不会返回空。若没有物体，scores[0]会是负数，由此来判断有没有物体。
-        if scores[0] < 0:
-            if isinstance(image, str):
-                print('[WARNNING] No object detected in %s.' % image)
-            results = {'boxes': np.array([])}
-        else:
-            results = self.postprocess(boxes, scores, classes, im_info, threshold=threshold)
+            outs = [self.predictor.get_output_tensor(name).copy_to_cpu() for name in output_names]
+
+        # 根据输出名看不出哪个输出是boxes 哪个输出是scores 哪个输出是classes，按形状、类型识别：
+        # boxes [N, T, 4]，scores [N, T]（float32），classes [N, T]（int32），num [N]（每张图片的有效框个数）
+        num = None
+        for o in outs:
+            o = np.array(o)
+            if len(o.shape) == 3:
+                boxes = o
+            elif len(o.shape) == 1:
+                num = o
+            elif o.dtype == np.float32:
+                scores = o
+            else:
+                classes = o
+        if num is None:
+            # 以前导出的模型没有num，没有物体时只有一个负分数的框
+            num = (scores >= 0).sum(axis=1)
+
+        results = []
+        for i, im_info in enumerate(im_infos):
+            n = int(num[i])
+            if n == 0:
+                if isinstance(images[i], str):
+                    print('[WARNNING] No object detected in %s.' % images[i])
+                results.append({'boxes': np.array([])})
+            else:
+                results.append(self.postprocess(boxes[i, :n], scores[i, :n], classes[i, :n], im_info,
+                                                threshold=threshold))
         return results
 
     def predict_with_multiclass_nms(self, image, threshold=-1.0):
@@ -572,12 +670,24 @@ class Detector():
         return results
 
     def predict_with_numpy_nms(self, image, threshold, pcfg):
+        '''
+        导出的模型不做后处理，只输出3个输出层，这里用numpy后处理。根据infer_cfg.yml里的postprocess：
+        numpy_nms:        逐类别的贪心nms
+        numpy_fastnms:    Fast-NMS，与fastnms模式图里的后处理结果一致
+        numpy_matrixnms:  Matrix-NMS，衰减分数而不是丢弃框
+        后两种没有逐个保留框的串行循环，全是矩阵运算。
+        Args:
+            image (str/np.ndarray): path of image/ np.ndarray read by cv2
+            threshold (float): threshold of predicted box' score
+            pcfg (PostprocessNumpyNMSConfig): 后处理配置
+        '''
         inputs, im_info = self.preprocess(image)
-        np_boxes, np_masks = None, None
 
         # 如果用python预测。
         if self.config.use_python_inference:
-            pass
+            outs = self.executor.run(self.program,
+                                     feed={'image': inputs['image']},
+                                     fetch_list=self.fecth_targets)
 
         # 如果用C++预测。
         else:
@@ -589,41 +699,30 @@ class Detector():
 
             self.predictor.zero_copy_run()
             output_names = self.predictor.get_output_names()
-
-            # 根据output_names看不出哪个输出是boxes 哪个输出是scores 哪个输出是classes
-            outs0 = self.predictor.get_output_tensor(output_names[0])
-            outs1 = self.predictor.get_output_tensor(output_names[1])
-            outs2 = self.predictor.get_output_tensor(output_names[2])
-            outs0 = outs0.copy_to_cpu()[0]
-            outs1 = outs1.copy_to_cpu()[0]
-            outs2 = outs2.copy_to_cpu()[0]
-
-            # 在这里后处理
-            # 识别哪个输出是output_l 哪个输出是output_m 哪个输出是output_s
-            # n_grids = []
-            # outs = [outs0, outs1, outs2]
-            # for i, o in enumerate(outs):
-            #     n_grids.append(o.shape[0])
-            # n_grids = np.array(n_grids, 'int32')
-            # idx = np.argsort(n_grids)
-            # n_grids = n_grids[idx]
-            # outs2 = []
-            # for _idx in idx:
-            #     outs2.append(outs[_idx])
-            # conf_thresh = pcfg.conf_thresh
-            # num_classes = 80
-            # input_shape = (416, 416)
-            # a1 = np.reshape(outs2[0], (1, input_shape[0] // 32, input_shape[1] // 32, 3, 5 + num_classes))
-            # a2 = np.reshape(outs2[1], (1, input_shape[0] // 16, input_shape[1] // 16, 3, 5 + num_classes))
-            # a3 = np.reshape(outs2[2], (1, input_shape[0] // 8, input_shape[1] // 8, 3, 5 + num_classes))
-            # h = im_info['origin_shape'][0]
-            # w = im_info['origin_shape'][1]
-            # boxes, scores, classes = _yolo_out([a1, a2, a3], (h, w), input_shape, conf_thresh)
-
-            # 上面注释掉，解锁这些，看速度上限。
-            boxes = np.zeros((1, 4), 'float32')
-            scores = np.zeros((1, ), 'float32') - 2.0
-            classes = np.zeros((1, ), 'int32')
+            outs = [self.predictor.get_output_tensor(name).copy_to_cpu() for name in output_names]
+
+        # 按格子数从少到多排列，就是output_l、output_m、output_s。每个是[1, grid_h, grid_w, 3 * (5 + num_classes)]
+        outs = sorted(outs, key=lambda o: o.shape[1] * o.shape[2])
+        outs = [np.reshape(o, (1, o.shape[1], o.shape[2], 3, -1)) for o in outs]
+        input_shape = im_info['resize_shape']
+        shape = im_info['box_shape']
+        postprocess = self.config.postprocess
+        if postprocess == 'numpy_nms':
+            boxes, scores, classes = _yolo_out(outs, shape, input_shape, pcfg.conf_thresh, pcfg.nms_thresh,
+                                               pcfg.keep_top_k)
+        else:
+            pred_boxes, pred_scores = yolo_box(outs, shape, input_shape, pcfg.conf_thresh, pcfg.anchors)
+            if postprocess == 'numpy_fastnms':
+                boxes, scores, classes = fast_nms(pred_boxes, pred_scores, pcfg.conf_thresh, pcfg.nms_thresh,
+                                                  pcfg.keep_top_k, pcfg.nms_top_k)
+            elif postprocess == 'numpy_matrixnms':
+                boxes, scores, classes = matrix_nms(pred_boxes, pred_scores, pcfg.conf_thresh, pcfg.post_thresh,
+                                                    pcfg.nms_top_k, pcfg.keep_top_k, pcfg.use_gaussian,
+                                                    pcfg.gaussian_sigma)
+            else:
+                raise ValueError("Unsupported postprocess: {}".format(postprocess))
+            if boxes is None:
+                scores = np.zeros((1, ), 'float32') - 2.0
         # 后处理那里，一定不会返回空。若没有物体，scores[0]会是负数，由此来判断有没有物体。
         if scores[0] < 0:
             if isinstance(image, str):
@@ -638,7 +737,8 @@ class Detector():
 def predict_images():
     config = Config(FLAGS.model_dir)
     detector = Detector(
-        FLAGS.model_dir, config, use_gpu=FLAGS.use_gpu, run_mode=config.mode)
+        FLAGS.model_dir, config, use_gpu=FLAGS.use_gpu, run_mode=config.mode, cpu_threads=FLAGS.cpu_threads,
+        batch_size=FLAGS.batch_size)
     if FLAGS.run_benchmark:
         detector.predict(
             FLAGS.image_file, detector.config.draw_threshold, warmup=10, repeats=10)
@@ -648,7 +748,7 @@ def predict_images():
         if not os.path.exists(FLAGS.output_dir): os.makedirs(FLAGS.output_dir)
 
         postprocess = config.postprocess
-        if postprocess == 'numpy_nms':
+        if postprocess.startswith('numpy'):
             pcfg = PostprocessNumpyNMSConfig()
 
 
@@ -663,7 +763,7 @@ def predict_images():
                 img_path = FLAGS.image_dir + filename
                 if postprocess == 'fastnms':
                     results = detector.predict_with_fastnms(img_path, detector.config.draw_threshold)
-                elif postprocess == 'numpy_nms':
+                elif postprocess.startswith('numpy'):
                     results = detector.predict_with_numpy_nms(img_path, detector.config.draw_threshold, pcfg)
                 elif postprocess == 'multiclass_nms':
                     results = detector.predict_with_multiclass_nms(img_path, detector.config.draw_threshold)
@@ -673,20 +773,24 @@ def predict_images():
         num_imgs = len(path_dir)
         start = time.time()
 
-        for k, filename in enumerate(path_dir):
-            img_path = FLAGS.image_dir + filename
+        # 只有fastnms后处理的图支持一次预测多张图片
+        batch_size = FLAGS.batch_size if postprocess == 'fastnms' else 1
+        for k in range(0, num_imgs, batch_size):
+            filenames = path_dir[k:k + batch_size]
+            img_paths = [FLAGS.image_dir + filename for filename in filenames]
             if postprocess == 'fastnms':
-                results = detector.predict_with_fastnms(img_path, detector.config.draw_threshold)
-            elif postprocess == 'numpy_nms':
-                results = detector.predict_with_numpy_nms(img_path, detector.config.draw_threshold, pcfg)
+                batch_results = detector.predict_batch_with_fastnms(img_paths, detector.config.draw_threshold)
+            elif postprocess.startswith('numpy'):
+                batch_results = [detector.predict_with_numpy_nms(img_paths[0], detector.config.draw_threshold, pcfg)]
             elif postprocess == 'multiclass_nms':
-                results = detector.predict_with_multiclass_nms(img_path, detector.config.draw_threshold)
-            image = cv2.imread(img_path)
-            if len(results['boxes']) > 0:
-                draw(image, results['boxes'], results['scores'], results['classes'], detector.config.labels, colors)
-            out_path = os.path.join(FLAGS.output_dir, filename)
-            cv2.imwrite(out_path, image)
-            print("Detection bbox results save in {}".format(out_path))
+                batch_results = [detector.predict_with_multiclass_nms(img_paths[0], detector.config.draw_threshold)]
+            for filename, img_path, results in zip(filenames, img_paths, batch_results):
+                image = cv2.imread(img_path)
+                if len(results['boxes']) > 0:
+                    draw(image, results['boxes'], results['scores'], results['classes'], detector.config.labels, colors)
+                out_path = os.path.join(FLAGS.output_dir, filename)
+                cv2.imwrite(out_path, image)
+                print("Detection bbox results save in {}".format(out_path))
         cost = time.time() - start
         print('total time: {0:.6f}s'.format(cost))
         print('Speed: %.6fs per image,  %.1f FPS.' % ((cost / num_imgs), (num_imgs / cost)))
@@ -695,14 +799,14 @@ def predict_images():
 def play_video():
     config = Config(FLAGS.model_dir)
     detector = Detector(
-        FLAGS.model_dir, config, use_gpu=FLAGS.use_gpu, run_mode=config.mode)
+        FLAGS.model_dir, config, use_gpu=FLAGS.use_gpu, run_mode=config.mode, cpu_threads=FLAGS.cpu_threads)
     # if os.path.exists(FLAGS.output_dir): shutil.rmtree(FLAGS.output_dir)
     # os.makedirs(FLAGS.output_dir)
     if not os.path.exists(FLAGS.output_dir): os.makedirs(FLAGS.output_dir)
 
 
     postprocess = config.postprocess
-    if postprocess == 'numpy_nms':
+    if postprocess.startswith('numpy'):
         pcfg = PostprocessNumpyNMSConfig()
 
     # 获取颜色
@@ -718,7 +822,7 @@ def play_video():
             img_path = image_dir + filename
             if postprocess == 'fastnms':
                 results = detector.predict_with_fastnms(img_path, detector.config.draw_threshold)
-            elif postprocess == 'numpy_nms':
+            elif postprocess.startswith('numpy'):
                 results = detector.predict_with_numpy_nms(img_path, detector.config.draw_threshold, pcfg)
             elif postprocess == 'multiclass_nms':
                 results = detector.predict_with_multiclass_nms(img_path, detector.config.draw_threshold)
@@ -746,7 +850,7 @@ def play_video():
         index += 1
         if postprocess == 'fastnms':
             results = detector.predict_with_fastnms(frame, detector.config.draw_threshold)
-        elif postprocess == 'numpy_nms':
+        elif postprocess.startswith('numpy'):
             results = detector.predict_with_numpy_nms(frame, detector.config.draw_threshold, pcfg)
         elif postprocess == 'multiclass_nms':
             results = detector.predict_with_multiclass_nms(frame, detector.config.draw_threshold)
@@ -768,10 +872,10 @@ def play_video():
 def predict_video():
     config = Config(FLAGS.model_dir)
     detector = Detector(
-        FLAGS.model_dir, config, use_gpu=FLAGS.use_gpu, run_mode=config.mode)
+        FLAGS.model_dir, config, use_gpu=FLAGS.use_gpu, run_mode=config.mode, cpu_threads=FLAGS.cpu_threads)
 
     postprocess = config.postprocess
-    if postprocess == 'numpy_nms':
+    if postprocess.startswith('numpy'):
         pcfg = PostprocessNumpyNMSConfig()
 
     capture = cv2.VideoCapture(FLAGS.video_file)
@@ -793,7 +897,7 @@ def predict_video():
         index += 1
         if postprocess == 'fastnms':
             results = detector.predict_with_fastnms(frame, detector.config.draw_threshold)
-        elif postprocess == 'numpy_nms':
+        elif postprocess.startswith('numpy'):
             results = detector.predict_with_numpy_nms(frame, detector.config.draw_threshold, pcfg)
         elif postprocess == 'multiclass_nms':
             results = detector.predict_with_multiclass_nms(frame, detector.config.draw_threshold)
@@ -832,6 +936,16 @@ if __name__ == '__main__':
         type=ast.literal_eval,
         default=True,
         help="Whether to predict with GPU.")
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        default=1,
+        help="Number of math library threads when predict on CPU.")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Number of images per batch when predict image_dir, only for fastnms postprocess.")
     parser.add_argument(
         "--run_benchmark",
         type=ast.literal_eval,
@@ -13,17 +13,22 @@ import cv2
 import os
 import copy
 import json
+import sys
 import time
+import argparse
 import numpy as np
 from config import *
 from model.head import YOLOv3Head
 from model.resnet import Resnet50Vd
 from model.yolov3 import YOLOv3
-from tools.cocotools import eval
+from tools.cocotools import eval, load_coco_gt, bbox_eval, collect_detections, get_catid_lut
+from tools.nms_sweep import CandidateWriter
+from tools.shard import shard_range, is_shard_done, save_shard, load_shards, launch_shards
 import paddle.fluid as fluid
 import paddle.fluid.layers as P
 from tools.cocotools import get_classes, clsid2catid
 from model.yolov4 import YOLOv4
+from tools.prune import load_channels
 from model.decode_np import Decode
 
 import logging
@@ -39,8 +44,25 @@ use_gpu = True
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Eval on val2017.')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='把验证集分成几片。大于1时每一片由一个子进程（或者另一台机器）预测，最后合并评测。')
+    parser.add_argument('--shard_id', type=int, default=-1,
+                        help='只预测这一片并保存结果。-1表示启动所有没完成的分片，再合并评测。')
+    parser.add_argument('--shard_dir', type=str, default='eval_results/shards/', help='分片结果的保存目录。')
+    parser.add_argument('--gpus', type=str, default='0', help='分片子进程轮流使用的GPU，逗号分隔，例如0,1,2,3')
+    parser.add_argument('--max_procs', type=int, default=0, help='同时运行的子进程数，0表示等于GPU数。')
+    parser.add_argument('--merge', action='store_true', help='不启动子进程，只合并已经完成的分片并评测。')
+    parser.add_argument('--save_candidates', type=str, default='',
+                        help='把每张图片nms之前的候选框保存到这个目录，之后用sweep.py搜索conf_thresh、nms_thresh，不用再跑网络。')
+    args = parser.parse_args()
+    if args.save_candidates and args.num_shards > 1:
+        # 分片时每一片只保存检测结果，候选框没有按片保存、合并
+        parser.error('--save_candidates is not supported with --num_shards > 1, run eval.py without sharding to save candidates.')
+
     # 选择配置
     cfg = YOLOv4_Config_1()
+    # cfg = YOLOv4_Tiny_Config_1()
     # cfg = YOLOv3_Config_1()
 
 
@@ -68,11 +90,24 @@ if __name__ == '__main__':
     # anno_file = '../COCO/annotations/instances_val2017.json'
     eval_pre_path = cfg.val_pre_path
     anno_file = cfg.val_path
-    with open(anno_file, 'r', encoding='utf-8') as f2:
-        for line in f2:
-            line = line.strip()
-            dataset = json.loads(line)
-            images = dataset['images']
+    # 标注只解析一次，评测时bbox_eval()直接复用这个COCO对象
+    images = load_coco_gt(anno_file, cfg.eval_cache_dir).dataset['images']
+
+    if args.num_shards > 1 and args.shard_id < 0:
+        # 启动所有没完成的分片（已完成的跳过，中断后重新运行会接着跑），全部完成后合并评测
+        if not args.merge:
+            launch_shards(os.path.abspath(__file__), args.num_shards, args.shard_dir, images,
+                          [int(g) for g in args.gpus.split(',')], args.max_procs)
+        dets = load_shards(args.shard_dir, args.num_shards, images)
+        box_ap = bbox_eval(anno_file, dets, fast_eval=cfg.fast_eval, fast_eval_workers=cfg.fast_eval_workers)
+        sys.exit(0)
+    if args.num_shards > 1:
+        if is_shard_done(args.shard_dir, args.num_shards, args.shard_id, images):
+            logger.info('Shard {}/{} is already done.'.format(args.shard_id, args.num_shards))
+            sys.exit(0)
+        all_images = images
+        start, end = shard_range(len(images), args.num_shards, args.shard_id)
+        images = images[start:end]
 
     anchors = cfg.anchors
     num_anchors = len(cfg.anchor_masks[0])
@@ -87,7 +122,9 @@ if __name__ == '__main__':
             # 多尺度训练
             inputs = P.data(name='input_1', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
             if algorithm == 'YOLOv4':
-                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True)
+                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True,
+                                                      width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                                      channels=load_channels(cfg.prune_channels))
             elif algorithm == 'YOLOv3':
                 backbone = Resnet50Vd()
                 head = YOLOv3Head(keep_prob=1.0)   # 一定要设置keep_prob=1.0, 为了得到一致的推理结果
@@ -101,7 +138,9 @@ if __name__ == '__main__':
     exe.run(startup_prog)
 
     fluid.load(eval_prog, model_path, executor=exe)
-    _decode = Decode(algorithm, anchors, conf_thresh, nms_thresh, input_shape, exe, eval_prog, all_classes)
+    _decode = Decode(algorithm, anchors, conf_thresh, nms_thresh, input_shape, exe, eval_prog, all_classes,
+                     cfg.pre_nms_class_top_k, cfg.pre_nms_top_k, cfg.max_dets, cfg.interp, cfg.letterbox)
+    _decode.start_post_pool(cfg.post_workers)
 
 
     _clsid2catid = copy.deepcopy(clsid2catid)
@@ -109,5 +148,15 @@ if __name__ == '__main__':
         _clsid2catid = {}
         for k in range(num_classes):
             _clsid2catid[k] = k
-    box_ap = eval(_decode, eval_fetch_list, images, eval_pre_path, anno_file, eval_batch_size, _clsid2catid, draw_image)
-
+    if args.num_shards > 1:
+        if draw_image and not os.path.exists('eval_results/images/'): os.makedirs('eval_results/images/')
+        dets = collect_detections(_decode, eval_fetch_list, images, eval_pre_path, eval_batch_size, _clsid2catid,
+                                  draw_image, 'eval_results/images/')
+        save_shard(args.shard_dir, args.num_shards, args.shard_id, all_images, dets)
+    else:
+        candidate_writer = None
+        if args.save_candidates:
+            candidate_writer = CandidateWriter(args.save_candidates, get_catid_lut(_clsid2catid), conf_thresh)
+        box_ap = eval(_decode, eval_fetch_list, images, eval_pre_path, anno_file, eval_batch_size, _clsid2catid, draw_image,
+                      fast_eval=cfg.fast_eval, fast_eval_workers=cfg.fast_eval_workers, candidate_writer=candidate_writer)
+    _decode.close_post_pool()
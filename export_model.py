@@ -20,7 +20,10 @@ from model.head import YOLOv3Head
 from model.resnet import Resnet50Vd
 from model.yolov3 import YOLOv3
 from tools.cocotools import get_classes
-from model.yolov4 import YOLOv4
+from model.yolov4 import YOLOv4, set_mish_impl
+from tools.prune import load_channels
+from model.custom_layers import set_spp_impl
+from tools.fold_bn import fold_batch_norm
 from config import *
 
 import logging
@@ -108,6 +111,27 @@ def save_infer_model(save_dir, exe, feed_vars, test_fetches, infer_prog):
         params_filename="__params__")
 
 
+def preprocess_input(image, algorithm, input_layout='NCHW'):
+    '''
+    在图里做预处理：uint8 -> float32，NHWC -> NCHW，归一化（与Decode、deploy_infer.py的Normalize一致）。
+    :param image:  缩放好的uint8 RGB图片
+    '''
+    x = P.cast(image, 'float32')
+    if input_layout == 'NHWC':
+        x = P.transpose(x, perm=[0, 3, 1, 2])
+    if algorithm == 'YOLOv4':
+        x = P.scale(x, scale=1. / 255.)
+    elif algorithm == 'YOLOv3':
+        mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+        std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+        # (x - mean) / std = x * (1 / std) + (-mean / std)，按通道乘加
+        scale = P.assign(1. / std)
+        bias = P.assign(-mean / std)
+        x = P.elementwise_mul(x, scale, axis=1)
+        x = P.elementwise_add(x, bias, axis=1)
+    return x
+
+
 def dump_infer_config(save_dir, cfg):
     if os.path.exists('%s/infer_cfg.yml' % save_dir): os.remove('%s/infer_cfg.yml' % save_dir)
     content = ''
@@ -137,6 +161,17 @@ if __name__ == '__main__':
     # postprocess = 'fastnms'
     postprocess = 'multiclass_nms'
     # postprocess = 'numpy_nms'
+    # postprocess = 'numpy_fastnms'
+    # postprocess = 'numpy_matrixnms'
+
+    # 导出的模型是否直接接收uint8图片（缩放好的RGB图片，不用归一化）。转float、归一化在图里做，
+    # 客户端不用再做这些运算，传的数据量是float32的1/4。
+    uint8_input = False
+    # uint8_input时输入的排列，'NCHW'，或者'NHWC'（客户端连transpose也不用做）
+    input_layout = 'NCHW'
+
+    # 导出时的图优化（batch_norm融合、Mish和SPP的实现），见config.py的ExportConfig
+    export_cfg = ExportConfig()
 
     # need 3 for YOLO arch
     min_subgraph_size = 3
@@ -154,6 +189,7 @@ if __name__ == '__main__':
 
     # 选择配置
     cfg = YOLOv4_Config_1()
+    # cfg = YOLOv4_Tiny_Config_1()
     # cfg = YOLOv3_Config_1()
 
 
@@ -167,6 +203,9 @@ if __name__ == '__main__':
     # input_shape越大，精度会上升，但速度会下降。
     input_shape = cfg.infer_input_shape
 
+    # 是否保持宽高比缩放（letterbox）。只影响infer_cfg.yml里的预处理，不用改模型
+    letterbox = cfg.infer_letterbox
+
     # 推理时的分数阈值和nms_iou阈值。注意，这些值会写死进模型，如需修改请重新导出模型。
     conf_thresh = cfg.infer_conf_thresh
     nms_thresh = cfg.infer_nms_thresh
@@ -188,11 +227,20 @@ if __name__ == '__main__':
     num_classes = len(all_classes)
 
 
+    set_mish_impl(export_cfg.mish_impl)
+    set_spp_impl(export_cfg.spp_impl)
     startup_prog = fluid.Program()
     infer_prog = fluid.Program()
     with fluid.program_guard(infer_prog, startup_prog):
         with fluid.unique_name.guard():
-            inputs = P.data(name='image', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
+            if uint8_input:
+                # 输入是缩放好的uint8 RGB图片，转float、归一化（以及NHWC转NCHW）在图里做
+                image_shape = [-1, -1, -1, 3] if input_layout == 'NHWC' else [-1, 3, -1, -1]
+                image = P.data(name='image', shape=image_shape, append_batch_size=False, dtype='uint8')
+                inputs = preprocess_input(image, algorithm, input_layout)
+            else:
+                image = P.data(name='image', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
+                inputs = image
 
             if postprocess == 'fastnms' or postprocess == 'multiclass_nms':
                 resize_shape = P.data(name='resize_shape', shape=[-1, 2], append_batch_size=False, dtype='int32')
@@ -208,31 +256,43 @@ if __name__ == '__main__':
                 param['num_classes'] = num_classes
                 param['num_anchors'] = num_anchors
                 # 输入字典
-                feed_vars = [('image', inputs), ('resize_shape', resize_shape), ('origin_shape', origin_shape)]
+                feed_vars = [('image', image), ('resize_shape', resize_shape), ('origin_shape', origin_shape)]
                 feed_vars = OrderedDict(feed_vars)
-            if postprocess == 'numpy_nms':
+            if postprocess in ['numpy_nms', 'numpy_fastnms', 'numpy_matrixnms']:
                 param = None
                 # 输入字典
-                feed_vars = [('image', inputs), ]
+                feed_vars = [('image', image), ]
                 feed_vars = OrderedDict(feed_vars)
 
             if algorithm == 'YOLOv4':
                 if postprocess == 'fastnms':
-                    boxes, scores, classes = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True, export=True, postprocess=postprocess, param=param)
-                    test_fetches = {'boxes': boxes, 'scores': scores, 'classes': classes, }
+                    boxes, scores, classes, num = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True, export=True, postprocess=postprocess, param=param,
+                                                    width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                                    channels=load_channels(cfg.prune_channels))
+                    test_fetches = {'boxes': boxes, 'scores': scores, 'classes': classes, 'num': num, }
                 if postprocess == 'multiclass_nms':
-                    pred = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True, export=True, postprocess=postprocess, param=param)
+                    pred = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True, export=True, postprocess=postprocess, param=param,
+                                  width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                  channels=load_channels(cfg.prune_channels))
                     test_fetches = {'pred': pred, }
+                if postprocess in ['numpy_nms', 'numpy_fastnms', 'numpy_matrixnms']:
+                    output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True, export=True, postprocess=postprocess, param=param,
+                                                          width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                                          channels=load_channels(cfg.prune_channels))
+                    test_fetches = {'output_l': output_l, 'output_m': output_m, 'output_s': output_s, }
             elif algorithm == 'YOLOv3':
                 backbone = Resnet50Vd()
                 head = YOLOv3Head(keep_prob=1.0)   # 一定要设置keep_prob=1.0, 为了得到一致的推理结果
                 yolov3 = YOLOv3(backbone, head)
                 if postprocess == 'fastnms':
-                    boxes, scores, classes = yolov3(inputs, export=True, postprocess=postprocess, param=param)
-                    test_fetches = {'boxes': boxes, 'scores': scores, 'classes': classes, }
+                    boxes, scores, classes, num = yolov3(inputs, export=True, postprocess=postprocess, param=param)
+                    test_fetches = {'boxes': boxes, 'scores': scores, 'classes': classes, 'num': num, }
                 if postprocess == 'multiclass_nms':
                     pred = yolov3(inputs, export=True, postprocess=postprocess, param=param)
                     test_fetches = {'pred': pred, }
+                if postprocess in ['numpy_nms', 'numpy_fastnms', 'numpy_matrixnms']:
+                    output_l, output_m, output_s = yolov3(inputs, export=True, postprocess=postprocess, param=param)
+                    test_fetches = {'output_l': output_l, 'output_m': output_m, 'output_s': output_s, }
     infer_prog = infer_prog.clone(for_test=True)
     place = fluid.CPUPlace()
     exe = fluid.Executor(place)
@@ -241,6 +301,8 @@ if __name__ == '__main__':
 
     logger.info("postprocess: %s" % postprocess)
     load_params(exe, infer_prog, model_path)
+    if export_cfg.fold_bn:
+        fold_batch_norm(infer_prog, fluid.global_scope(), place)
 
     save_infer_model(save_dir, exe, feed_vars, test_fetches, infer_prog)
 
@@ -257,6 +319,12 @@ if __name__ == '__main__':
     cfg['input_shape_h'] = input_shape_h
     cfg['input_shape_w'] = input_shape_w
     cfg['class_names'] = all_classes
+    # uint8_input时deploy_infer.py跳过Normalize，直接喂uint8；NHWC时也不做Permute
+    cfg['input_dtype'] = 'uint8' if uint8_input else 'float32'
+    cfg['channel_first'] = not (uint8_input and input_layout == 'NHWC')
+    # letterbox时保持宽高比缩放，再填充到32的倍数
+    cfg['keep_ratio'] = letterbox
+    cfg['pad_stride'] = 32 if letterbox else 0
     if algorithm == 'YOLOv4':
         cfg['is_scale'] = True
         cfg['mean0'] = 0.0
@@ -16,12 +16,15 @@ import numpy as np
 import paddle.fluid as fluid
 import paddle.fluid.layers as P
 
-from export_model import load_params, dump_infer_config, prune_feed_vars
+from export_model import load_params, dump_infer_config, prune_feed_vars, preprocess_input
 from model.head import YOLOv3Head
 from model.resnet import Resnet50Vd
 from model.yolov3 import YOLOv3
 from tools.cocotools import get_classes
-from model.yolov4 import YOLOv4
+from model.yolov4 import YOLOv4, set_mish_impl
+from tools.prune import load_channels
+from model.custom_layers import set_spp_impl
+from tools.fold_bn import fold_batch_norm
 from config import *
 
 import logging
@@ -68,6 +71,15 @@ if __name__ == '__main__':
     postprocess = 'multiclass_nms'
     # postprocess = 'numpy_nms'
 
+    # 导出的模型是否直接接收uint8图片（缩放好的RGB图片，不用归一化）。转float、归一化在图里做，
+    # 客户端不用再做这些运算，传的数据量是float32的1/4。
+    uint8_input = False
+    # uint8_input时输入的排列，'NCHW'，或者'NHWC'（客户端连transpose也不用做）
+    input_layout = 'NCHW'
+
+    # 导出时的图优化（batch_norm融合、Mish和SPP的实现），见config.py的ExportConfig
+    export_cfg = ExportConfig()
+
     # need 3 for YOLO arch
     min_subgraph_size = 3
 
@@ -84,6 +96,7 @@ if __name__ == '__main__':
 
     # 选择配置
     cfg = YOLOv4_Config_1()
+    # cfg = YOLOv4_Tiny_Config_1()
     # cfg = YOLOv3_Config_1()
 
 
@@ -118,11 +131,20 @@ if __name__ == '__main__':
     num_classes = len(all_classes)
 
 
+    set_mish_impl(export_cfg.mish_impl)
+    set_spp_impl(export_cfg.spp_impl)
     startup_prog = fluid.Program()
     infer_prog = fluid.Program()
     with fluid.program_guard(infer_prog, startup_prog):
         with fluid.unique_name.guard():
-            inputs = P.data(name='image', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
+            if uint8_input:
+                # 输入是缩放好的uint8 RGB图片，转float、归一化（以及NHWC转NCHW）在图里做
+                image_shape = [-1, -1, -1, 3] if input_layout == 'NHWC' else [-1, 3, -1, -1]
+                image = P.data(name='image', shape=image_shape, append_batch_size=False, dtype='uint8')
+                inputs = preprocess_input(image, algorithm, input_layout)
+            else:
+                image = P.data(name='image', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
+                inputs = image
 
             if postprocess == 'fastnms' or postprocess == 'multiclass_nms':
                 resize_shape = P.data(name='resize_shape', shape=[-1, 2], append_batch_size=False, dtype='int32')
@@ -138,28 +160,32 @@ if __name__ == '__main__':
                 param['num_classes'] = num_classes
                 param['num_anchors'] = num_anchors
                 # 输入字典
-                feed_vars = [('image', inputs), ('resize_shape', resize_shape), ('origin_shape', origin_shape)]
+                feed_vars = [('image', image), ('resize_shape', resize_shape), ('origin_shape', origin_shape)]
                 feed_vars = OrderedDict(feed_vars)
             if postprocess == 'numpy_nms':
                 param = None
                 # 输入字典
-                feed_vars = [('image', inputs), ]
+                feed_vars = [('image', image), ]
                 feed_vars = OrderedDict(feed_vars)
 
             if algorithm == 'YOLOv4':
                 if postprocess == 'fastnms':
-                    boxes, scores, classes = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True, export=True, postprocess=postprocess, param=param)
-                    test_fetches = {'boxes': boxes, 'scores': scores, 'classes': classes, }
+                    boxes, scores, classes, num = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True, export=True, postprocess=postprocess, param=param,
+                                                    width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                                    channels=load_channels(cfg.prune_channels))
+                    test_fetches = {'boxes': boxes, 'scores': scores, 'classes': classes, 'num': num, }
                 if postprocess == 'multiclass_nms':
-                    pred = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True, export=True, postprocess=postprocess, param=param)
+                    pred = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True, export=True, postprocess=postprocess, param=param,
+                                  width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                  channels=load_channels(cfg.prune_channels))
                     test_fetches = {'pred': pred, }
             elif algorithm == 'YOLOv3':
                 backbone = Resnet50Vd()
                 head = YOLOv3Head(keep_prob=1.0)   # 一定要设置keep_prob=1.0, 为了得到一致的推理结果
                 yolov3 = YOLOv3(backbone, head)
                 if postprocess == 'fastnms':
-                    boxes, scores, classes = yolov3(inputs, export=True, postprocess=postprocess, param=param)
-                    test_fetches = {'boxes': boxes, 'scores': scores, 'classes': classes, }
+                    boxes, scores, classes, num = yolov3(inputs, export=True, postprocess=postprocess, param=param)
+                    test_fetches = {'boxes': boxes, 'scores': scores, 'classes': classes, 'num': num, }
                 if postprocess == 'multiclass_nms':
                     pred = yolov3(inputs, export=True, postprocess=postprocess, param=param)
                     test_fetches = {'pred': pred, }
@@ -171,6 +197,8 @@ if __name__ == '__main__':
 
     logger.info("postprocess: %s" % postprocess)
     load_params(exe, infer_prog, model_path)
+    if export_cfg.fold_bn:
+        fold_batch_norm(infer_prog, fluid.global_scope(), place)
 
     save_serving_model(save_dir, exe, feed_vars, test_fetches, infer_prog)
     logger.info("Done.")
@@ -118,6 +118,51 @@ class Conv2dUnit(object):
         return x
 
 
+
+# SPP的实现。'parallel'是对同一张特征图分别做5x5、9x9、13x13的最大池化；
+# 'sppf'是连续做3次5x5的最大池化（stride=1，padding=2）：两次5x5的池化窗口正好是9x9，三次是13x13，
+# 边界处填充的部分不参与取最大值，所以结果与'parallel'完全一样（逐位相同），计算量只有25 * 3，而不是25 + 81 + 169。
+# 但有多个最大值时两者反向传播给的元素不一样，所以训练、验证默认用原版的'parallel'，
+# 只有export_model.py、export_serving_model.py导出推理模型时才用set_spp_impl('sppf')。
+SPP_IMPLS = ['parallel', 'sppf']
+_spp_impl = 'parallel'
+
+
+def set_spp_impl(impl):
+    global _spp_impl
+    if impl not in SPP_IMPLS:
+        raise ValueError('Unknown spp implementation {}, expect one of {}.'.format(impl, SPP_IMPLS))
+    _spp_impl = impl
+
+
+def spp_max_pools(x):
+    '''
+    :return:  x的5x5、9x9、13x13最大池化（stride=1，输出与x一样大）
+    '''
+    if _spp_impl == 'sppf':
+        pools = []
+        y = x
+        for _ in range(3):
+            y = fluid.layers.pool2d(
+                input=y,
+                pool_size=5,
+                pool_type='max',
+                pool_stride=1,
+                pool_padding=2,
+                ceil_mode=True)
+            pools.append(y)
+        return pools
+    pools = []
+    for size in [5, 9, 13]:
+        pools.append(fluid.layers.pool2d(
+            input=x,
+            pool_size=size,
+            pool_type='max',
+            pool_stride=1,
+            pool_padding=size // 2,
+            ceil_mode=True))
+    return pools
+
 def DropBlock(input, block_size, keep_prob, is_test):
     if is_test:
         return input
@@ -4,11 +4,26 @@ import colorsys
 import cv2
 import threading
 import os
+import time
+import queue
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
+from tools.postprocess_np import conf_logit_threshold, nms_boxes, multiclass_nms, pre_nms_top_k
+from tools.preprocess import BatchPreprocessor
+
 
 class Decode(object):
-    def __init__(self, algorithm, anchors, obj_threshold, nms_threshold, input_shape, exe, program, all_classes):
+    def __init__(self, algorithm, anchors, obj_threshold, nms_threshold, input_shape, exe, program, all_classes,
+                 pre_nms_class_top_k=-1, pre_nms_top_k=-1, max_dets=-1, interp='cubic', letterbox=False):
+        '''
+        :param pre_nms_class_top_k:  nms之前每个类别最多保留的候选框数，-1表示不限制
+        :param pre_nms_top_k:        nms之前所有类别一共最多保留的候选框数，-1表示不限制
+        :param max_dets:             nms之后每张图片最多保留的框数，-1表示不限制
+        :param interp:               预处理缩放图片的插值方式，见tools/preprocess.py
+        :param letterbox:            保持宽高比缩放，只填充到32的倍数（tools/preprocess.py），不拉伸成input_shape
+        '''
         self.algorithm = algorithm
         self.anchors = anchors
         self._t1 = obj_threshold
@@ -18,22 +33,37 @@ class Decode(object):
         self.num_classes = len(self.all_classes)
         self.exe = exe
         self.program = program
+        self._consts = {}
+        self.pre_nms_class_top_k = pre_nms_class_top_k
+        self.pre_nms_top_k = pre_nms_top_k
+        self.max_dets = max_dets
+        self.letterbox = letterbox
+        self.preprocessor = BatchPreprocessor(input_shape, algorithm, interp, letterbox)
+        self.post_pool = None
+
+    # 启动常驻的后处理进程池（tools/post_pool.py）。之后detect_batch()、post_batch()在子进程里后处理，不再每张图片开一个线程
+    def start_post_pool(self, num_workers=4, num_slots=2):
+        from tools.post_pool import PostprocessPool
+        if self.post_pool is None and num_workers > 0:
+            self.post_pool = PostprocessPool(self, num_workers, num_slots)
+
+    def close_post_pool(self):
+        if self.post_pool is not None:
+            self.post_pool.close()
+            self.post_pool = None
 
     # 处理一张图片
     def detect_image(self, image, fetch_list, draw_image):
-        pimage = self.process_image(np.copy(image))
+        pimage = self.process_image(image)
 
         boxes, scores, classes = self.predict(pimage, fetch_list, image.shape)
         if boxes is not None and draw_image:
             self.draw(image, boxes, scores, classes)
         return image, boxes, scores, classes
 
-    # 多线程后处理
-    def multi_thread_post(self, batch_img, outs, i, draw_image, result_image, result_boxes, result_scores, result_classes):
-        a1 = np.reshape(outs[0][i], (1, self.input_shape[0] // 32, self.input_shape[1] // 32, 3, 5 + self.num_classes))
-        a2 = np.reshape(outs[1][i], (1, self.input_shape[0] // 16, self.input_shape[1] // 16, 3, 5 + self.num_classes))
-        a3 = np.reshape(outs[2][i], (1, self.input_shape[0] // 8, self.input_shape[1] // 8, 3, 5 + self.num_classes))
-        boxes, scores, classes = self._yolo_out([a1, a2, a3], batch_img[i].shape)
+    # 多线程后处理。candidates是candidates_batch()的结果，每个线程只做第i张图片的nms
+    def multi_thread_post(self, batch_img, candidates, i, draw_image, result_image, result_boxes, result_scores, result_classes):
+        boxes, scores, classes = self.nms(*candidates[i], batch_img[i].shape)
         if boxes is not None and draw_image:
             self.draw(batch_img[i], boxes, scores, classes)
         result_image[i] = batch_img[i]
@@ -41,23 +71,30 @@ class Decode(object):
         result_scores[i] = scores
         result_classes[i] = classes
 
+    # 多线程后处理，只要原图的shape，不画图
+    def multi_thread_post_shape(self, candidates, i, shape, result_boxes, result_scores, result_classes):
+        boxes, scores, classes = self.nms(*candidates[i], shape)
+        result_boxes[i] = boxes
+        result_scores[i] = scores
+        result_classes[i] = classes
+
     # 处理一批图片
     def detect_batch(self, batch_img, fetch_list, draw_image):
+        outs = self._forward_batch(batch_img, fetch_list)
+        if self.post_pool is not None:
+            future = self.post_pool.submit(outs, [image.shape for image in batch_img])
+            return self._draw_results(batch_img, future.result(), draw_image)
+
         batch_size = len(batch_img)
         result_image, result_boxes, result_scores, result_classes = [None] * batch_size, [None] * batch_size, [None] * batch_size, [None] * batch_size
-        batch = []
-
-        for image in batch_img:
-            pimage = self.process_image(np.copy(image))
-            batch.append(pimage)
-        batch = np.concatenate(batch, axis=0)
-        outs = self.exe.run(self.program, feed={"input_1": batch, }, fetch_list=fetch_list)
+        # 整批一起解码
+        candidates = self.candidates_batch(outs, [image.shape for image in batch_img])
 
         # 多线程
         threads = []
         for i in range(batch_size):
             t = threading.Thread(target=self.multi_thread_post, args=(
-                batch_img, outs, i, draw_image, result_image, result_boxes, result_scores, result_classes))
+                batch_img, candidates, i, draw_image, result_image, result_boxes, result_scores, result_classes))
             threads.append(t)
             t.start()
         # 等待所有线程任务结束。
@@ -65,6 +102,242 @@ class Decode(object):
             t.join()
         return result_image, result_boxes, result_scores, result_classes
 
+    # 逐批处理batches里的每一批图片，每一批返回一个detect_batch()那样的结果。
+    # 用了后处理进程池时，这一批交给子进程后处理的同时，主线程接着跑下一批的网络。
+    def detect_batches(self, batches, fetch_list, draw_image):
+        if self.post_pool is None:
+            for batch_img in batches:
+                yield self.detect_batch(batch_img, fetch_list, draw_image)
+            return
+        pending = None
+        for batch_img in batches:
+            outs = self._forward_batch(batch_img, fetch_list)
+            future = self.post_pool.submit(outs, [image.shape for image in batch_img])
+            if pending is not None:
+                yield self._draw_results(pending[0], pending[1].result(), draw_image)
+            pending = (batch_img, future)
+        if pending is not None:
+            yield self._draw_results(pending[0], pending[1].result(), draw_image)
+
+    # 读一张图片并缩放。item是图片路径或者cv2读进来的BGR图片。返回原图、resize_image()的结果、原图的shape
+    def load_item(self, item):
+        image = cv2.imread(item) if isinstance(item, str) else item
+        return image, self.resize_image(image), image.shape
+
+    def detect_stream(self, items, fetch_list, batch_size=8, draw_image=False, max_latency=None,
+                      num_workers=4, prefetch=2, load=None, post=None, stats=None, group_window=None):
+        '''
+        流式预测。items可以是任意可迭代对象（图片路径、cv2读进来的BGR图片，也可以是视频帧的生成器），
+        按items的顺序逐张产出(item, image, boxes, scores, classes)，image是原图（draw_image时画好了框）。
+        内部自动凑批：凑够batch_size张，或者最早的一张图片等了max_latency秒（视频流、摄像头这种来得慢的输入），就跑一次网络。
+        letterbox时按网络输入的shape分组凑批（宽图和宽图一批，高图和高图一批），最多缓冲group_window张图片
+        （默认batch_size * 4），超过时最早的图片所在的组不凑满也先跑。
+        读图和缩放在线程池里提前做；后处理交给后处理进程池（start_post_pool()）或者一个后处理线程，画框也在后处理线程里；
+        最多prefetch批在后处理中时，主线程接着跑下一批的网络。读图、网络、后处理三段同时进行。
+        :param load:   load(item) -> (image, pimage, shape)，默认是load_item()。例如读验证集缓存。
+        :param post:   post(outs, batch_items, batch_shape) -> (result_boxes, result_scores, result_classes)，
+                       在后处理线程里被调用，默认是post_batch()
+        :param stats:  tools.eval_pipeline.PipelineStats，统计每个阶段的耗时
+        '''
+        load = self.load_item if load is None else load
+        if group_window is None:
+            group_window = batch_size * 4 if self.letterbox else batch_size
+        group_window = max(group_window, batch_size)
+        loader = ThreadPoolExecutor(max_workers=num_workers)
+        poster = ThreadPoolExecutor(max_workers=1)   # 只有一个线程，post()按批的顺序被调用
+        loaded = queue.Queue(maxsize=batch_size * (prefetch + 1))
+        stop = threading.Event()
+
+        def timed_load(item):
+            t0 = time.time()
+            out = load(item)
+            if stats is not None:
+                stats.add('load', time.time() - t0)
+            return out
+
+        def feed():
+            try:
+                for item in items:
+                    if stop.is_set():
+                        break
+                    loaded.put((item, loader.submit(timed_load, item)))
+            except Exception as e:
+                loaded.put(e)
+            loaded.put(None)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        groups = OrderedDict()   # 网络输入的shape -> 读好的图片：(序号, 到达时间, item, (image, pimage, shape))
+        pending = deque()   # 在后处理中的批：(序号, batch_items, batch_img, future)
+        finished = {}       # 后处理完、还没有轮到产出的图片：序号 -> 结果
+        max_pending = prefetch
+        if post is None and self.post_pool is not None:
+            # 进程池的共享内存块都被占用时submit()会等，这里要先取走最早的一批，否则会互相等待
+            max_pending = min(prefetch, self.post_pool.num_slots - 1)
+
+        def finish(seqs, batch_items, batch_img, future):
+            t0 = time.time()
+            result_boxes, result_scores, result_classes = future.result()
+            if stats is not None:
+                stats.add('wait_post', time.time() - t0)
+            for k, item in enumerate(batch_items):
+                finished[seqs[k]] = (item, batch_img[k], result_boxes[k], result_scores[k], result_classes[k])
+
+        # 在后处理线程里等这一批的后处理结果并画框，不占用主线程
+        def draw_batch(future, batch_img):
+            result = future.result()
+            for image, boxes, scores, classes in zip(batch_img, *result):
+                if image is not None and boxes is not None:
+                    self.draw(image, boxes, scores, classes)
+            return result
+
+        # 取最早的一张图片所在的组
+        def oldest_group():
+            key = min(groups, key=lambda g: groups[g][0][0])
+            return groups.pop(key)
+
+        try:
+            seq, next_seq, num_buffered = 0, 0, 0
+            done = False
+            while True:
+                # 凑一批：有一组凑满、缓冲满、最早的图片等够了max_latency或者读完了就跑
+                t0 = time.time()
+                batch = None
+                while batch is None:
+                    for key, group in groups.items():
+                        if len(group) >= batch_size:
+                            batch = groups.pop(key)
+                            break
+                    if batch is not None:
+                        break
+                    deadline = None
+                    if groups and max_latency is not None:
+                        deadline = min(group[0][1] for group in groups.values()) + max_latency
+                    if groups and (done or num_buffered >= group_window or
+                                   (deadline is not None and time.time() >= deadline)):
+                        batch = oldest_group()
+                        break
+                    if done:
+                        break
+                    try:
+                        if deadline is None:
+                            entry = loaded.get()
+                        else:
+                            entry = loaded.get(timeout=max(deadline - time.time(), 0.0))
+                    except queue.Empty:
+                        continue
+                    if entry is None:
+                        done = True
+                        continue
+                    if isinstance(entry, Exception):
+                        raise entry
+                    item, future = entry
+                    image, pimage, shape = future.result()
+                    key = self.preprocessor.pad_shape([pimage.shape])
+                    groups.setdefault(key, []).append((seq, time.time(), item, (image, pimage, shape)))
+                    seq += 1
+                    num_buffered += 1
+                if batch is None:
+                    break
+                num_buffered -= len(batch)
+                if stats is not None:
+                    stats.add('wait_load', time.time() - t0)
+                    stats.load_depth.append(loaded.qsize())
+                seqs = [x[0] for x in batch]
+                batch_items = [x[2] for x in batch]
+                batch_img = [x[3][0] for x in batch]
+                batch_pimage = [x[3][1] for x in batch]
+                batch_shape = [x[3][2] for x in batch]
+
+                t0 = time.time()
+                outs = self.run_batch(batch_pimage, fetch_list)
+                if stats is not None:
+                    stats.add('infer', time.time() - t0)
+                    stats.post_depth.append(len(pending))
+                    stats.num_batches += 1
+                if post is None and self.post_pool is not None:
+                    future = self.post_pool.submit(outs, batch_shape)
+                elif post is None:
+                    future = poster.submit(self.post_batch, outs, batch_shape)
+                else:
+                    future = poster.submit(post, outs, batch_items, batch_shape)
+                if draw_image:
+                    # poster只有一个线程，排在这一批的后处理之后
+                    future = poster.submit(draw_batch, future, batch_img)
+                pending.append((seqs, batch_items, batch_img, future))
+                if len(pending) > max_pending:
+                    finish(*pending.popleft())
+                    # 按items的顺序产出
+                    while next_seq in finished:
+                        yield finished.pop(next_seq)
+                        next_seq += 1
+            while pending:
+                finish(*pending.popleft())
+                while next_seq in finished:
+                    yield finished.pop(next_seq)
+                    next_seq += 1
+        finally:
+            # 正常结束，或者调用方中途不再取结果（break、出错）
+            stop.set()
+            while feeder.is_alive():
+                try:
+                    loaded.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for seqs, batch_items, batch_img, future in pending:
+                try:
+                    future.result()
+                except Exception:
+                    pass
+            loader.shutdown()
+            poster.shutdown()
+
+    def _forward_batch(self, batch_img, fetch_list):
+        batch = self.preprocessor.process(batch_img)
+        return self.exe.run(self.program, feed={"input_1": batch, }, fetch_list=fetch_list)
+
+    def _draw_results(self, batch_img, results, draw_image):
+        result_boxes, result_scores, result_classes = results
+        if draw_image:
+            for image, boxes, scores, classes in zip(batch_img, result_boxes, result_scores, result_classes):
+                if boxes is not None:
+                    self.draw(image, boxes, scores, classes)
+        return list(batch_img), result_boxes, result_scores, result_classes
+
+    # 处理一批已经缩放好的图片。batch_pimage是resize_image()的结果组成的列表（或者叠成的[bz, h, w, 3]），batch_shape是原图的shape
+    def detect_preprocessed(self, batch_pimage, batch_shape, fetch_list):
+        outs = self.run_batch(batch_pimage, fetch_list)
+        return self.post_batch(outs, batch_shape)
+
+    # 只跑网络。batch_pimage是resize_image()的结果组成的列表（或者叠成的[bz, h, w, 3]）
+    def run_batch(self, batch_pimage, fetch_list):
+        batch = self.normalize_batch(batch_pimage)
+        outs = self.exe.run(self.program, feed={"input_1": batch, }, fetch_list=fetch_list)
+        return outs
+
+    # 只做后处理。outs是run_batch()的结果，batch_shape是原图的shape
+    def post_batch(self, outs, batch_shape):
+        if self.post_pool is not None:
+            return self.post_pool.submit(outs, batch_shape).result()
+        batch_size = len(batch_shape)
+        result_boxes, result_scores, result_classes = [None] * batch_size, [None] * batch_size, [None] * batch_size
+        # 整批一起解码
+        candidates = self.candidates_batch(outs, batch_shape)
+
+        # 多线程
+        threads = []
+        for i in range(batch_size):
+            t = threading.Thread(target=self.multi_thread_post_shape, args=(
+                candidates, i, batch_shape[i], result_boxes, result_scores, result_classes))
+            threads.append(t)
+            t.start()
+        # 等待所有线程任务结束。
+        for t in threads:
+            t.join()
+        return result_boxes, result_scores, result_classes
+
     def draw(self, image, boxes, scores, classes):
         image_h, image_w, _ = image.shape
         # 定义颜色
@@ -92,31 +365,28 @@ class Decode(object):
             cv2.putText(image, bbox_mess, (left, top - 2), cv2.FONT_HERSHEY_SIMPLEX,
                         0.5, (0, 0, 0), 1, lineType=cv2.LINE_AA)
 
+    # BGR原图 -> [1, 3, h, w]的网络输入。单独分配，不用批缓冲区，返回值可以一直留着
     def process_image(self, img):
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        h, w = img.shape[:2]
-        scale_x = float(self.input_shape[1]) / w
-        scale_y = float(self.input_shape[0]) / h
-        img = cv2.resize(img, None, None, fx=scale_x, fy=scale_y, interpolation=cv2.INTER_CUBIC)
-        if self.algorithm == 'YOLOv4':
-            pimage = img.astype(np.float32) / 255.
-        elif self.algorithm == 'YOLOv3':
-            mean = np.array([0.485, 0.456, 0.406])[np.newaxis, np.newaxis, :].astype(np.float32)
-            std = np.array([0.229, 0.224, 0.225])[np.newaxis, np.newaxis, :].astype(np.float32)
-            pimage = img.astype(np.float32) - mean
-            pimage /= std
-        pimage = pimage.transpose(2, 0, 1)
-        pimage = np.expand_dims(pimage, axis=0)
+        resized = self.resize_image(img)
+        h, w = self.preprocessor.pad_shape([resized.shape])
+        pimage = np.empty((1, 3, h, w), dtype=np.float32)
+        self.preprocessor.fill(pimage, 0, resized)
         return pimage
 
+    # BGR原图 -> 缩放到input_shape（letterbox时是保持宽高比缩放到input_shape以内）的BGR图，uint8，HWC。
+    # 还没有交换通道、归一化、填充，可以缓存起来。
+    def resize_image(self, img):
+        return self.preprocessor.resize(img)
+
+    # 一批resize_image()的结果 -> 网络的输入。写进复用的批缓冲区，下一批覆盖之前要交给网络
+    def normalize_batch(self, batch):
+        return self.preprocessor.normalize(batch)
+
     def predict(self, image, fetch_list, shape):
         outs = self.exe.run(self.program, feed={"input_1": image, }, fetch_list=fetch_list)
 
         # numpy后处理
-        a1 = np.reshape(outs[0], (1, self.input_shape[0]//32, self.input_shape[1]//32, 3, 5+self.num_classes))
-        a2 = np.reshape(outs[1], (1, self.input_shape[0]//16, self.input_shape[1]//16, 3, 5+self.num_classes))
-        a3 = np.reshape(outs[2], (1, self.input_shape[0]//8, self.input_shape[1]//8, 3, 5+self.num_classes))
-        boxes, scores, classes = self._yolo_out([a1, a2, a3], shape)
+        boxes, scores, classes = self._yolo_out(outs, shape)
 
         return boxes, scores, classes
 
@@ -124,127 +394,130 @@ class Decode(object):
     def _sigmoid(self, x):
         return 1 / (1 + np.exp(-x))
 
-    def _process_feats(self, out, anchors, mask):
-        grid_h, grid_w, num_boxes = map(int, out.shape[1: 4])
-
-        anchors = [anchors[i] for i in mask]
-        anchors_tensor = np.array(anchors).reshape(1, 1, len(anchors), 2)
-
-        # Reshape to batch, height, width, num_anchors, box_params.
-        out = out[0]
-        box_xy = self._sigmoid(out[..., :2])
-        box_wh = np.exp(out[..., 2:4])
-        box_wh = box_wh * anchors_tensor
-
-        box_confidence = self._sigmoid(out[..., 4])
-        box_confidence = np.expand_dims(box_confidence, axis=-1)
-        box_class_probs = self._sigmoid(out[..., 5:])
-
-        col = np.tile(np.arange(0, grid_w), grid_w).reshape(-1, grid_w)
-        row = np.tile(np.arange(0, grid_h).reshape(-1, 1), grid_h)
-
-        col = col.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-        row = row.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-        grid = np.concatenate((col, row), axis=-1)
-
-        box_xy += grid
+    # 每一层的网格偏移和anchor按(grid_h, grid_w, 层)缓存，不用对每张图片每一层都重新构造
+    def _level_consts(self, grid_h, grid_w, level):
+        key = (grid_h, grid_w, level)
+        consts = self._consts.get(key)
+        if consts is None:
+            masks = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
+            anchors = [self.anchors[i] for i in masks[level]]
+            anchors_tensor = np.array(anchors).reshape(1, 1, 1, len(anchors), 2)
+
+            col = np.tile(np.arange(0, grid_w), (grid_h, 1))
+            row = np.tile(np.arange(0, grid_h).reshape(-1, 1), (1, grid_w))
+            grid = np.stack((col, row), axis=-1).reshape(1, grid_h, grid_w, 1, 2).repeat(len(anchors), axis=-2)
+            grid = grid.astype(np.float32)
+            consts = (grid, anchors_tensor)
+            self._consts[key] = consts
+        return consts
+
+    # 一整批一起解码。out是某一层的输出，[batch, height, width, num_anchors, box_params]，input_shape是网络输入的(h, w)。
+    # score = conf * prob <= conf，所以先在logit空间里按objectness过滤，只对留下来的框解码坐标、算类别概率。
+    # 返回留下来的框所属的图片下标和它们的boxes, box_confidence, box_class_probs
+    def _process_feats(self, out, level, input_shape):
+        grid_h, grid_w = map(int, out.shape[1: 3])
+        grid, anchors_tensor = self._level_consts(grid_h, grid_w, level)
+
+        im_ids, rows, cols, ans = np.where(out[..., 4] >= conf_logit_threshold(self._t1))
+        out = out[im_ids, rows, cols, ans]   # [n, box_params]
+
+        box_xy = self._sigmoid(out[:, :2])
+        box_wh = np.exp(out[:, 2:4])
+        box_wh = box_wh * anchors_tensor[0, 0, 0, ans]
+
+        box_confidence = self._sigmoid(out[:, 4:5])
+        # 原地计算1 / (1 + exp(-x))，少分配几个临时数组，结果与self._sigmoid()一样
+        box_class_probs = np.negative(out[:, 5:])
+        np.exp(box_class_probs, out=box_class_probs)
+        box_class_probs += 1
+        np.divide(1, box_class_probs, out=box_class_probs)
+
+        box_xy += grid[0, rows, cols, ans]
         box_xy /= (grid_w, grid_h)
-        box_wh /= self.input_shape
+        box_wh /= (input_shape[1], input_shape[0])   # box_wh是先w再h
         box_xy -= (box_wh / 2.)   # 坐标格式是左上角xy加矩形宽高wh，xywh都除以图片边长归一化了。
         boxes = np.concatenate((box_xy, box_wh), axis=-1)
 
-        return boxes, box_confidence, box_class_probs
+        return im_ids, boxes, box_confidence, box_class_probs
 
+    # 按分数阈值过滤，返回被保留的框的下标和它们的boxes, classes, scores
     def _filter_boxes(self, boxes, box_confidences, box_class_probs):
-        box_scores = box_confidences * box_class_probs
+        box_class_probs *= box_confidences   # 原地乘，box_class_probs变成box_scores
+        box_scores = box_class_probs
         box_classes = np.argmax(box_scores, axis=-1)
-        box_class_scores = np.max(box_scores, axis=-1)
-        pos = np.where(box_class_scores >= self._t1)
+        # 最大值就是argmax处的值，不用再扫一遍
+        box_class_scores = np.take_along_axis(box_scores, box_classes[..., np.newaxis], axis=-1)[..., 0]
+        pos = np.where(box_class_scores >= self._t1)[0]
 
         boxes = boxes[pos]
         classes = box_classes[pos]
         scores = box_class_scores[pos]
 
-        return boxes, classes, scores
+        return pos, boxes, classes, scores
 
     def _nms_boxes(self, boxes, scores):
-        x = boxes[:, 0]
-        y = boxes[:, 1]
-        w = boxes[:, 2]
-        h = boxes[:, 3]
-
-        areas = w * h
-        order = scores.argsort()[::-1]
-
-        keep = []
-        while order.size > 0:
-            i = order[0]
-            keep.append(i)
-
-            xx1 = np.maximum(x[i], x[order[1:]])
-            yy1 = np.maximum(y[i], y[order[1:]])
-            xx2 = np.minimum(x[i] + w[i], x[order[1:]] + w[order[1:]])
-            yy2 = np.minimum(y[i] + h[i], y[order[1:]] + h[order[1:]])
-
-            w1 = np.maximum(0.0, xx2 - xx1 + 1)
-            h1 = np.maximum(0.0, yy2 - yy1 + 1)
-            inter = w1 * h1
-
-            ovr = inter / (areas[i] + areas[order[1:]] - inter)
-            inds = np.where(ovr <= self._t2)[0]
-            order = order[inds + 1]
-
-        keep = np.array(keep)
-
-        return keep
+        return nms_boxes(boxes, scores, self._t2)
 
+    # 解码、按分数阈值过滤之后，nms之前的候选框。boxes是xywh（左上角坐标、宽高），都除以原图边长归一化了。
+    def _yolo_candidates(self, outs, shape=None):
+        return self.candidates_batch(outs, None if shape is None else [shape])[0]
 
     def _yolo_out(self, outs, shape):
-        masks = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
-        anchors = self.anchors
-
-        boxes, classes, scores = [], [], []
-
-        for out, mask in zip(outs, masks):
-            b, c, s = self._process_feats(out, anchors, mask)
-            b, c, s = self._filter_boxes(b, c, s)
-            boxes.append(b)
-            classes.append(c)
-            scores.append(s)
-
-        boxes = np.concatenate(boxes)
-        classes = np.concatenate(classes)
-        scores = np.concatenate(scores)
-
-        # boxes坐标格式是左上角xy加矩形宽高wh，xywh都除以图片边长归一化了。
-        # Scale boxes back to original image shape.
-        w, h = shape[1], shape[0]
-        image_dims = [w, h, w, h]
-        boxes = boxes * image_dims
-
-        nboxes, nclasses, nscores = [], [], []
-        for c in set(classes):
-            inds = np.where(classes == c)
-            b = boxes[inds]
-            c = classes[inds]
-            s = scores[inds]
-
-            keep = self._nms_boxes(b, s)
-
-            nboxes.append(b[keep])
-            nclasses.append(c[keep])
-            nscores.append(s[keep])
-
-        if not nclasses and not nscores:
-            return None, None, None
-
-        boxes = np.concatenate(nboxes)
-        classes = np.concatenate(nclasses)
-        scores = np.concatenate(nscores)
-
-        # 换坐标
-        boxes[:, [2, 3]] = boxes[:, [0, 1]] + boxes[:, [2, 3]]
-
-        return boxes, scores, classes
-
-
+        boxes, scores, classes = self._yolo_candidates(outs, shape)
+        return self.nms(boxes, scores, classes, shape)
+
+    # 对一张图片的候选框做nms，用这个Decode的nms阈值和候选框个数限制
+    def nms(self, boxes, scores, classes, shape):
+        return nms_candidates(boxes, scores, classes, shape, self._t2, self.max_dets,
+                              self.pre_nms_class_top_k, self.pre_nms_top_k)
+
+    # 一批输出中每张图片nms之前的候选框，每张图片是一个(boxes, scores, classes)。
+    # sigmoid、exp、加网格偏移、乘anchor都是整批一起做的，逐张图片的只有按下标切分。
+    # batch_shape是原图的shape，letterbox时用来把框坐标换成除以原图边长归一化（去掉填充的部分）。
+    def candidates_batch(self, outs, batch_shape=None):
+        batch_size = len(outs[0])
+        # 网络输入的(h, w)由output_l的格子数得到，letterbox时每一批可能不一样
+        input_shape = (int(outs[0].shape[1]) * 32, int(outs[0].shape[2]) * 32)
+        box_scale = None
+        if batch_shape is not None:
+            box_scale = self.preprocessor.box_scale(batch_shape, input_shape)
+        levels = []
+        for level, (out, stride) in enumerate(zip(outs, [32, 16, 8])):
+            out = np.reshape(out, (batch_size, input_shape[0] // stride, input_shape[1] // stride, 3, 5 + self.num_classes))
+            im_ids, b, c, s = self._process_feats(out, level, input_shape)
+            pos, b, c, s = self._filter_boxes(b, c, s)
+            im_ids = im_ids[pos]
+            if box_scale is not None:
+                b *= np.tile(box_scale[im_ids], (1, 2))
+            # np.where按行优先的顺序返回下标，同一张图片的框是连续的
+            splits = np.cumsum(np.bincount(im_ids, minlength=batch_size))[:-1]
+            levels.append((np.split(b, splits), np.split(s, splits), np.split(c, splits)))
+
+        result = []
+        for i in range(batch_size):
+            boxes = np.concatenate([lv[0][i] for lv in levels])
+            scores = np.concatenate([lv[1][i] for lv in levels])
+            classes = np.concatenate([lv[2][i] for lv in levels])
+            result.append((boxes, scores, classes))
+        return result
+
+
+def nms_candidates(boxes, scores, classes, shape, nms_thresh, keep_top_k=-1, class_top_k=-1, top_k=-1):
+    '''
+    对Decode._yolo_candidates()的结果做nms（tools/postprocess_np.multiclass_nms()，所有类别一起做）。
+    :param boxes:  xywh（左上角坐标、宽高），都除以图片边长归一化了
+    :param shape:  原图的shape
+    :param keep_top_k:   nms之后最多保留的框数，-1表示不限制
+    :param class_top_k:  nms之前每个类别最多保留的候选框数，-1表示不限制
+    :param top_k:        nms之前所有类别一共最多保留的候选框数，-1表示不限制
+    :return:  原图上的boxes（左上角坐标、右下角坐标）, scores, classes。没有框时返回None, None, None
+    '''
+    if class_top_k > 0 or top_k > 0:
+        keep = pre_nms_top_k(scores, classes, class_top_k, top_k)
+        if len(keep) < len(scores):
+            boxes, scores, classes = boxes[keep], scores[keep], classes[keep]
+    # Scale boxes back to original image shape.
+    w, h = shape[1], shape[0]
+    image_dims = [w, h, w, h]
+    boxes = boxes * image_dims
+    return multiclass_nms(boxes, scores, classes, nms_thresh, keep_top_k)
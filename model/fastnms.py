@@ -49,25 +49,42 @@ def _iou(box_a, box_b):
     iou = inter_area / (union_area + 1e-9)
     return iou
 
-def fast_nms(boxes, scores, conf_thresh, nms_thresh, keep_top_k, nms_top_k):
+def _batch_gather(x, idx):
     '''
-    :param boxes:    [?, 4]
-    :param scores:   [80, ?]
+    每张图片按自己的下标取元素。
+    :param x:      [batch_size, N, ...]
+    :param idx:    [batch_size, M]  int64，每张图片里的下标
+    :return:   [batch_size * M, ...]
     '''
+    batch_size, n = P.shape(x)[0], P.shape(x)[1]
+    # 第i张图片的下标加上i * N，变成x的前两维展平之后的下标
+    offset = P.cast(P.range(0, batch_size, 1, 'int32') * n, 'int64')
+    idx = P.elementwise_add(idx, offset, axis=0)
+    x = P.flatten(x, axis=2) if len(x.shape) > 2 else P.reshape(x, (-1, 1))
+    return P.gather(x, P.reshape(idx, (-1, )))
 
-    # 同类方框根据得分降序排列
-    scores, idx = P.argsort(scores, axis=1, descending=True)
+def fast_nms(boxes, scores, conf_thresh, nms_thresh, keep_top_k, nms_top_k):
+    '''
+    :param boxes:    [batch_size, ?, 4]   cx_cy_w_h格式
+    :param scores:   [batch_size, ?, 80]
+    :return:   boxes [batch_size, nms_top_k, 4], scores [batch_size, nms_top_k], classes [batch_size, nms_top_k]。
+               被丢弃的、分数不超过conf_thresh的框分数是-2，排在有效的框后面。
+               要求每张图片的候选框个数 >= keep_top_k，80 * keep_top_k >= nms_top_k（topk()的要求）
+    '''
+    batch_size = P.shape(scores)[0]
 
-    idx = idx[:, :keep_top_k]
-    scores = scores[:, :keep_top_k]
+    # 同类方框根据得分降序排列，每个类别取前keep_top_k个框。
+    # 不先按最高分数过滤：最高分数不超过conf_thresh的框，它在每个类别上的分数都不超过conf_thresh，
+    # 排在有效的框后面，不会抑制有效的框，最后被分数过滤掉，结果与先过滤一样，但不会出现某张图片没有候选框的情况
+    scores = P.transpose(scores, perm=[0, 2, 1])  # [batch_size, 80, ?]
+    scores, idx = P.topk(scores, k=keep_top_k)
 
-    num_classes, num_dets = P.shape(idx)[0], P.shape(idx)[1]
+    num_classes, num_dets = P.shape(idx)[1], P.shape(idx)[2]
 
-    idx = P.reshape(idx, (-1, ))
-    boxes = P.gather(boxes, idx)
-    boxes = P.reshape(boxes, (num_classes, num_dets, 4))
+    boxes = _batch_gather(boxes, P.reshape(idx, (batch_size, -1)))
+    boxes = P.reshape(boxes, (-1, num_dets, 4))   # [batch_size * 80, keep_top_k, 4]
 
-    # 计算一个c×n×n的IOU矩阵，其中每个n×n矩阵表示对该类n个候选框，两两之间的IOU
+    # 计算一个c×n×n的IOU矩阵，其中每个n×n矩阵表示对该类n个候选框，两两之间的IOU（c = batch_size * 80）
     iou = _iou(boxes, boxes)
 
     # 因为自己与自己的IOU=1，IOU(A,B)=IOU(B,A)，所以对上一步得到的IOU矩阵
@@ -77,94 +94,65 @@ def fast_nms(boxes, scores, conf_thresh, nms_thresh, keep_top_k, nms_top_k):
     rows = P.expand(P.reshape(rows, (1, -1)), [num_dets, 1])
     cols = P.expand(P.reshape(cols, (-1, 1)), [1, num_dets])
     tri_mask = P.cast(rows > cols, 'float32')
-    tri_mask = P.expand(P.reshape(tri_mask, (1, num_dets, num_dets)), [num_classes, 1, 1])
+    tri_mask = P.expand(P.reshape(tri_mask, (1, num_dets, num_dets)), [P.shape(boxes)[0], 1, 1])
     iou = tri_mask * iou
     iou_max = P.reduce_max(iou, dim=1)
 
     # 同一类别，n个框与“分数比它高的框”的最高iou超过nms_thresh的话，就丢弃。下标是0的框肯定被保留。
-    keep = P.where(iou_max <= nms_thresh)
+    # 再做一次分数过滤。只要某个框最高分数>阈值就会参与每个类别的nms，
+    # 然而这个框其实重复了80次，每一个分身代表是不同类的物品。
+    # 非最高分数的其它类别，它的得分可能小于阈值，要过滤。
+    # 所以fastnms存在这么一个现象：某个框它最高分数 > 阈值，它有一个非最高分数类的得分也超过了阈值，
+    # 那么最后有可能两个框都保留，而且这两个框有相同的xywh
+    scores = P.reshape(scores, (-1, num_dets))
+    keep = P.cast(iou_max <= nms_thresh, 'float32') * P.cast(scores > conf_thresh, 'float32')
+    # 不保留的框分数设为-2，不用按图片取出不定个数的框
+    scores = scores * keep + (keep - 1.0) * 2.0
+    scores = P.reshape(scores, (batch_size, -1))   # [batch_size, 80 * keep_top_k]
+    boxes = P.reshape(boxes, (batch_size, -1, 4))
 
     # Assign each kept detection to its corresponding class
     classes = P.range(0, num_classes, 1, 'int32')
-    classes = P.expand(P.reshape(classes, (-1, 1)), [1, num_dets])
-    classes = P.gather_nd(classes, keep)
-
-    boxes = P.gather_nd(boxes, keep)
-    scores = P.gather_nd(scores, keep)
+    classes = P.expand(P.reshape(classes, (1, -1, 1)), [batch_size, 1, num_dets])
+    classes = P.reshape(classes, (batch_size, -1))
 
     # Only keep the top cfg.max_num_detections highest scores across all classes
-    scores, idx = P.argsort(scores, axis=0, descending=True)
-    idx = idx[:nms_top_k]
-    scores = scores[:nms_top_k]
+    scores, idx = P.topk(scores, k=nms_top_k)
 
-    classes = P.gather(classes, idx)
-    boxes = P.gather(boxes, idx)
+    boxes = P.reshape(_batch_gather(boxes, idx), (batch_size, -1, 4))
+    classes = P.reshape(_batch_gather(classes, idx), (batch_size, -1))
 
     return boxes, scores, classes
 
 def fastnms(all_pred_boxes, all_pred_scores, resize_shape,
             origin_shape, conf_thresh, nms_thresh, keep_top_k, nms_top_k, use_yolo_box):
     '''
+    每张图片各自做Fast-NMS，支持批大小大于1。
     :param all_pred_boxes:      [batch_size, -1, 4]
     :param all_pred_scores:     [batch_size, -1, 80]
     :param resize_shape:        [batch_size, 2]
     :param origin_shape:        [batch_size, 2]
+    :return:   boxes [batch_size, nms_top_k, 4], scores [batch_size, nms_top_k], classes [batch_size, nms_top_k], num [batch_size]。
+               第i张图片只有前num[i]个框是有效的，后面填充的框分数是负数
     '''
-    conf_preds = P.transpose(all_pred_scores, perm=[0, 2, 1])  # [1, 80, -1]
-    cur_scores = conf_preds[0]  # [80, -1]
-    conf_scores = P.reduce_max(cur_scores, dim=0)  # [-1, ]
-    # keep如果是[None]，并且在gather()里使用了keep，就会出现
-    # cudaGetLastError  invalid configuration argument errno: 9   这个错误。
-    # 为了避免上面的问题，只能让keep不是[None]，所以这里当keep是[None]时给keep赋予一个坐标[[0]]。
-    keep = P.where(conf_scores > conf_thresh)
-    def exist_objs_1(keep):
-        return keep
-    def no_objs_1():
-        keep_extra = P.zeros((1, 1), 'int64')
-        return keep_extra
-    keep = P.cond(P.shape(keep)[0] == 0, no_objs_1, lambda: exist_objs_1(keep))
-    scores = P.gather(all_pred_scores[0], keep)
-    scores = P.transpose(scores, perm=[1, 0])
-    boxes = P.gather(all_pred_boxes[0], keep)
-    boxes, scores, classes = fast_nms(boxes, scores, conf_thresh, nms_thresh, keep_top_k, nms_top_k)
-
-
-    # 再做一次分数过滤。前面提到，只要某个框最高分数>阈值就保留，
-    # 然而计算上面那个矩阵时，这个框其实重复了80次，每一个分身代表是不同类的物品。
-    # 非最高分数的其它类别，它的得分可能小于阈值，要过滤。
-    # 所以fastnms存在这么一个现象：某个框它最高分数 > 阈值，它有一个非最高分数类的得分也超过了阈值，
-    # 那么最后有可能两个框都保留，而且这两个框有相同的xywh
-    keep = P.where(scores > conf_thresh)
-    def exist_objs_2(keep, boxes, classes, scores):
-        boxes = P.gather(boxes, keep)
-        classes = P.gather(classes, keep)
-        scores = P.gather(scores, keep)
-        return boxes, classes, scores
-    def no_objs_2(boxes, classes, scores):
-        keep = P.zeros((1, 1), 'int64')
-        boxes = P.gather(boxes, keep)
-        classes = P.gather(classes, keep)
-        scores = P.gather(scores, keep)
-        scores -= 2.0  # 巧妙设置为负分数让python端过滤
-        return boxes, classes, scores
-    boxes, classes, scores = P.cond(P.shape(keep)[0] == 0,
-                                           lambda: no_objs_2(boxes, classes, scores),
-                                           lambda: exist_objs_2(keep, boxes, classes, scores))
+    boxes, scores, classes = fast_nms(all_pred_boxes, all_pred_scores, conf_thresh, nms_thresh, keep_top_k, nms_top_k)
+    num = P.reduce_sum(P.cast(scores > -1.0, 'int32'), dim=1)
+
     # 变成左上角坐标、右下角坐标
-    boxes = P.concat([boxes[:, :2] - boxes[:, 2:] * 0.5,
-                      boxes[:, :2] + boxes[:, 2:] * 0.5], axis=-1)
+    boxes = P.concat([boxes[:, :, :2] - boxes[:, :, 2:] * 0.5,
+                      boxes[:, :, :2] + boxes[:, :, 2:] * 0.5], axis=-1)
 
     # 缩放到原图大小
     if not use_yolo_box:
         resize_shape_f = P.cast(resize_shape, 'float32')
         origin_shape_f = P.cast(origin_shape, 'float32')
         scale = origin_shape_f / resize_shape_f
-        scale = P.expand(scale, [1, 3])   # [[h, w, h, w, h, w]]
-        boxes *= scale[:, 1:5]   # 批大小是1才支持这么做，因为scale第0维表示批大小，boxes第0维却表示这张图片预测出的物体数
+        scale = P.expand(scale, [1, 3])[:, 1:5]   # [[h, w, h, w, h, w]]取出每张图片的[w, h, w, h]
+        scale = P.expand(P.reshape(scale, (-1, 1, 4)), [1, P.shape(boxes)[1], 1])
+        boxes *= scale
 
     # 批大小在前
-    boxes = P.reshape(boxes, (1, -1, 4), name='boxes')
-    scores = P.reshape(scores, (1, -1), name='scores')
-    classes = P.reshape(classes, (1, -1), name='classes')
-    return [boxes, scores, classes]
-
+    boxes = P.reshape(boxes, (-1, P.shape(scores)[1], 4), name='boxes')
+    scores = P.reshape(scores, (-1, P.shape(scores)[1]), name='scores')
+    classes = P.reshape(classes, (-1, P.shape(scores)[1]), name='classes')
+    return [boxes, scores, classes, num]
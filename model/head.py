@@ -11,7 +11,7 @@ import paddle.fluid as fluid
 from paddle.fluid.param_attr import ParamAttr
 from paddle.fluid.regularizer import L2Decay
 
-from model.custom_layers import DropBlock
+from model.custom_layers import DropBlock, spp_max_pools
 
 
 class YOLOv3Head(object):
@@ -409,27 +409,7 @@ class YOLACTHead(object):
 
     def _spp(self, x):
         x_1 = x
-        x_2 = fluid.layers.pool2d(
-            input=x,
-            pool_size=5,
-            pool_type='max',
-            pool_stride=1,
-            pool_padding=2,
-            ceil_mode=True)
-        x_3 = fluid.layers.pool2d(
-            input=x,
-            pool_size=9,
-            pool_type='max',
-            pool_stride=1,
-            pool_padding=4,
-            ceil_mode=True)
-        x_4 = fluid.layers.pool2d(
-            input=x,
-            pool_size=13,
-            pool_type='max',
-            pool_stride=1,
-            pool_padding=6,
-            ceil_mode=True)
+        x_2, x_3, x_4 = spp_max_pools(x)
         out = fluid.layers.concat(input=[x_1, x_2, x_3, x_4], axis=1)
         return out
 
@@ -13,6 +13,7 @@ from paddle.fluid.param_attr import ParamAttr
 from paddle.fluid.regularizer import L2Decay
 import numpy as np
 
+from model.custom_layers import spp_max_pools
 from model.fastnms import fastnms
 
 
@@ -21,11 +22,38 @@ def _softplus(input):
     return fluid.layers.log(1 + expf)
 
 
+# Mish的实现。'default'是训练用的clip、exp、+1、log、tanh、乘，6个op；
+# 'softplus'用官方softplus()（内部是数值稳定的max(x, 0) + log(exp(-max(x, 0)) + exp(x - max(x, 0)))），只有softplus、tanh、乘3个op，
+# 结果与'default'一致（只差float32的舍入误差）；'fused'用官方的mish op（一个op），需要paddle版本支持。
+# 导出推理模型时用set_mish_impl()选择，权重不受影响。
+MISH_IMPLS = ['default', 'softplus', 'fused']
+_mish_impl = 'default'
+
+
+def set_mish_impl(impl):
+    global _mish_impl
+    if impl not in MISH_IMPLS:
+        raise ValueError('Unknown mish implementation {}, expect one of {}.'.format(impl, MISH_IMPLS))
+    if impl == 'fused' and not hasattr(fluid.layers, 'mish'):
+        raise ValueError('This paddle version has no mish op, use \'softplus\' instead.')
+    _mish_impl = impl
+
+
 def _mish(input):
+    if _mish_impl == 'fused':
+        return fluid.layers.mish(input)
+    if _mish_impl == 'softplus':
+        return input * fluid.layers.tanh(fluid.layers.softplus(input))
     return input * fluid.layers.tanh(_softplus(input))
 
 
-def conv2d_unit(x, filters, kernels, stride=1, padding=0, bn=1, act='mish', name='', is_test=False, trainable=True):
+def conv2d_unit(x, filters, kernels, stride=1, padding=0, bn=1, act='mish', name='', is_test=False, trainable=True,
+                channels=None):
+    '''
+    :param channels:  剪枝后每个卷积的输出通道数{name: filters}（见tools/prune.py），有这个卷积时覆盖filters
+    '''
+    if channels:
+        filters = channels.get(name, filters)
     use_bias = (bn != 1)
     bias_attr = False
     if use_bias:
@@ -67,43 +95,66 @@ def conv2d_unit(x, filters, kernels, stride=1, padding=0, bn=1, act='mish', name
     return x
 
 
-def residual_block(inputs, filters_1, filters_2, conv_start_idx, is_test, trainable):
-    x = conv2d_unit(inputs, filters_1, 1, stride=1, padding=0, name='conv%.3d' % conv_start_idx, is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, filters_2, 3, stride=1, padding=1, name='conv%.3d' % (conv_start_idx + 1), is_test=is_test, trainable=trainable)
+def repeat_name(conv_start_idx, n_orig, convs_per_repeat, i, j, offset=0):
+    '''
+    第i次重复里第j个卷积的名字。前n_orig次（原版的重复次数）用原版的编号，能读原版权重；
+    depth_mult > 1 多出来的重复用'conv起始编号_x次数_j'，不会与后面固定编号的卷积重名
+    '''
+    if i < n_orig:
+        return 'conv%.3d' % (conv_start_idx + offset + convs_per_repeat * i + j)
+    return 'conv%.3d_x%d_%d' % (conv_start_idx, i - n_orig, j)
+
+
+def residual_block(inputs, filters_1, filters_2, names, is_test, trainable, channels=None):
+    x = conv2d_unit(inputs, filters_1, 1, stride=1, padding=0, name=names[0], is_test=is_test, trainable=trainable,
+                    channels=channels)
+    x = conv2d_unit(x, filters_2, 3, stride=1, padding=1, name=names[1], is_test=is_test, trainable=trainable,
+                    channels=channels)
     x = fluid.layers.elementwise_add(x=inputs, y=x, act=None)
     return x
 
 
-def stack_residual_block(inputs, filters_1, filters_2, n, conv_start_idx, is_test, trainable):
-    x = residual_block(inputs, filters_1, filters_2, conv_start_idx, is_test, trainable)
-    for i in range(n - 1):
-        x = residual_block(x, filters_1, filters_2, conv_start_idx + 2 * (1 + i), is_test, trainable)
+def stack_residual_block(inputs, filters_1, filters_2, n, conv_start_idx, is_test, trainable, n_orig=None, channels=None):
+    '''
+    n组残差块。n_orig是原版的重复次数，不传时等于n
+    '''
+    n_orig = n if n_orig is None else n_orig
+    x = inputs
+    for i in range(n):
+        names = [repeat_name(conv_start_idx, n_orig, 2, i, j) for j in range(2)]
+        x = residual_block(x, filters_1, filters_2, names, is_test, trainable, channels)
+    return x
+
+
+def neck_block(inputs, filters, n, conv_start_idx, is_test, trainable, n_orig=2, channels=None):
+    '''
+    fpn、pan里的 1x1卷积 + n组（3x3卷积 + 1x1卷积）。原版YOLOv4 n=2
+    '''
+    x = conv2d_unit(inputs, filters, 1, stride=1, act='leaky', name='conv%.3d' % conv_start_idx, is_test=is_test, trainable=trainable,
+                    channels=channels)
+    for i in range(n):
+        x = conv2d_unit(x, filters * 2, 3, stride=1, padding=1, act='leaky',
+                        name=repeat_name(conv_start_idx, n_orig, 2, i, 0, offset=1), is_test=is_test, trainable=trainable,
+                        channels=channels)
+        x = conv2d_unit(x, filters, 1, stride=1, act='leaky',
+                        name=repeat_name(conv_start_idx, n_orig, 2, i, 1, offset=1), is_test=is_test, trainable=trainable,
+                        channels=channels)
     return x
 
 
+def scale_width(filters, width_mult, divisor=8):
+    # 通道数乘上width_mult，取divisor的倍数
+    return max(int(np.ceil(filters * width_mult / divisor) * divisor), divisor)
+
+
+def scale_depth(n, depth_mult):
+    # 重复次数乘上depth_mult，至少1次
+    return max(int(round(n * depth_mult)), 1)
+
+
 def _spp(x):
     x_1 = x
-    x_2 = fluid.layers.pool2d(
-        input=x,
-        pool_size=5,
-        pool_type='max',
-        pool_stride=1,
-        pool_padding=2,
-        ceil_mode=True)
-    x_3 = fluid.layers.pool2d(
-        input=x,
-        pool_size=9,
-        pool_type='max',
-        pool_stride=1,
-        pool_padding=4,
-        ceil_mode=True)
-    x_4 = fluid.layers.pool2d(
-        input=x,
-        pool_size=13,
-        pool_type='max',
-        pool_stride=1,
-        pool_padding=6,
-        ceil_mode=True)
+    x_2, x_3, x_4 = spp_max_pools(x)
     out = fluid.layers.concat(input=[x_4, x_3, x_2, x_1], axis=1)
     return out
 
@@ -218,10 +269,10 @@ def yolo_decode(output_l, output_m, output_s, postprocess=None, param=None):
                                        all_pred_boxes[:, :, 2:] - all_pred_boxes[:, :, :2]], axis=-1)
         # 官方的multiclass_nms()也更快一点。但是为了之后的深度定制。
         # 用fastnms
-        boxes, scores, classes = fastnms(all_pred_boxes, all_pred_scores, resize_shape, origin_shape, conf_thresh,
-                                         nms_thresh, keep_top_k, nms_top_k, use_yolo_box)
-        return boxes, scores, classes
-    elif 'multiclass_nms':
+        # 返回boxes, scores, classes, num（每张图片的有效框个数）
+        return fastnms(all_pred_boxes, all_pred_scores, resize_shape, origin_shape, conf_thresh,
+                       nms_thresh, keep_top_k, nms_top_k, use_yolo_box)
+    elif postprocess == 'multiclass_nms':
         origin_shape = param['origin_shape']
         anchors = param['anchors']
         conf_thresh = param['conf_thresh']
@@ -277,11 +328,34 @@ def yolo_decode(output_l, output_m, output_s, postprocess=None, param=None):
                                            nms_threshold=nms_thresh,
                                            background_label=-1)  # 对于YOLO算法，一定要设置background_label=-1，否则检测不出人。
         return pred
+    else:
+        # numpy_nms、numpy_fastnms、numpy_matrixnms：不在图里后处理，直接输出3个输出层，由deploy_infer.py用numpy后处理
+        output_l = fluid.layers.transpose(output_l, perm=[0, 2, 3, 1], name='output_l')
+        output_m = fluid.layers.transpose(output_m, perm=[0, 2, 3, 1], name='output_m')
+        output_s = fluid.layers.transpose(output_s, perm=[0, 2, 3, 1], name='output_s')
+        return output_l, output_m, output_s
 
 
 def YOLOv4(inputs, num_classes, num_anchors, initial_filters=32, is_test=False, trainable=True,
-           export=False, postprocess=None, param=None):
-    i32 = initial_filters
+           export=False, postprocess=None, param=None, width_mult=1.0, depth_mult=1.0, tiny=False, channels=None):
+    '''
+    :param width_mult:  所有卷积的通道数乘上width_mult（取8的倍数）
+    :param depth_mult:  cspdarknet53每个stage的残差块个数、fpn和pan里（3x3卷积 + 1x1卷积）的组数乘上depth_mult（至少1）。
+                        width_mult = depth_mult = 1.0时就是原版YOLOv4，参数名也不变，可以读取原来的模型
+                        depth_mult > 1多出来的重复块命名为'conv起始编号_x次数_j'（见repeat_name()），不与固定编号的卷积重名
+    :param tiny:        用YOLOv4_tiny_3l()，depth_mult不起作用
+    :param channels:    剪枝后的模型每个卷积的输出通道数{name: filters}，覆盖上面算出来的通道数（tools/prune.py的load_channels()）
+    '''
+    if tiny:
+        return YOLOv4_tiny_3l(inputs, num_classes, num_anchors, initial_filters, is_test, trainable,
+                              export, postprocess, param, width_mult, channels)
+    return _csp_yolov4(inputs, num_classes, num_anchors, initial_filters, is_test, trainable,
+                       export, postprocess, param, width_mult, depth_mult, channels)
+
+
+def _csp_yolov4(inputs, num_classes, num_anchors, initial_filters, is_test, trainable,
+                export, postprocess, param, width_mult, depth_mult, channels=None):
+    i32 = scale_width(initial_filters, width_mult)
     i64 = i32 * 2
     i128 = i32 * 4
     i256 = i32 * 8
@@ -289,120 +363,118 @@ def YOLOv4(inputs, num_classes, num_anchors, initial_filters=32, is_test=False,
     i1024 = i32 * 32
 
     # cspdarknet53部分
-    x = conv2d_unit(inputs, i32, 3, stride=1, padding=1, name='conv001', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(inputs, i32, 3, stride=1, padding=1, name='conv001', is_test=is_test, trainable=trainable, channels=channels)
 
     # ============================= s2 =============================
-    x = conv2d_unit(x, i64, 3, stride=2, padding=1, name='conv002', is_test=is_test, trainable=trainable)
-    s2 = conv2d_unit(x, i64, 1, stride=1, name='conv003', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i64, 1, stride=1, name='conv004', is_test=is_test, trainable=trainable)
-    x = stack_residual_block(x, i32, i64, n=1, conv_start_idx=5, is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i64, 1, stride=1, name='conv007', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(x, i64, 3, stride=2, padding=1, name='conv002', is_test=is_test, trainable=trainable, channels=channels)
+    s2 = conv2d_unit(x, i64, 1, stride=1, name='conv003', is_test=is_test, trainable=trainable, channels=channels)
+    x = conv2d_unit(x, i64, 1, stride=1, name='conv004', is_test=is_test, trainable=trainable, channels=channels)
+    x = stack_residual_block(x, i32, i64, n=scale_depth(1, depth_mult), conv_start_idx=5, is_test=is_test, trainable=trainable,
+                             n_orig=1, channels=channels)
+    x = conv2d_unit(x, i64, 1, stride=1, name='conv007', is_test=is_test, trainable=trainable, channels=channels)
     x = fluid.layers.concat([x, s2], axis=1)
-    s2 = conv2d_unit(x, i64, 1, stride=1, name='conv008', is_test=is_test, trainable=trainable)
+    s2 = conv2d_unit(x, i64, 1, stride=1, name='conv008', is_test=is_test, trainable=trainable, channels=channels)
 
     # ============================= s4 =============================
-    x = conv2d_unit(s2, i128, 3, stride=2, padding=1, name='conv009', is_test=is_test, trainable=trainable)
-    s4 = conv2d_unit(x, i64, 1, stride=1, name='conv010', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i64, 1, stride=1, name='conv011', is_test=is_test, trainable=trainable)
-    x = stack_residual_block(x, i64, i64, n=2, conv_start_idx=12, is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i64, 1, stride=1, name='conv016', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(s2, i128, 3, stride=2, padding=1, name='conv009', is_test=is_test, trainable=trainable, channels=channels)
+    s4 = conv2d_unit(x, i64, 1, stride=1, name='conv010', is_test=is_test, trainable=trainable, channels=channels)
+    x = conv2d_unit(x, i64, 1, stride=1, name='conv011', is_test=is_test, trainable=trainable, channels=channels)
+    x = stack_residual_block(x, i64, i64, n=scale_depth(2, depth_mult), conv_start_idx=12, is_test=is_test, trainable=trainable,
+                             n_orig=2, channels=channels)
+    x = conv2d_unit(x, i64, 1, stride=1, name='conv016', is_test=is_test, trainable=trainable, channels=channels)
     x = fluid.layers.concat([x, s4], axis=1)
-    s4 = conv2d_unit(x, i128, 1, stride=1, name='conv017', is_test=is_test, trainable=trainable)
+    s4 = conv2d_unit(x, i128, 1, stride=1, name='conv017', is_test=is_test, trainable=trainable, channels=channels)
 
     # ============================= s8 =============================
-    x = conv2d_unit(s4, i256, 3, stride=2, padding=1, name='conv018', is_test=is_test, trainable=trainable)
-    s8 = conv2d_unit(x, i128, 1, stride=1, name='conv019', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i128, 1, stride=1, name='conv020', is_test=is_test, trainable=trainable)
-    x = stack_residual_block(x, i128, i128, n=8, conv_start_idx=21, is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i128, 1, stride=1, name='conv037', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(s4, i256, 3, stride=2, padding=1, name='conv018', is_test=is_test, trainable=trainable, channels=channels)
+    s8 = conv2d_unit(x, i128, 1, stride=1, name='conv019', is_test=is_test, trainable=trainable, channels=channels)
+    x = conv2d_unit(x, i128, 1, stride=1, name='conv020', is_test=is_test, trainable=trainable, channels=channels)
+    x = stack_residual_block(x, i128, i128, n=scale_depth(8, depth_mult), conv_start_idx=21, is_test=is_test, trainable=trainable,
+                             n_orig=8, channels=channels)
+    x = conv2d_unit(x, i128, 1, stride=1, name='conv037', is_test=is_test, trainable=trainable, channels=channels)
     x = fluid.layers.concat([x, s8], axis=1)
-    s8 = conv2d_unit(x, i256, 1, stride=1, name='conv038', is_test=is_test, trainable=trainable)
+    s8 = conv2d_unit(x, i256, 1, stride=1, name='conv038', is_test=is_test, trainable=trainable, channels=channels)
 
     # ============================= s16 =============================
-    x = conv2d_unit(s8, i512, 3, stride=2, padding=1, name='conv039', is_test=is_test, trainable=trainable)
-    s16 = conv2d_unit(x, i256, 1, stride=1, name='conv040', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i256, 1, stride=1, name='conv041', is_test=is_test, trainable=trainable)
-    x = stack_residual_block(x, i256, i256, n=8, conv_start_idx=42, is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i256, 1, stride=1, name='conv058', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(s8, i512, 3, stride=2, padding=1, name='conv039', is_test=is_test, trainable=trainable, channels=channels)
+    s16 = conv2d_unit(x, i256, 1, stride=1, name='conv040', is_test=is_test, trainable=trainable, channels=channels)
+    x = conv2d_unit(x, i256, 1, stride=1, name='conv041', is_test=is_test, trainable=trainable, channels=channels)
+    x = stack_residual_block(x, i256, i256, n=scale_depth(8, depth_mult), conv_start_idx=42, is_test=is_test, trainable=trainable,
+                             n_orig=8, channels=channels)
+    x = conv2d_unit(x, i256, 1, stride=1, name='conv058', is_test=is_test, trainable=trainable, channels=channels)
     x = fluid.layers.concat([x, s16], axis=1)
-    s16 = conv2d_unit(x, i512, 1, stride=1, name='conv059', is_test=is_test, trainable=trainable)
+    s16 = conv2d_unit(x, i512, 1, stride=1, name='conv059', is_test=is_test, trainable=trainable, channels=channels)
 
     # ============================= s32 =============================
-    x = conv2d_unit(s16, i1024, 3, stride=2, padding=1, name='conv060', is_test=is_test, trainable=trainable)
-    s32 = conv2d_unit(x, i512, 1, stride=1, name='conv061', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i512, 1, stride=1, name='conv062', is_test=is_test, trainable=trainable)
-    x = stack_residual_block(x, i512, i512, n=4, conv_start_idx=63, is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i512, 1, stride=1, name='conv071', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(s16, i1024, 3, stride=2, padding=1, name='conv060', is_test=is_test, trainable=trainable, channels=channels)
+    s32 = conv2d_unit(x, i512, 1, stride=1, name='conv061', is_test=is_test, trainable=trainable, channels=channels)
+    x = conv2d_unit(x, i512, 1, stride=1, name='conv062', is_test=is_test, trainable=trainable, channels=channels)
+    x = stack_residual_block(x, i512, i512, n=scale_depth(4, depth_mult), conv_start_idx=63, is_test=is_test, trainable=trainable,
+                             n_orig=4, channels=channels)
+    x = conv2d_unit(x, i512, 1, stride=1, name='conv071', is_test=is_test, trainable=trainable, channels=channels)
     x = fluid.layers.concat([x, s32], axis=1)
-    s32 = conv2d_unit(x, i1024, 1, stride=1, name='conv072', is_test=is_test, trainable=trainable)
+    s32 = conv2d_unit(x, i1024, 1, stride=1, name='conv072', is_test=is_test, trainable=trainable, channels=channels)
     # cspdarknet53部分结束
 
     # fpn部分
-    x = conv2d_unit(s32, i512, 1, stride=1, act='leaky', name='conv073', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i1024, 3, stride=1, padding=1, act='leaky', name='conv074', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i512, 1, stride=1, act='leaky', name='conv075', is_test=is_test, trainable=trainable)
+    n_neck = scale_depth(2, depth_mult)
+    x = conv2d_unit(s32, i512, 1, stride=1, act='leaky', name='conv073', is_test=is_test, trainable=trainable, channels=channels)
+    x = conv2d_unit(x, i1024, 3, stride=1, padding=1, act='leaky', name='conv074', is_test=is_test, trainable=trainable,
+                    channels=channels)
+    x = conv2d_unit(x, i512, 1, stride=1, act='leaky', name='conv075', is_test=is_test, trainable=trainable, channels=channels)
     x = _spp(x)
 
-    x = conv2d_unit(x, i512, 1, stride=1, act='leaky', name='conv076', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i1024, 3, stride=1, padding=1, act='leaky', name='conv077', is_test=is_test, trainable=trainable)
-    fpn_s32 = conv2d_unit(x, i512, 1, stride=1, act='leaky', name='conv078', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(x, i512, 1, stride=1, act='leaky', name='conv076', is_test=is_test, trainable=trainable, channels=channels)
+    x = conv2d_unit(x, i1024, 3, stride=1, padding=1, act='leaky', name='conv077', is_test=is_test, trainable=trainable,
+                    channels=channels)
+    fpn_s32 = conv2d_unit(x, i512, 1, stride=1, act='leaky', name='conv078', is_test=is_test, trainable=trainable, channels=channels)
 
     # pan01
-    x = conv2d_unit(fpn_s32, i256, 1, stride=1, act='leaky', name='conv079', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(fpn_s32, i256, 1, stride=1, act='leaky', name='conv079', is_test=is_test, trainable=trainable, channels=channels)
     x = fluid.layers.resize_nearest(x, scale=float(2))
-    s16 = conv2d_unit(s16, i256, 1, stride=1, act='leaky', name='conv080', is_test=is_test, trainable=trainable)
+    s16 = conv2d_unit(s16, i256, 1, stride=1, act='leaky', name='conv080', is_test=is_test, trainable=trainable, channels=channels)
     x = fluid.layers.concat([s16, x], axis=1)
-    x = conv2d_unit(x, i256, 1, stride=1, act='leaky', name='conv081', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i512, 3, stride=1, padding=1, act='leaky', name='conv082', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i256, 1, stride=1, act='leaky', name='conv083', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i512, 3, stride=1, padding=1, act='leaky', name='conv084', is_test=is_test, trainable=trainable)
-    fpn_s16 = conv2d_unit(x, i256, 1, stride=1, act='leaky', name='conv085', is_test=is_test, trainable=trainable)
+    fpn_s16 = neck_block(x, i256, n_neck, 81, is_test, trainable, channels=channels)
     # pan01结束
 
     # pan02
-    x = conv2d_unit(fpn_s16, i128, 1, stride=1, act='leaky', name='conv086', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(fpn_s16, i128, 1, stride=1, act='leaky', name='conv086', is_test=is_test, trainable=trainable, channels=channels)
     x = fluid.layers.resize_nearest(x, scale=float(2))
-    s8 = conv2d_unit(s8, i128, 1, stride=1, act='leaky', name='conv087', is_test=is_test, trainable=trainable)
+    s8 = conv2d_unit(s8, i128, 1, stride=1, act='leaky', name='conv087', is_test=is_test, trainable=trainable, channels=channels)
     x = fluid.layers.concat([s8, x], axis=1)
-    x = conv2d_unit(x, i128, 1, stride=1, act='leaky', name='conv088', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i256, 3, stride=1, padding=1, act='leaky', name='conv089', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i128, 1, stride=1, act='leaky', name='conv090', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i256, 3, stride=1, padding=1, act='leaky', name='conv091', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i128, 1, stride=1, act='leaky', name='conv092', is_test=is_test, trainable=trainable)
+    x = neck_block(x, i128, n_neck, 88, is_test, trainable, channels=channels)
     # pan02结束
 
     # output_s, 不用concat()
     output_s = conv2d_unit(x, i256, 3, stride=1, padding=1, act='leaky', name='conv093', is_test=is_test,
-                           trainable=trainable)
+                           trainable=trainable, channels=channels)
     output_s = conv2d_unit(output_s, num_anchors * (num_classes + 5), 1, stride=1, bn=0, act=None, name='conv094',
-                           is_test=is_test, trainable=trainable)
+                           is_test=is_test, trainable=trainable, channels=channels)
 
     # output_m, 需要concat()
-    x = conv2d_unit(x, i256, 3, stride=2, padding=1, act='leaky', name='conv095', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(x, i256, 3, stride=2, padding=1, act='leaky', name='conv095', is_test=is_test, trainable=trainable,
+                    channels=channels)
     x = fluid.layers.concat([x, fpn_s16], axis=1)
-    x = conv2d_unit(x, i256, 1, stride=1, act='leaky', name='conv096', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i512, 3, stride=1, padding=1, act='leaky', name='conv097', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i256, 1, stride=1, act='leaky', name='conv098', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i512, 3, stride=1, padding=1, act='leaky', name='conv099', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i256, 1, stride=1, act='leaky', name='conv100', is_test=is_test, trainable=trainable)
+    x = neck_block(x, i256, n_neck, 96, is_test, trainable, channels=channels)
     output_m = conv2d_unit(x, i512, 3, stride=1, padding=1, act='leaky', name='conv101', is_test=is_test,
-                           trainable=trainable)
+                           trainable=trainable, channels=channels)
     output_m = conv2d_unit(output_m, num_anchors * (num_classes + 5), 1, stride=1, bn=0, act=None, name='conv102',
-                           is_test=is_test, trainable=trainable)
+                           is_test=is_test, trainable=trainable, channels=channels)
 
     # output_l, 需要concat()
-    x = conv2d_unit(x, i512, 3, stride=2, padding=1, act='leaky', name='conv103', is_test=is_test, trainable=trainable)
+    x = conv2d_unit(x, i512, 3, stride=2, padding=1, act='leaky', name='conv103', is_test=is_test, trainable=trainable,
+                    channels=channels)
     x = fluid.layers.concat([x, fpn_s32], axis=1)
-    x = conv2d_unit(x, i512, 1, stride=1, act='leaky', name='conv104', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i1024, 3, stride=1, padding=1, act='leaky', name='conv105', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i512, 1, stride=1, act='leaky', name='conv106', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i1024, 3, stride=1, padding=1, act='leaky', name='conv107', is_test=is_test, trainable=trainable)
-    x = conv2d_unit(x, i512, 1, stride=1, act='leaky', name='conv108', is_test=is_test, trainable=trainable)
+    x = neck_block(x, i512, n_neck, 104, is_test, trainable, channels=channels)
     output_l = conv2d_unit(x, i1024, 3, stride=1, padding=1, act='leaky', name='conv109', is_test=is_test,
-                           trainable=trainable)
+                           trainable=trainable, channels=channels)
     output_l = conv2d_unit(output_l, num_anchors * (num_classes + 5), 1, stride=1, bn=0, act=None, name='conv110',
-                           is_test=is_test, trainable=trainable)
+                           is_test=is_test, trainable=trainable, channels=channels)
 
+    return _yolo_outputs(output_l, output_m, output_s, export, postprocess, param)
+
+
+def _yolo_outputs(output_l, output_m, output_s, export, postprocess, param):
     if export:
         return yolo_decode(output_l, output_m, output_s, postprocess, param)
 
@@ -413,4 +485,78 @@ def YOLOv4(inputs, num_classes, num_anchors, initial_filters=32, is_test=False,
     return output_l, output_m, output_s
 
 
+def _csp_tiny_block(x, filters, conv_start_idx, is_test, trainable, channels=None):
+    '''
+    cspdarknet53-tiny的一个stage：3x3卷积，取后一半通道过两个3x3卷积，拼接后1x1卷积，再与3x3卷积的输出拼接。
+    :return:  (2x2最大池化之后的输出, 池化之前的1x1卷积输出（给fpn用）)
+    '''
+    x = conv2d_unit(x, filters, 3, stride=1, padding=1, act='leaky', name='conv%.3d' % conv_start_idx, is_test=is_test, trainable=trainable,
+                    channels=channels)
+    route = x
+    x = fluid.layers.split(x, 2, dim=1)[1]
+    x = conv2d_unit(x, filters // 2, 3, stride=1, padding=1, act='leaky', name='conv%.3d' % (conv_start_idx + 1), is_test=is_test, trainable=trainable,
+                    channels=channels)
+    route_1 = x
+    x = conv2d_unit(x, filters // 2, 3, stride=1, padding=1, act='leaky', name='conv%.3d' % (conv_start_idx + 2), is_test=is_test, trainable=trainable,
+                    channels=channels)
+    x = fluid.layers.concat([x, route_1], axis=1)
+    feat = conv2d_unit(x, filters, 1, stride=1, act='leaky', name='conv%.3d' % (conv_start_idx + 3), is_test=is_test, trainable=trainable,
+                       channels=channels)
+    x = fluid.layers.concat([route, feat], axis=1)
+    x = fluid.layers.pool2d(input=x, pool_size=2, pool_type='max', pool_stride=2)
+    return x, feat
+
+
+def YOLOv4_tiny_3l(inputs, num_classes, num_anchors, initial_filters=32, is_test=False, trainable=True,
+                   export=False, postprocess=None, param=None, width_mult=1.0, channels=None):
+    '''
+    YOLOv4-tiny（cspdarknet53-tiny + 只有一次上采样的fpn，全部是leaky），加上stride=8的第3个输出层（tiny-3l），
+    这样输出、先验框、标签、损失、后处理都和YOLOv4一样，训练、验证、导出的脚本不用改。
+    '''
+    i32 = scale_width(initial_filters, width_mult)
+    i64 = i32 * 2
+    i128 = i32 * 4
+    i256 = i32 * 8
+    i512 = i32 * 16
+
+    # cspdarknet53-tiny部分
+    x = conv2d_unit(inputs, i32, 3, stride=2, padding=1, act='leaky', name='conv001', is_test=is_test, trainable=trainable,
+                    channels=channels)
+    x = conv2d_unit(x, i64, 3, stride=2, padding=1, act='leaky', name='conv002', is_test=is_test, trainable=trainable,
+                    channels=channels)
+    x, _ = _csp_tiny_block(x, i64, 3, is_test, trainable, channels=channels)
+    x, s8 = _csp_tiny_block(x, i128, 7, is_test, trainable, channels=channels)
+    x, s16 = _csp_tiny_block(x, i256, 11, is_test, trainable, channels=channels)
+    x = conv2d_unit(x, i512, 3, stride=1, padding=1, act='leaky', name='conv015', is_test=is_test, trainable=trainable,
+                    channels=channels)
+    # cspdarknet53-tiny部分结束
+
+    # output_l
+    fpn_s32 = conv2d_unit(x, i256, 1, stride=1, act='leaky', name='conv016', is_test=is_test, trainable=trainable, channels=channels)
+    output_l = conv2d_unit(fpn_s32, i512, 3, stride=1, padding=1, act='leaky', name='conv017', is_test=is_test,
+                           trainable=trainable, channels=channels)
+    output_l = conv2d_unit(output_l, num_anchors * (num_classes + 5), 1, stride=1, bn=0, act=None, name='conv018',
+                           is_test=is_test, trainable=trainable, channels=channels)
+
+    # output_m
+    x = conv2d_unit(fpn_s32, i128, 1, stride=1, act='leaky', name='conv019', is_test=is_test, trainable=trainable, channels=channels)
+    x = fluid.layers.resize_nearest(x, scale=float(2))
+    x = fluid.layers.concat([x, s16], axis=1)
+    fpn_s16 = conv2d_unit(x, i256, 3, stride=1, padding=1, act='leaky', name='conv020', is_test=is_test,
+                          trainable=trainable, channels=channels)
+    output_m = conv2d_unit(fpn_s16, num_anchors * (num_classes + 5), 1, stride=1, bn=0, act=None, name='conv021',
+                           is_test=is_test, trainable=trainable, channels=channels)
+
+    # output_s
+    x = conv2d_unit(fpn_s16, i64, 1, stride=1, act='leaky', name='conv022', is_test=is_test, trainable=trainable, channels=channels)
+    x = fluid.layers.resize_nearest(x, scale=float(2))
+    x = fluid.layers.concat([x, s8], axis=1)
+    output_s = conv2d_unit(x, i128, 3, stride=1, padding=1, act='leaky', name='conv023', is_test=is_test,
+                           trainable=trainable, channels=channels)
+    output_s = conv2d_unit(output_s, num_anchors * (num_classes + 5), 1, stride=1, bn=0, act=None, name='conv024',
+                           is_test=is_test, trainable=trainable, channels=channels)
+
+    return _yolo_outputs(output_l, output_m, output_s, export, postprocess, param)
+
+
 
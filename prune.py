@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-09-07 10:15:33
+#   Description : 通道剪枝。敏感度分析之后按目标FLOPs剪掉YOLOv4卷积的通道，保存成train.py能微调、export_model.py能导出的模型
+#
+# ================================================================
+import os
+import copy
+import json
+import time
+import argparse
+import numpy as np
+import paddle.fluid as fluid
+import paddle.fluid.layers as P
+
+from config import *
+from model.yolov4 import YOLOv4
+from model.decode_np import Decode
+from tools.cocotools import get_classes, clsid2catid, load_coco_gt, bbox_eval, collect_detections
+from tools.prune import ChannelGraph, load_channels, save_channels, ratios_by_flops
+
+import logging
+FORMAT = '%(asctime)s-%(levelname)s: %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+
+use_gpu = False
+use_gpu = True
+
+
+def build_eval_prog(cfg, num_classes, num_anchors, channels):
+    startup_prog = fluid.Program()
+    eval_prog = fluid.Program()
+    with fluid.program_guard(eval_prog, startup_prog):
+        with fluid.unique_name.guard():
+            inputs = P.data(name='input_1', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
+            output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True,
+                                                  width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                                  channels=channels)
+            eval_fetch_list = [output_l, output_m, output_s]
+    return eval_prog.clone(for_test=True), startup_prog, eval_fetch_list
+
+
+def evaluate(_decode, eval_fetch_list, images, cfg, _clsid2catid):
+    '''
+    :return:  (AP, 每秒图片数)。包括读图、预处理、后处理，是端到端的速度
+    '''
+    t0 = time.time()
+    dets = collect_detections(_decode, eval_fetch_list, images, cfg.val_pre_path, cfg.eval_batch_size, _clsid2catid,
+                              False)
+    speed = len(images) / (time.time() - t0)
+    if len(dets) == 0:
+        return 0.0, speed
+    stats = bbox_eval(cfg.val_path, dets, fast_eval=cfg.fast_eval, img_ids=[im['id'] for im in images])
+    return stats[0], speed
+
+
+def conv_out_hw(exe, eval_prog, graph, input_shape):
+    # 每个卷积输出的(h, w)，用于计算FLOPs
+    names = graph.order
+    outs = exe.run(eval_prog, feed={'input_1': np.zeros((1, 3) + tuple(input_shape), np.float32)},
+                   fetch_list=[graph.convs[name]['out'] for name in names])
+    return {name: out.shape[2:] for name, out in zip(names, outs)}
+
+
+def sensitivity_analysis(graph, scores, scope, place, ratios, base_ap, evaluate_fn, path):
+    '''
+    逐个unit剪掉ratios里的比例（把被剪通道的BN的scale、offset置0，不用改网络），验证子集上的AP相对下降就是这个unit的敏感度。
+    每算完一个unit就写一次path，中断后重新运行会接着算。
+    :return:  {unit: {剪枝比例: 精度损失}}
+    '''
+    sensitivities = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            sensitivities = {u: {float(r): l for r, l in s.items()} for u, s in json.load(f).items()}
+    for k, unit in enumerate(sorted(graph.units.keys(), key=graph.order.index)):
+        s = sensitivities.setdefault(unit, {})
+        for ratio in ratios:
+            if ratio in s:
+                continue
+            backup = graph.mask(scope, place, graph.prune_classes(unit, ratio, scores))
+            ap, _ = evaluate_fn()
+            graph.restore(scope, place, backup)
+            s[ratio] = (base_ap - ap) / max(base_ap, 1e-9)
+            logger.info('[{}/{}] {} ({} convs, {} channels) ratio {:.2f}: AP {:.4f}, loss {:.4f}'.format(
+                k + 1, len(graph.units), unit, len(graph.units[unit]['convs']), len(graph.units[unit]['classes']),
+                ratio, ap, s[ratio]))
+        with open(path, 'w') as f:
+            json.dump(sensitivities, f, indent=2, sort_keys=True)
+    return {unit: sensitivities[unit] for unit in graph.units}
+
+
+def count_params(prog):
+    return sum([int(np.prod(p.shape)) for p in prog.all_parameters()])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Channel pruning for YOLOv4.')
+    parser.add_argument('--pruned_flops', type=float, default=0.3, help='剪掉的FLOPs占比')
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7],
+                        help='敏感度分析时每个unit试剪的比例')
+    parser.add_argument('--num_images', type=int, default=200, help='敏感度分析、对比用的验证集图片数')
+    parser.add_argument('--align', type=int, default=8, help='每个unit保留的通道数取这个数的倍数')
+    parser.add_argument('--sensitivities', type=str, default='yolov4_sensitivities.json',
+                        help='敏感度分析结果的缓存。换了模型、图片数时要删掉')
+    parser.add_argument('--save_dir', type=str, default='pruned_yolov4',
+                        help='剪枝后的权重（与yolov4一样是save_persistables()的目录），通道数保存在<save_dir>.channels.json')
+    args = parser.parse_args()
+
+    # 选择配置。只支持YOLOv4（tiny里被split的通道不剪）
+    cfg = YOLOv4_Config_1()
+    # cfg = YOLOv4_Tiny_Config_1()
+    if cfg.algorithm != 'YOLOv4':
+        raise ValueError('prune.py only supports YOLOv4.')
+
+    all_classes = get_classes(cfg.classes_path)
+    num_classes = len(all_classes)
+    num_anchors = len(cfg.anchor_masks[0])
+    _clsid2catid = copy.deepcopy(clsid2catid)
+    if num_classes != 80:   # 如果不是COCO数据集，而是自定义数据集
+        _clsid2catid = {}
+        for k in range(num_classes):
+            _clsid2catid[k] = k
+    images = load_coco_gt(cfg.val_path, cfg.eval_cache_dir).dataset['images'][:args.num_images]
+
+    gpu_id = int(os.environ.get('FLAGS_selected_gpus', 0))
+    place = fluid.CUDAPlace(gpu_id) if use_gpu else fluid.CPUPlace()
+    exe = fluid.Executor(place)
+
+    # 剪枝前的模型（也可以是已经剪过的模型，再剪一次）
+    old_channels = load_channels(cfg.prune_channels) or {}
+    scope = fluid.Scope()
+    with fluid.scope_guard(scope):
+        eval_prog, startup_prog, eval_fetch_list = build_eval_prog(cfg, num_classes, num_anchors, old_channels)
+        exe.run(startup_prog)
+        fluid.load(eval_prog, cfg.infer_model_path, executor=exe)
+        _decode = Decode(cfg.algorithm, cfg.anchors, cfg.conf_thresh, cfg.nms_thresh, cfg.input_shape, exe, eval_prog,
+                         all_classes, cfg.pre_nms_class_top_k, cfg.pre_nms_top_k, cfg.max_dets, cfg.interp, cfg.letterbox)
+        _decode.start_post_pool(cfg.post_workers)
+        evaluate_fn = lambda: evaluate(_decode, eval_fetch_list, images, cfg, _clsid2catid)
+
+        graph = ChannelGraph(eval_prog)
+        out_hw = conv_out_hw(exe, eval_prog, graph, cfg.input_shape)
+        scores = graph.scores(scope)
+        base_ap, base_speed = evaluate_fn()
+        logger.info('Base AP {:.4f}'.format(base_ap))
+        sensitivities = sensitivity_analysis(graph, scores, scope, place, args.ratios, base_ap, evaluate_fn,
+                                             args.sensitivities)
+        ratios, removed, _ = ratios_by_flops(graph, sensitivities, scores, out_hw, args.pruned_flops, args.align)
+        kept = graph.kept_channels(removed)
+        for unit in sorted(ratios.keys(), key=graph.order.index):
+            if ratios[unit] > 0:
+                n = len(graph.units[unit]['classes'])
+                logger.info('{:>8s}: {} -> {} channels'.format(unit, n, len(kept[unit])))
+        _decode.close_post_pool()
+
+    # 剪枝后的模型，参数名与原来一样、形状不一样，用新的scope
+    channels = dict(old_channels)
+    channels.update(graph.channels(kept))
+    pruned_scope = fluid.Scope()
+    with fluid.scope_guard(pruned_scope):
+        pruned_prog, pruned_startup, pruned_fetch_list = build_eval_prog(cfg, num_classes, num_anchors, channels)
+        exe.run(pruned_startup)
+        graph.copy_pruned(pruned_prog, scope, pruned_scope, place, kept)
+
+        # 与train.py读取的yolov4一样，保存成save_persistables()的目录
+        fluid.io.save_persistables(exe, args.save_dir, pruned_prog)
+        channels_path = args.save_dir.rstrip('/') + '.channels.json'
+        save_channels(channels_path, channels)
+        logger.info('Pruned model saved to {}, channels saved to {}.'.format(args.save_dir, channels_path))
+
+        _decode = Decode(cfg.algorithm, cfg.anchors, cfg.conf_thresh, cfg.nms_thresh, cfg.input_shape, exe, pruned_prog,
+                         all_classes, cfg.pre_nms_class_top_k, cfg.pre_nms_top_k, cfg.max_dets, cfg.interp, cfg.letterbox)
+        _decode.start_post_pool(cfg.post_workers)
+        pruned_ap, pruned_speed = evaluate(_decode, pruned_fetch_list, images, cfg, _clsid2catid)
+        _decode.close_post_pool()
+
+    # 第一次验证的速度包含了预热，重新测一次剪枝前的速度
+    with fluid.scope_guard(scope):
+        _decode = Decode(cfg.algorithm, cfg.anchors, cfg.conf_thresh, cfg.nms_thresh, cfg.input_shape, exe, eval_prog,
+                         all_classes, cfg.pre_nms_class_top_k, cfg.pre_nms_top_k, cfg.max_dets, cfg.interp, cfg.letterbox)
+        _decode.start_post_pool(cfg.post_workers)
+        _, base_speed = evaluate(_decode, eval_fetch_list, images, cfg, _clsid2catid)
+        _decode.close_post_pool()
+
+    base_flops = graph.flops(out_hw)
+    pruned_flops = graph.flops(out_hw, kept)
+    logger.info('%d images, input_shape %s, batch_size %d' % (len(images), cfg.input_shape, cfg.eval_batch_size))
+    logger.info('%8s %8s %12s %12s %10s' % ('model', 'AP', 'GFLOPs', 'params (M)', 'images/s'))
+    logger.info('%8s %8.4f %12.2f %12.2f %10.2f' % ('base', base_ap, base_flops * 2 / 1e9, count_params(eval_prog) / 1e6,
+                                                     base_speed))
+    logger.info('%8s %8.4f %12.2f %12.2f %10.2f' % ('pruned', pruned_ap, pruned_flops * 2 / 1e9,
+                                                     count_params(pruned_prog) / 1e6, pruned_speed))
+    logger.info('Pruned {:.1%} FLOPs, speedup {:.2f}x. Fine-tune with train.py: set model_path = \'{}\', '
+                'prune_channels = \'{}\'.'.format(1.0 - float(pruned_flops) / base_flops, pruned_speed / base_speed,
+                                                 args.save_dir, channels_path))
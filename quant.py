@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-09-05 14:26:52
+#   Description : 训练后量化（PTQ），把export_model.py导出的模型转换成CPU上的int8模型
+#
+# ================================================================
+import os
+import re
+import copy
+import time
+import shutil
+import argparse
+import numpy as np
+import paddle.fluid as fluid
+from paddle.fluid.framework import IrGraph
+from paddle.fluid.contrib.slim.quantization import PostTrainingQuantization
+try:
+    from paddle.fluid.contrib.slim.quantization import Quant2Int8MkldnnPass
+except ImportError:
+    # 旧一点的paddle里叫这个名字
+    from paddle.fluid.contrib.slim.quantization import Qat2Int8MkldnnPass as Quant2Int8MkldnnPass
+
+from config import *
+from deploy_infer import Config, Detector, create_preprocess_ops, preprocess
+from tools.cocotools import load_coco_gt, bbox_eval, dets_to_array, get_catid_lut, clsid2catid
+
+import logging
+FORMAT = '%(asctime)s-%(levelname)s: %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+
+def load_feed_names(model_dir):
+    exe = fluid.Executor(fluid.CPUPlace())
+    with fluid.scope_guard(fluid.Scope()):
+        _, feed_names, _ = fluid.io.load_inference_model(model_dir, exe, model_filename='__model__',
+                                                         params_filename='__params__')
+    return feed_names
+
+
+def calib_reader(model_dir, image_paths):
+    '''
+    校准数据：与deploy_infer.py完全相同的预处理，按模型的输入顺序给出每张图片的输入（不带批大小那一维）。
+    '''
+    feed_names = load_feed_names(model_dir)
+    config = Config(model_dir)
+    preprocess_ops = create_preprocess_ops(config)
+
+    def reader():
+        for path in image_paths:
+            inputs, _ = preprocess(path, preprocess_ops, config)
+            yield [inputs[name][0] for name in feed_names]
+    return reader
+
+
+def quantize(model_dir, save_dir, image_paths, algo):
+    '''
+    1. PostTrainingQuantization用float32模型跑一遍校准图片，统计conv2d、mul的输入、权重的范围，得到带fake量化op的模型；
+    2. Quant2Int8MkldnnPass把fake量化op转换成MKLDNN的int8 op，保存成deploy_infer.py能直接读的__model__、__params__，
+       infer_cfg.yml里的mode改成mkldnn_int8。
+    '''
+    place = fluid.CPUPlace()
+    exe = fluid.Executor(place)
+    fake_dir = save_dir.rstrip('/') + '_fake_quant'
+    ptq = PostTrainingQuantization(
+        executor=exe,
+        sample_generator=calib_reader(model_dir, image_paths),
+        model_dir=model_dir,
+        model_filename='__model__',
+        params_filename='__params__',
+        batch_size=1,
+        batch_nums=len(image_paths),
+        algo=algo,
+        quantizable_op_type=['conv2d', 'depthwise_conv2d', 'mul'])
+    ptq.quantize()
+    ptq.save_quantized_model(fake_dir, model_filename='__model__', params_filename='__params__')
+    logger.info('Fake quantized model saved to {}.'.format(fake_dir))
+
+    scope = fluid.Scope()
+    with fluid.scope_guard(scope):
+        program, feed_names, fetch_targets = fluid.io.load_inference_model(
+            fake_dir, exe, model_filename='__model__', params_filename='__params__')
+        graph = IrGraph(fluid.core.Graph(program.desc), for_test=True)
+        graph = Quant2Int8MkldnnPass(set(), _scope=scope, _place=place, _core=fluid.core).apply(graph)
+        program = graph.to_program()
+        fluid.io.save_inference_model(save_dir, feed_names, fetch_targets, exe, main_program=program,
+                                      model_filename='__model__', params_filename='__params__')
+    shutil.rmtree(fake_dir)
+
+    with open(os.path.join(model_dir, 'infer_cfg.yml'), 'r', encoding='utf-8') as f:
+        content = f.read()
+    content = re.sub(r'^mode: .*$', 'mode: mkldnn_int8', content, flags=re.M)
+    content = re.sub(r'^use_python_inference: .*$', 'use_python_inference: false', content, flags=re.M)
+    with open(os.path.join(save_dir, 'infer_cfg.yml'), 'w', encoding='utf-8') as f:
+        f.write(content)
+    logger.info('INT8 model saved to {}.'.format(save_dir))
+
+
+def evaluate(model_dir, run_mode, images, pre_path, anno_file, catid_lut, cpu_threads, fast_eval):
+    '''
+    用deploy_infer.Detector（CPU）预测images，返回(mAP的12个指标, 每张图片的平均耗时ms)。
+    '''
+    detector = Detector(model_dir, Config(model_dir), use_gpu=False, run_mode=run_mode, cpu_threads=cpu_threads)
+    # 预热
+    for im in images[:5]:
+        detector.predict_image(pre_path + im['file_name'])
+    dets = []
+    cost = 0.0
+    for im in images:
+        t0 = time.time()
+        results = detector.predict_image(pre_path + im['file_name'])
+        cost += time.time() - t0
+        if len(results['boxes']) > 0:
+            dets.append(dets_to_array(im['id'], results['boxes'], results['scores'], results['classes'], catid_lut))
+    dets = np.concatenate(dets, axis=0) if dets else np.zeros((0, 7), dtype=np.float64)
+    stats = bbox_eval(anno_file, dets, fast_eval=fast_eval, img_ids=[im['id'] for im in images])
+    return stats, cost * 1000.0 / len(images)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Post-training INT8 quantization for CPU (MKLDNN).')
+    parser.add_argument('--model_dir', type=str, default='inference_model', help='export_model.py导出的float32模型')
+    parser.add_argument('--save_dir', type=str, default='inference_model_int8')
+    parser.add_argument('--algo', type=str, default='KL', choices=['KL', 'abs_max', 'min_max'],
+                        help='激活值范围的统计方式')
+    parser.add_argument('--num_calib', type=int, default=100, help='校准用的验证集图片数')
+    parser.add_argument('--num_eval', type=int, default=500, help='对比精度、速度用的验证集图片数（与校准图片不重复）')
+    parser.add_argument('--cpu_threads', type=int, default=1)
+    parser.add_argument('--eval_only', action='store_true', help='不量化，只对比已经保存的int8模型')
+    args = parser.parse_args()
+
+    # 选择配置。只用到验证集的路径
+    cfg = YOLOv4_Config_1()
+    # cfg = YOLOv4_Tiny_Config_1()
+    # cfg = YOLOv3_Config_1()
+
+    anno_file = cfg.val_path
+    pre_path = cfg.val_pre_path
+    images = load_coco_gt(anno_file, cfg.eval_cache_dir).dataset['images']
+    eval_images = images[:args.num_eval]
+    calib_images = images[args.num_eval:args.num_eval + args.num_calib]
+
+    if not args.eval_only:
+        quantize(args.model_dir, args.save_dir, [pre_path + im['file_name'] for im in calib_images], args.algo)
+
+    _clsid2catid = copy.deepcopy(clsid2catid)
+    num_classes = len(Config(args.model_dir).labels)
+    if num_classes != 80:   # 如果不是COCO数据集，而是自定义数据集
+        _clsid2catid = {}
+        for k in range(num_classes):
+            _clsid2catid[k] = k
+    catid_lut = get_catid_lut(_clsid2catid)
+
+    rows = []
+    for name, model_dir, run_mode in [('fp32', args.model_dir, 'fluid'),
+                                      ('fp32 mkldnn', args.model_dir, 'mkldnn'),
+                                      ('int8 mkldnn', args.save_dir, 'mkldnn_int8')]:
+        stats, cost = evaluate(model_dir, run_mode, eval_images, pre_path, anno_file, catid_lut, args.cpu_threads,
+                               cfg.fast_eval)
+        rows.append((name, stats[0], stats[1], cost))
+    logger.info('%d images, %d threads' % (len(eval_images), args.cpu_threads))
+    logger.info('%12s %8s %8s %10s %8s' % ('model', 'AP', 'AP50', 'ms/img', 'speedup'))
+    for name, ap, ap50, cost in rows:
+        logger.info('%12s %8.4f %8.4f %10.2f %7.2fx' % (name, ap, ap50, cost, rows[0][3] / cost))
+    logger.info('AP drop of int8 vs fp32: %.4f' % (rows[0][1] - rows[2][1]))
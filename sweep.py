@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-28 17:03:45
+#   Description : 用eval.py --save_candidates保存的候选框搜索conf_thresh、nms_thresh
+#
+# ================================================================
+import os
+import json
+import argparse
+from config import YOLOv4_Config_1, YOLOv4_Tiny_Config_1, YOLOv3_Config_1
+from tools.nms_sweep import sweep
+
+import logging
+FORMAT = '%(asctime)s-%(levelname)s: %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep conf_thresh / nms_thresh on saved pre-NMS candidates.')
+    parser.add_argument('--candidates', type=str, default='eval_results/candidates/',
+                        help='eval.py --save_candidates保存的目录。验证时的conf_thresh要不大于要搜索的最小值，例如0.001')
+    parser.add_argument('--conf_threshs', type=str, default='0.001,0.005,0.01,0.05,0.1')
+    parser.add_argument('--nms_threshs', type=str, default='0.4,0.45,0.5,0.55,0.6,0.65')
+    parser.add_argument('--keep_top_ks', type=str, default='', help='每张图片最多保留的框数，-1表示不限制。默认与验证时一样用cfg.max_dets')
+    parser.add_argument('--num_workers', type=int, default=4, help='并行评测的进程数')
+    parser.add_argument('--output', type=str, default='eval_results/sweep.json')
+    args = parser.parse_args()
+
+    # 选择配置
+    cfg = YOLOv4_Config_1()
+    # cfg = YOLOv4_Tiny_Config_1()
+    # cfg = YOLOv3_Config_1()
+
+    results = sweep(args.candidates, cfg.val_path,
+                    [float(t) for t in args.conf_threshs.split(',')],
+                    [float(t) for t in args.nms_threshs.split(',')],
+                    [int(k) for k in args.keep_top_ks.split(',')] if args.keep_top_ks else [cfg.max_dets],
+                    num_workers=args.num_workers, fast_eval=cfg.fast_eval,
+                    pre_nms_class_top_k=cfg.pre_nms_class_top_k, pre_nms_top_k=cfg.pre_nms_top_k)
+
+    logger.info('conf_thresh  nms_thresh  keep_top_k    AP   AP50   AP75  num_dets')
+    for r in results:
+        logger.info('%11.4f  %10.2f  %10d  %.3f  %.3f  %.3f  %8d' % (r['conf_thresh'], r['nms_thresh'], r['keep_top_k'],
+                                                                   r['stats'][0], r['stats'][1], r['stats'][2], r['num_dets']))
+    out_dir = os.path.dirname(args.output)
+    if out_dir and not os.path.exists(out_dir): os.makedirs(out_dir)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info('Results saved to {}.'.format(args.output))
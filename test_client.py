@@ -2,6 +2,7 @@
 from tools.cocotools import get_classes
 from tools.visualize import get_colors, draw
 from paddle_serving_client import Client
+from tools.preprocess import letterbox_shape, pad_to_stride, letterbox_box_shape
 import cv2
 import sys
 import numpy as np
@@ -23,23 +24,43 @@ client.load_client_config(prototxt_path)
 client.connect(['127.0.0.1:9494'])
 
 
+# 导出时uint8_input=True的模型直接传uint8图片（归一化在图里做），数据量是float32的1/4
+uint8_input = False
+# 保持宽高比缩放（letterbox），只填充到32的倍数
+letterbox = False
+
+
 img_path = sys.argv[3]
 print(img_path)   # 这是图片的路径
 input_shape = (608, 608)
 image = cv2.imread(img_path)
 h, w = image.shape[:2]
 img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-scale_x = float(input_shape[1]) / w
-scale_y = float(input_shape[0]) / h
-img = cv2.resize(img, None, None, fx=scale_x, fy=scale_y, interpolation=cv2.INTER_CUBIC)
-pimage = img.astype(np.float32) / 255.
-pimage = pimage.transpose(2, 0, 1)
+box_shape = (h, w)
+if letterbox:
+    resize_h, resize_w = letterbox_shape(img.shape, input_shape)
+    img = cv2.resize(img, (resize_w, resize_h), interpolation=cv2.INTER_CUBIC)
+    pad_h, pad_w = pad_to_stride((resize_h, resize_w))
+    padding_img = np.zeros((pad_h, pad_w, 3), dtype=np.uint8)
+    padding_img[:resize_h, :resize_w] = img
+    img = padding_img
+    # 模型把坐标乘上origin_shape，喂box_shape就直接得到原图上的坐标
+    box_shape = letterbox_box_shape((h, w), (resize_h, resize_w), (pad_h, pad_w))
+else:
+    scale_x = float(input_shape[1]) / w
+    scale_y = float(input_shape[0]) / h
+    img = cv2.resize(img, None, None, fx=scale_x, fy=scale_y, interpolation=cv2.INTER_CUBIC)
+if uint8_input:
+    pimage = img.transpose(2, 0, 1)
+else:
+    pimage = img.astype(np.float32) / 255.
+    pimage = pimage.transpose(2, 0, 1)
 
 
 fetch_map = client.predict(
     feed={
         "image": pimage,
-        "origin_shape": np.array([h, w]),
+        "origin_shape": np.round(np.array(box_shape)).astype(np.int32),
     },
     fetch=["multiclass_nms_0.tmp_0"])
 print('===============================================')
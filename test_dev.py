@@ -13,12 +13,16 @@ from model.resnet import Resnet50Vd
 from model.yolov3 import YOLOv3
 from tools.cocotools import get_classes
 from model.yolov4 import YOLOv4
+from tools.prune import load_channels
 from model.decode_np import Decode
 import json
 import os
+import sys
+import argparse
 import paddle.fluid as fluid
 import paddle.fluid.layers as P
-from tools.cocotools import test_dev
+from tools.cocotools import test_dev, clsid2catid, collect_detections, DetectionJsonWriter
+from tools.shard import shard_range, is_shard_done, save_shard, load_shards, launch_shards
 
 import logging
 FORMAT = '%(asctime)s-%(levelname)s: %(message)s'
@@ -29,8 +33,20 @@ logger = logging.getLogger(__name__)
 use_gpu = True
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predict on test-dev2017.')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='把test集分成几片。大于1时每一片由一个子进程（或者另一台机器）预测，最后合并成bbox_detections.json')
+    parser.add_argument('--shard_id', type=int, default=-1,
+                        help='只预测这一片并保存结果。-1表示启动所有没完成的分片，再合并。')
+    parser.add_argument('--shard_dir', type=str, default='results/shards/', help='分片结果的保存目录。')
+    parser.add_argument('--gpus', type=str, default='0', help='分片子进程轮流使用的GPU，逗号分隔，例如0,1,2,3')
+    parser.add_argument('--max_procs', type=int, default=0, help='同时运行的子进程数，0表示等于GPU数。')
+    parser.add_argument('--merge', action='store_true', help='不启动子进程，只合并已经完成的分片。')
+    args = parser.parse_args()
+
     # 选择配置
     cfg = YOLOv4_Config_1()
+    # cfg = YOLOv4_Tiny_Config_1()
     # cfg = YOLOv3_Config_1()
 
 
@@ -62,6 +78,26 @@ if __name__ == '__main__':
             dataset = json.loads(line)
             images = dataset['images']
 
+    if args.num_shards > 1 and args.shard_id < 0:
+        # 启动所有没完成的分片（已完成的跳过，中断后重新运行会接着跑），全部完成后合并
+        if not args.merge:
+            launch_shards(os.path.abspath(__file__), args.num_shards, args.shard_dir, images,
+                          [int(g) for g in args.gpus.split(',')], args.max_procs)
+        dets = load_shards(args.shard_dir, args.num_shards, images)
+        if not os.path.exists('results/'): os.mkdir('results/')
+        writer = DetectionJsonWriter('results/bbox_detections.json')
+        writer.write(dets)
+        writer.close()
+        logger.info('Done.')
+        sys.exit(0)
+    if args.num_shards > 1:
+        if is_shard_done(args.shard_dir, args.num_shards, args.shard_id, images):
+            logger.info('Shard {}/{} is already done.'.format(args.shard_id, args.num_shards))
+            sys.exit(0)
+        all_images = images
+        start, end = shard_range(len(images), args.num_shards, args.shard_id)
+        images = images[start:end]
+
     anchors = cfg.anchors
     num_anchors = len(cfg.anchor_masks[0])
     all_classes = get_classes(classes_path)
@@ -75,7 +111,9 @@ if __name__ == '__main__':
             # 多尺度训练
             inputs = P.data(name='input_1', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
             if algorithm == 'YOLOv4':
-                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True)
+                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True,
+                                                      width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                                      channels=load_channels(cfg.prune_channels))
             elif algorithm == 'YOLOv3':
                 backbone = Resnet50Vd()
                 head = YOLOv3Head(keep_prob=1.0)   # 一定要设置keep_prob=1.0, 为了得到一致的推理结果
@@ -89,7 +127,15 @@ if __name__ == '__main__':
     exe.run(startup_prog)
 
     fluid.load(eval_prog, model_path, executor=exe)
-    _decode = Decode(algorithm, anchors, conf_thresh, nms_thresh, input_shape, exe, eval_prog, all_classes)
-
-    test_dev(_decode, eval_fetch_list, images, test_pre_path, eval_batch_size, draw_image)
-
+    _decode = Decode(algorithm, anchors, conf_thresh, nms_thresh, input_shape, exe, eval_prog, all_classes,
+                     cfg.pre_nms_class_top_k, cfg.pre_nms_top_k, cfg.max_dets, cfg.interp, cfg.letterbox)
+    _decode.start_post_pool(cfg.post_workers)
+
+    if args.num_shards > 1:
+        if draw_image and not os.path.exists('results/images/'): os.makedirs('results/images/')
+        dets = collect_detections(_decode, eval_fetch_list, images, test_pre_path, eval_batch_size, clsid2catid,
+                                  draw_image, 'results/images/')
+        save_shard(args.shard_dir, args.num_shards, args.shard_id, all_images, dets)
+    else:
+        test_dev(_decode, eval_fetch_list, images, test_pre_path, eval_batch_size, draw_image)
+    _decode.close_post_pool()
@@ -12,6 +12,11 @@ import json
 import sys
 import cv2
 import shutil
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+from tools.eval_pipeline import run_pipeline
 import logging
 logger = logging.getLogger(__name__)
 
@@ -38,27 +43,225 @@ def get_classes(classes_path):
     class_names = [c.strip() for c in class_names]
     return class_names
 
+def get_catid_lut(_clsid2catid):
+    '''
+    把字典_clsid2catid变成查找表，catid_lut[clsid] = catid，可以一次性转换一整个数组的类别id。
+    '''
+    catid_lut = np.zeros((max(_clsid2catid.keys()) + 1, ), dtype=np.int64)
+    for clsid, catid in _clsid2catid.items():
+        catid_lut[clsid] = catid
+    return catid_lut
+
+def dets_to_array(im_id, boxes, scores, classes, catid_lut):
+    '''
+    一张图片的预测结果一次性转换成COCO格式。
+    :param boxes:    [n, 4]  左上角坐标、右下角坐标
+    :param scores:   [n, ]
+    :param classes:  [n, ]
+    :return:   [n, 7]  每行是[image_id, x, y, w, h, score, category_id]
+    '''
+    n = len(boxes)
+    dets = np.empty((n, 7), dtype=np.float64)
+    dets[:, 0] = im_id
+    dets[:, 1:3] = boxes[:, :2]
+    dets[:, 3:5] = boxes[:, 2:4] - boxes[:, :2] + 1
+    # Round to the nearest 10th to avoid huge file sizes, as COCO suggests
+    dets[:, 1:5] = np.round(dets[:, 1:5] * 10) / 10
+    dets[:, 5] = scores
+    dets[:, 6] = catid_lut[classes.astype(np.int64)]
+    return dets
+
+class DetectionBuffer(object):
+    """
+    在内存里收集检测结果，每行是[image_id, x, y, w, h, score, category_id]，
+    正好是COCO.loadRes()直接接受的numpy格式，不用再写json、读json。
+    内存里的缓冲区第一次extend()时才分配，不够时翻倍，最多capacity行；满了就追加写到spill_root下临时目录里的
+    一个文件（spill），get()返回这个文件的只读np.memmap，不再把所有结果读回内存，所以内存占用有上界。
+    每个实例用自己的tempfile.mkdtemp()目录，多个进程（例如分片评测）同时收集也不会互相覆盖；clear()时删掉。
+    """
+    def __init__(self, capacity=1000000, spill_root='eval_results/', initial_capacity=4096):
+        self.capacity = capacity
+        self.initial_capacity = min(initial_capacity, capacity)
+        self.spill_root = spill_root
+        self.spill_dir = None
+        self.spill_path = None
+        self.num_spilled = 0
+        self.data = None
+        self.size = 0
+
+    def __len__(self):
+        return self.num_spilled + self.size
+
+    def _reserve(self, num):
+        # 缓冲区不够num行时翻倍，最多capacity行
+        cap = 0 if self.data is None else len(self.data)
+        if cap >= num or cap == self.capacity:
+            return
+        data = np.zeros((min(max(cap * 2, num, self.initial_capacity), self.capacity), 7), dtype=np.float64)
+        if self.size > 0:
+            data[:self.size] = self.data[:self.size]
+        self.data = data
+
+    def extend(self, dets):
+        '''
+        :param dets:  [n, 7]  dets_to_array()的结果
+        '''
+        while len(dets) > 0:
+            self._reserve(self.size + len(dets))
+            if self.size == len(self.data):
+                self._spill()
+            num = min(len(dets), len(self.data) - self.size)
+            self.data[self.size:self.size + num] = dets[:num]
+            self.size += num
+            dets = dets[num:]
+
+    def _spill(self):
+        if self.spill_dir is None:
+            if not os.path.exists(self.spill_root): os.makedirs(self.spill_root)
+            self.spill_dir = tempfile.mkdtemp(prefix='spill_', dir=self.spill_root)
+            self.spill_path = os.path.join(self.spill_dir, 'detections.bin')
+        with open(self.spill_path, 'ab') as f:
+            self.data[:self.size].tofile(f)
+        self.num_spilled += self.size
+        self.size = 0
+
+    def get(self):
+        '''
+        返回所有检测结果，[N, 7]。写过磁盘时是spill文件的只读np.memmap（按需从磁盘读），否则是内存里的数组。
+        clear()会删掉spill文件，Linux上已经打开的memmap仍然可以读。
+        '''
+        if self.num_spilled == 0:
+            if self.data is None:
+                return np.zeros((0, 7), dtype=np.float64)
+            return self.data[:self.size]
+        if self.size > 0:
+            self._spill()
+        return np.memmap(self.spill_path, dtype=np.float64, mode='r', shape=(self.num_spilled, 7))
+
+    def clear(self):
+        self.data = None
+        self.size = 0
+        self.num_spilled = 0
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self.spill_dir = None
+        self.spill_path = None
+
+
+class DetectionJsonWriter(object):
+    """
+    边预测边把检测结果写进一个json文件（一个大list），只写一遍，不需要先写每张图片的小文件再合并。
+    """
+    def __init__(self, path):
+        self.f = open(path, 'w')
+        self.f.write('[')
+        self.count = 0
+
+    def write(self, dets):
+        '''
+        :param dets:  [n, 7]  dets_to_array()的结果
+        '''
+        if len(dets) == 0:
+            return
+        records = ', '.join(['{"image_id": %d, "category_id": %d, "bbox": [%r, %r, %r, %r], "score": %r}' %
+                             (im_id, catid, x, y, w, h, score) for im_id, x, y, w, h, score, catid in dets.tolist()])
+        if self.count > 0:
+            self.f.write(', ')
+        self.f.write(records)
+        self.count += len(dets)
+
+    def close(self):
+        self.f.write(']')
+        self.f.close()
+
+
+# 进程内的标注缓存，key是(绝对路径, 文件大小, 修改时间)
+_coco_gt_cache = {}
+
+def load_coco_gt(anno_file, cache_dir=None):
+    '''
+    同一个标注文件只建一次COCO索引，之后的调用（每次验证、eval()、训练循环）直接返回同一个COCO对象。
+    cache_dir不是None时，还会把COCO对象pickle到cache_dir下，文件名里带标注文件内容的md5，
+    下次启动直接读pickle，不用再解析json、建索引。标注文件内容变了，md5跟着变，旧的pickle自然不会被用到。
+    返回的COCO对象是共享的，不要修改它。
+    '''
+    from pycocotools.coco import COCO
+
+    path = os.path.abspath(anno_file)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if key in _coco_gt_cache:
+        return _coco_gt_cache[key]
+    coco_gt = None
+    pkl_path = None
+    if cache_dir is not None:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        pkl_path = os.path.join(cache_dir, 'coco_gt_%s.pkl' % md5.hexdigest()[:12])
+        if os.path.exists(pkl_path):
+            with open(pkl_path, 'rb') as f:
+                coco_gt = pickle.load(f)
+            logger.info('Load COCO index from {}.'.format(pkl_path))
+    if coco_gt is None:
+        coco_gt = COCO(path)
+        if pkl_path is not None:
+            if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+            tmp_path = pkl_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(coco_gt, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, pkl_path)
+    _coco_gt_cache[key] = coco_gt
+    return coco_gt
+
 def cocoapi_eval(jsonfile,
                  style,
                  coco_gt=None,
                  anno_file=None,
-                 max_dets=(100, 300, 1000)):
+                 max_dets=(100, 300, 1000),
+                 fast_eval=False,
+                 fast_eval_workers=0,
+                 img_ids=None):
     """
     Args:
         jsonfile: Evaluation json file, eg: bbox.json, mask.json.
+                  Or a np.ndarray of shape [N, 7], each row is
+                  [image_id, x, y, w, h, score, category_id].
         style: COCOeval style, can be `bbox` , `segm` and `proposal`.
         coco_gt: Whether to load COCOAPI through anno_file,
                  eg: coco_gt = COCO(anno_file)
         anno_file: COCO annotations file.
         max_dets: COCO evaluation maxDets.
+        fast_eval: Use tools.fast_cocoeval.FastCOCOeval instead of
+                   COCOeval, only for `bbox` style. Same stats, faster.
+        fast_eval_workers: Number of processes of FastCOCOeval.
+        img_ids: Only evaluate these images (e.g. a subset of val2017).
+                 None means all images in the annotations.
     """
     assert coco_gt != None or anno_file != None
-    from pycocotools.coco import COCO
     from pycocotools.cocoeval import COCOeval
 
     if coco_gt == None:
-        coco_gt = COCO(anno_file)
+        coco_gt = load_coco_gt(anno_file)
     logger.info("Start evaluate...")
+    if fast_eval and style == 'bbox':
+        from tools.fast_cocoeval import FastCOCOeval
+        if isinstance(jsonfile, str):
+            with open(jsonfile, 'r') as f:
+                records = json.load(f)
+            jsonfile = np.array([[r['image_id']] + r['bbox'] + [r['score'], r['category_id']] for r in records],
+                                dtype=np.float64).reshape((-1, 7))
+        coco_eval = FastCOCOeval(coco_gt, jsonfile, num_workers=fast_eval_workers)
+        if img_ids is not None:
+            coco_eval.params.imgIds = sorted(img_ids)
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+        return coco_eval.stats
+    if isinstance(jsonfile, np.ndarray):
+        # loadRes()只认type是np.ndarray的数组，np.memmap（DetectionBuffer.get()）转成不复制数据的视图
+        jsonfile = np.asarray(jsonfile)
     coco_dt = coco_gt.loadRes(jsonfile)
     if style == 'proposal':
         coco_eval = COCOeval(coco_gt, coco_dt, 'bbox')
@@ -66,179 +269,94 @@ def cocoapi_eval(jsonfile,
         coco_eval.params.maxDets = list(max_dets)
     else:
         coco_eval = COCOeval(coco_gt, coco_dt, style)
+    if img_ids is not None:
+        coco_eval.params.imgIds = sorted(img_ids)
     coco_eval.evaluate()
     coco_eval.accumulate()
     coco_eval.summarize()
     return coco_eval.stats
 
-def bbox_eval(anno_file):
-    from pycocotools.coco import COCO
+def bbox_eval(anno_file, detections, fast_eval=False, fast_eval_workers=0, img_ids=None):
+    '''
+    :param detections: DetectionBuffer.get()的结果，[N, 7]
+    :param fast_eval:  True时用tools.fast_cocoeval.FastCOCOeval评测，结果与COCOeval相同，速度快得多
+    :param img_ids:    只评测这些图片（例如只预测了验证集的一部分），None表示标注里的所有图片
+    '''
+    coco_gt = load_coco_gt(anno_file)
 
-    coco_gt = COCO(anno_file)
-
-    outfile = 'eval_results/bbox_detections.json'
-    logger.info('Generating json file...')
-    bbox_list = []
-    path_dir = os.listdir('eval_results/bbox/')
-    for name in path_dir:
-        with open('eval_results/bbox/' + name, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                r_list = json.loads(line)
-                bbox_list += r_list
-    with open(outfile, 'w') as f:
-        json.dump(bbox_list, f)
-
-    map_stats = cocoapi_eval(outfile, 'bbox', coco_gt=coco_gt)
+    if len(detections) == 0:
+        logger.warning('No detection results, mAP is 0.')
+        return np.zeros((12, ), dtype=np.float64)
+    map_stats = cocoapi_eval(detections, 'bbox', coco_gt=coco_gt,
+                             fast_eval=fast_eval, fast_eval_workers=fast_eval_workers, img_ids=img_ids)
     # flush coco evaluation result
     sys.stdout.flush()
     return map_stats
 
-def eval(_decode, eval_fetch_list, images, eval_pre_path, anno_file, eval_batch_size, _clsid2catid, draw_image):
-    # 8G内存的电脑并不能装下所有结果，所以把结果写进文件里。
-    if os.path.exists('eval_results/bbox/'): shutil.rmtree('eval_results/bbox/')
+def collect_detections(_decode, eval_fetch_list, images, pre_path, batch_size, _clsid2catid, draw_image,
+                       draw_dir='eval_results/images/', eval_cache=None, num_workers=4, prefetch=4,
+                       candidate_writer=None):
+    '''
+    预测images里的所有图片，返回检测结果[N, 7]，每行是[image_id, x, y, w, h, score, category_id]。
+    draw_image时画好框的图片保存在draw_dir下。
+    candidate_writer是tools.nms_sweep.CandidateWriter时，同时保存每张图片nms之前的候选框。
+    '''
+    # 检测结果收集在内存里，结果太多时会把一部分写到磁盘上，8G内存的电脑也装得下。
+    detections = DetectionBuffer()
+    catid_lut = get_catid_lut(_clsid2catid)
+
+    # 在run_pipeline()的写线程里按images的顺序被调用
+    def consumer(im, image, boxes, scores, classes):
+        if boxes is not None:
+            detections.extend(dets_to_array(im['id'], boxes, scores, classes, catid_lut))
+            if draw_image:
+                cv2.imwrite(os.path.join(draw_dir, im['file_name']), image)
+
+    # eval_cache是tools.eval_cache.EvalImageCache。第一次验证时写缓存，之后的验证直接读缓存。
+    run_pipeline(_decode, eval_fetch_list, images, pre_path, batch_size, draw_image, consumer,
+                 eval_cache=eval_cache, num_workers=num_workers, prefetch=prefetch,
+                 candidate_consumer=candidate_writer.write if candidate_writer is not None else None)
+    if candidate_writer is not None:
+        candidate_writer.close()
+    # 结果多时是np.memmap，不读回内存
+    dets = detections.get()
+    detections.clear()
+    return dets
+
+def eval(_decode, eval_fetch_list, images, eval_pre_path, anno_file, eval_batch_size, _clsid2catid, draw_image,
+         eval_cache=None, num_workers=4, prefetch=4, fast_eval=False, fast_eval_workers=0, candidate_writer=None):
     if draw_image:
         if os.path.exists('eval_results/images/'): shutil.rmtree('eval_results/images/')
     if not os.path.exists('eval_results/'): os.mkdir('eval_results/')
-    os.mkdir('eval_results/bbox/')
     if draw_image:
         os.mkdir('eval_results/images/')
-
-    count = 0
-    n = len(images)
-    batch_im_id = []
-    batch_im_name = []
-    batch_img = []
-    for i, im in enumerate(images):
-        im_id = im['id']
-        file_name = im['file_name']
-        image = cv2.imread(eval_pre_path + file_name)
-        if i % eval_batch_size == 0:
-            batch_im_id = []
-            batch_im_name = []
-            batch_img = []
-        batch_im_id.append(im_id)
-        batch_im_name.append(file_name)
-        batch_img.append(image)
-
-        # 收集够一个batch的图片
-        if i != n - 1 and len(batch_img) != eval_batch_size:
-            continue
-
-        result_image, result_boxes, result_scores, result_classes = _decode.detect_batch(batch_img, eval_fetch_list, draw_image=draw_image)
-        k = 0
-        for image, boxes, scores, classes in zip(result_image, result_boxes, result_scores, result_classes):
-            if boxes is not None:
-                im_id = batch_im_id[k]
-                im_name = batch_im_name[k]
-                n = len(boxes)
-                bbox_data = []
-                for p in range(n):
-                    clsid = classes[p]
-                    score = scores[p]
-                    xmin, ymin, xmax, ymax = boxes[p]
-                    catid = (_clsid2catid[int(clsid)])
-                    w = xmax - xmin + 1
-                    h = ymax - ymin + 1
-
-                    bbox = [xmin, ymin, w, h]
-                    # Round to the nearest 10th to avoid huge file sizes, as COCO suggests
-                    bbox = [round(float(x) * 10) / 10 for x in bbox]
-                    bbox_res = {
-                        'image_id': im_id,
-                        'category_id': catid,
-                        'bbox': bbox,
-                        'score': float(score)
-                    }
-                    bbox_data.append(bbox_res)
-                path = 'eval_results/bbox/%s.json' % im_name.split('.')[0]
-                if draw_image:
-                    cv2.imwrite('eval_results/images/%s' % im_name, image)
-                with open(path, 'w') as f:
-                    json.dump(bbox_data, f)
-            count += 1
-            k += 1
-            if count % 100 == 0:
-                logger.info('Test iter {}'.format(count))
+    dets = collect_detections(_decode, eval_fetch_list, images, eval_pre_path, eval_batch_size, _clsid2catid,
+                              draw_image, 'eval_results/images/', eval_cache=eval_cache,
+                              num_workers=num_workers, prefetch=prefetch, candidate_writer=candidate_writer)
     # 开始评测
-    box_ap_stats = bbox_eval(anno_file)
+    box_ap_stats = bbox_eval(anno_file, dets, fast_eval=fast_eval, fast_eval_workers=fast_eval_workers)
     return box_ap_stats
 
 
-def test_dev(_decode, eval_fetch_list, images, test_pre_path, test_batch_size, draw_image):
-    # 8G内存的电脑并不能装下所有结果，所以把结果写进文件里。
-    if os.path.exists('results/bbox/'): shutil.rmtree('results/bbox/')
+def test_dev(_decode, eval_fetch_list, images, test_pre_path, test_batch_size, draw_image,
+             num_workers=4, prefetch=4):
     if draw_image:
         if os.path.exists('results/images/'): shutil.rmtree('results/images/')
     if not os.path.exists('results/'): os.mkdir('results/')
-    os.mkdir('results/bbox/')
     if draw_image:
         os.mkdir('results/images/')
+    # 提交到网站的文件，边预测边写。
+    writer = DetectionJsonWriter('results/bbox_detections.json')
+    catid_lut = get_catid_lut(clsid2catid)
 
-    count = 0
-    n = len(images)
-    batch_im_id = []
-    batch_img = []
-    for i, im in enumerate(images):
-        im_id = im['id']
-        file_name = im['file_name']
-        image = cv2.imread(test_pre_path + file_name)
-        if i % test_batch_size == 0:
-            batch_im_id = []
-            batch_img = []
-        batch_im_id.append(im_id)
-        batch_img.append(image)
-
-        # 收集够一个batch的图片
-        if i != n - 1 and len(batch_img) != test_batch_size:
-            continue
-
-        result_image, result_boxes, result_scores, result_classes = _decode.detect_batch(batch_img, eval_fetch_list, draw_image=draw_image)
-        k = 0
-        for image, boxes, scores, classes in zip(result_image, result_boxes, result_scores, result_classes):
-            if boxes is not None:
-                im_id = batch_im_id[k]
-                n = len(boxes)
-                bbox_data = []
-                for p in range(n):
-                    clsid = classes[p]
-                    score = scores[p]
-                    xmin, ymin, xmax, ymax = boxes[p]
-                    catid = (clsid2catid[int(clsid)])
-                    w = xmax - xmin + 1
-                    h = ymax - ymin + 1
-
-                    bbox = [xmin, ymin, w, h]
-                    # Round to the nearest 10th to avoid huge file sizes, as COCO suggests
-                    bbox = [round(float(x) * 10) / 10 for x in bbox]
-                    bbox_res = {
-                        'image_id': im_id,
-                        'category_id': catid,
-                        'bbox': bbox,
-                        'score': float(score)
-                    }
-                    bbox_data.append(bbox_res)
-                path = 'results/bbox/%.12d.json' % im_id
-                if draw_image:
-                    cv2.imwrite('results/images/%.12d.jpg' % im_id, image)
-                with open(path, 'w') as f:
-                    json.dump(bbox_data, f)
-            count += 1
-            k += 1
-            if count % 100 == 0:
-                logger.info('Test iter {}'.format(count))
-    # 生成json文件
-    logger.info('Generating json file...')
-    bbox_list = []
-    path_dir = os.listdir('results/bbox/')
-    for name in path_dir:
-        with open('results/bbox/' + name, 'r', encoding='utf-8') as f2:
-            for line in f2:
-                line = line.strip()
-                r_list = json.loads(line)
-                bbox_list += r_list
-    # 提交到网站的文件
-    with open('results/bbox_detections.json', 'w') as f2:
-        json.dump(bbox_list, f2)
-    logger.info('Done.')
+    # 在run_pipeline()的写线程里按images的顺序被调用
+    def consumer(im, image, boxes, scores, classes):
+        if boxes is not None:
+            if draw_image:
+                cv2.imwrite('results/images/%.12d.jpg' % im['id'], image)
+            writer.write(dets_to_array(im['id'], boxes, scores, classes, catid_lut))
 
+    run_pipeline(_decode, eval_fetch_list, images, test_pre_path, test_batch_size, draw_image, consumer,
+                 num_workers=num_workers, prefetch=prefetch)
+    writer.close()
+    logger.info('Done.')
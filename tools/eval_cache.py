@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-25 10:12:41
+#   Description : 验证集预处理结果缓存
+#
+# ================================================================
+import os
+import json
+import hashlib
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class EvalImageCache(object):
+    """
+    训练时每隔eval_iter步验证一次，每次都要对5000张验证集图片重新imread、BGR2RGB、resize，结果每次都一样。
+    第一次验证时把缩放到input_shape之后的图片（Decode.resize_image()的结果，uint8，HWC，BGR，未归一化）写进内存映射文件，
+    之后的验证直接从文件里按批读取，省掉解码和缩放。
+    存uint8而不是float32：体积是1/4，而且归一化很便宜，读出来之后再做。
+    """
+    def __init__(self, cache_dir, images, eval_pre_path, input_shape, interp='cubic', letterbox=False):
+        self.cache_dir = cache_dir
+        self.input_shape = input_shape
+        self.num_images = len(images)
+        # 图片列表、图片目录、input_shape、插值方式、是否letterbox任何一个变了，缓存都要作废
+        md5 = hashlib.md5()
+        md5.update(eval_pre_path.encode('utf-8'))
+        md5.update(('interp=%s\n' % interp).encode('utf-8'))
+        if letterbox:
+            md5.update(b'letterbox\n')
+        for im in images:
+            md5.update(('%s\n' % im['file_name']).encode('utf-8'))
+        key = md5.hexdigest()[:12]
+        prefix = os.path.join(cache_dir, 'val_hwc_%dx%d_%s' % (input_shape[0], input_shape[1], key))
+        self.data_path = prefix + '.npy'
+        self.shape_path = prefix + '_shapes.npy'
+        self.meta_path = prefix + '_meta.json'   # 写完才生成，作为缓存完整的标记
+        self.data = None
+        self.shapes = None
+        self.writable = False
+
+    def is_complete(self):
+        return os.path.exists(self.meta_path) and os.path.exists(self.data_path) and os.path.exists(self.shape_path)
+
+    def open(self):
+        '''
+        缓存完整时以只读方式打开并返回True；否则新建缓存文件等待写入，返回False。
+        '''
+        if self.is_complete():
+            self.data = np.load(self.data_path, mmap_mode='r')
+            self.shapes = np.load(self.shape_path)
+            self.writable = False
+            return True
+        if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir)
+        h, w = self.input_shape
+        self.data = np.lib.format.open_memmap(self.data_path, mode='w+', dtype=np.uint8,
+                                              shape=(self.num_images, h, w, 3))
+        self.shapes = np.zeros((self.num_images, 3), dtype=np.int32)
+        self.writable = True
+        logger.info('Building eval cache {}...'.format(self.data_path))
+        return False
+
+    def write(self, start, batch_pimage, batch_shape):
+        '''
+        :param batch_pimage:  [bz, h, w, 3]  uint8。letterbox时是bz张不超过input_shape的图片，放在左上角
+        :param batch_shape:   原图的shape，bz个(h, w, c)
+        '''
+        end = start + len(batch_pimage)
+        for i, pimage in enumerate(batch_pimage):
+            self.data[start + i, :pimage.shape[0], :pimage.shape[1]] = pimage
+        self.shapes[start:end] = np.array(batch_shape, dtype=np.int32)
+
+    def read(self, start, end):
+        batch_pimage = np.ascontiguousarray(self.data[start:end])
+        batch_shape = [tuple(s) for s in self.shapes[start:end]]
+        return batch_pimage, batch_shape
+
+    def close(self):
+        if self.writable:
+            self.data.flush()
+            np.save(self.shape_path, self.shapes)
+            meta = {'num_images': self.num_images, 'input_shape': list(self.input_shape)}
+            with open(self.meta_path, 'w') as f:
+                json.dump(meta, f)
+            logger.info('Eval cache saved to {}.'.format(self.data_path))
+        self.data = None
+        self.shapes = None
+        self.writable = False
@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-26 14:03:12
+#   Description : 流水线式的验证、test-dev预测
+#
+# ================================================================
+import time
+import queue
+import threading
+import cv2
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PipelineStats(object):
+    """
+    统计流水线每个阶段的耗时和队列深度。
+    load:        线程池里读图、预处理的耗时（各线程累加）
+    wait_load:   主线程凑一批、等预处理结果的耗时。越接近0，说明读图没有拖后腿
+    infer:       主线程跑网络的耗时
+    wait_post:   主线程等后处理结果的耗时。越接近0，说明后处理没有拖后腿
+    wait_write:  主线程把结果交给写线程时被阻塞的耗时。越接近0，说明画图、写结果没有拖后腿
+    write:       写线程画图、保存结果的耗时
+    """
+    stages = ['load', 'wait_load', 'infer', 'wait_post', 'wait_write', 'write']
+
+    def __init__(self):
+        self.times = {stage: 0.0 for stage in self.stages}
+        self.load_depth = []
+        self.post_depth = []
+        self.write_depth = []
+        self.num_batches = 0
+        self.lock = threading.Lock()
+
+    def add(self, stage, cost):
+        with self.lock:
+            self.times[stage] += cost
+
+    def summary(self):
+        n = max(self.num_batches, 1)
+        strs = ', '.join(['{}: {:.1f}ms'.format(stage, self.times[stage] * 1000.0 / n) for stage in self.stages])
+        strs += ', load_queue: {:.2f}, post_queue: {:.2f}, write_queue: {:.2f}'.format(
+            np.mean(self.load_depth) if self.load_depth else 0.0, np.mean(self.post_depth) if self.post_depth else 0.0,
+            np.mean(self.write_depth) if self.write_depth else 0.0)
+        return 'Per batch {}'.format(strs)
+
+
+def run_pipeline(_decode, fetch_list, images, pre_path, batch_size, draw_image, consumer,
+                 eval_cache=None, num_workers=4, prefetch=4, log_iter=100, candidate_consumer=None):
+    '''
+    用Decode.detect_stream()预测images里的所有图片：线程池读图、预处理后面的图片；主线程跑网络；
+    后处理进程池（或者后处理线程）做后处理；写线程画图、保存结果。这样验证的速度只受限于网络的计算，而不是串行的读写。
+    :param consumer:    consumer(im, image, boxes, scores, classes)，在写线程里按images的顺序被调用。im是images里的元素，
+                        image是画好框的原图（draw_image=False时是None）
+    :param eval_cache:  tools.eval_cache.EvalImageCache。第一次验证时写缓存，之后的验证直接读缓存。
+    :param candidate_consumer:  candidate_consumer(im, shape, boxes, scores, classes)，在后处理线程里按跑网络的顺序被调用
+                                （letterbox时按输入shape分组凑批，不一定是images的顺序），
+                                参数是nms之前的候选框（Decode._yolo_candidates()的结果）
+    '''
+    cached = eval_cache.open() if eval_cache is not None else False
+    stats = PipelineStats()
+
+    # item是(下标, images里的元素)
+    def load(item):
+        k, im = item
+        image = None
+        if not cached or draw_image:
+            image = cv2.imread(pre_path + im['file_name'])
+        if cached:
+            pimage, shape = eval_cache.read(k, k + 1)
+            # letterbox时缓存里的图片放在input_shape的左上角，按原图的shape取出缩放后的部分
+            h, w = _decode.preprocessor.resized_shape(shape[0])
+            return image, pimage[0, :h, :w], shape[0]
+        pimage = _decode.resize_image(image)
+        if eval_cache is not None:
+            eval_cache.write(k, pimage[np.newaxis], [image.shape])
+        return image, pimage, image.shape
+
+    post = None
+    if candidate_consumer is not None:
+        # 先交出nms之前的候选框，再对同一批候选框做nms，不用重复解码
+        def post(outs, batch_items, batch_shape):
+            result_boxes, result_scores, result_classes = [], [], []
+            for k, (boxes, scores, classes) in enumerate(_decode.candidates_batch(outs, batch_shape)):
+                candidate_consumer(batch_items[k][1], batch_shape[k], boxes, scores, classes)
+                boxes, scores, classes = _decode.nms(boxes, scores, classes, batch_shape[k])
+                result_boxes.append(boxes)
+                result_scores.append(scores)
+                result_classes.append(classes)
+            return result_boxes, result_scores, result_classes
+
+    # 画图、consumer（写结果、保存图片）在写线程里做，不阻塞主线程给网络喂下一批
+    write_queue = queue.Queue(maxsize=batch_size * prefetch)
+    errors = []
+
+    def write_loop():
+        count = 0
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            if errors:   # 出错之后只把队列取空，不让主线程阻塞
+                continue
+            try:
+                t0 = time.time()
+                im, image, boxes, scores, classes = item
+                if draw_image and boxes is not None:
+                    _decode.draw(image, boxes, scores, classes)
+                consumer(im, image if draw_image else None, boxes, scores, classes)
+                stats.add('write', time.time() - t0)
+                count += 1
+                if count % log_iter == 0:
+                    logger.info('Test iter {}'.format(count))
+                    logger.info(stats.summary())
+            except Exception as e:
+                errors.append(e)
+
+    writer = threading.Thread(target=write_loop)
+    writer.start()
+    try:
+        for (k, im), image, boxes, scores, classes in _decode.detect_stream(
+                enumerate(images), fetch_list, batch_size, False, num_workers=num_workers, prefetch=prefetch,
+                load=load, post=post, stats=stats):
+            if errors:
+                break
+            t0 = time.time()
+            stats.write_depth.append(write_queue.qsize())
+            write_queue.put((im, image, boxes, scores, classes))
+            stats.add('wait_write', time.time() - t0)
+    finally:
+        write_queue.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    if eval_cache is not None:
+        eval_cache.close()
+    logger.info(stats.summary())
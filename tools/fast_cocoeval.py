@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-27 16:40:05
+#   Description : 向量化的COCO bbox评测，结果与pycocotools的COCOeval一致
+#
+# ================================================================
+import time
+import multiprocessing
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Params(object):
+    '''
+    与pycocotools.cocoeval.Params的bbox设置相同
+    '''
+    def __init__(self):
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+        self.maxDets = [1, 10, 100]
+        self.areaRng = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
+        self.areaRngLbl = ['all', 'small', 'medium', 'large']
+
+
+def _group_starts(keys):
+    '''
+    keys已经排好序，返回每一组的起始下标和组内的序号
+    '''
+    n = len(keys)
+    starts = np.concatenate([[0], np.where(keys[1:] != keys[:-1])[0] + 1]).astype(np.int64)
+    counts = np.diff(np.concatenate([starts, [n]]))
+    rank = np.arange(n) - np.repeat(starts, counts)
+    return starts, counts, rank
+
+
+def _bbox_iou(dt_box, gt_box, gt_crowd):
+    '''
+    与pycocotools/maskApi.c的bbIou()逐个运算相同，所以结果是一模一样的。
+    :param dt_box:    [B, D, 4]  xywh
+    :param gt_box:    [B, G, 4]  xywh
+    :param gt_crowd:  [B, G]
+    :return:   [B, D, G]
+    '''
+    dx, dy, dw, dh = [dt_box[:, :, None, i] for i in range(4)]
+    gx, gy, gw, gh = [gt_box[:, None, :, i] for i in range(4)]
+    da = dw * dh
+    ga = gw * gh
+    w = np.minimum(dw + dx, gw + gx) - np.maximum(dx, gx)
+    h = np.minimum(dh + dy, gh + gy) - np.maximum(dy, gy)
+    pos = (w > 0) & (h > 0)
+    inter = w * h
+    union = np.where(gt_crowd[:, None, :], da, da + ga - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(pos, inter / union, 0.0)
+    return iou
+
+
+def _match(ious, d_valid, g_valid, g_ignore, g_crowd, thrs):
+    '''
+    COCOeval.evaluateImg()里的贪心匹配，一次处理B组(图片, 类别)和所有iou阈值。
+    每个预测框（按分数从高到低）在还没被匹配的gt（crowd的gt可以被重复匹配）里，优先找不被忽略的gt中iou最大的，
+    iou相同时取靠后的；找不到再去被忽略的gt里找。
+    :param ious:      [B, D, G]
+    :param g_ignore:  [B, G]
+    :return:  dtm [B, T, D] 是否匹配上，dt_ig [B, T, D] 匹配上的gt是否被忽略
+    '''
+    B, D, G = ious.shape
+    T = len(thrs)
+    matched = np.zeros((B, T, G), dtype=bool)
+    dtm = np.zeros((B, T, D), dtype=bool)
+    dt_ig = np.zeros((B, T, D), dtype=bool)
+    avail_base = g_valid[:, None, :]
+    not_ig = ~g_ignore[:, None, :]
+    crowd = g_crowd[:, None, :]
+    thrs = thrs[None, :, None]
+    b_idx = np.arange(B)[:, None]
+    t_idx = np.arange(T)[None, :]
+    for d in range(D):
+        iou_d = ious[:, d, None, :]
+        cand = (iou_d >= thrs) & avail_base & (~matched | crowd)
+        tier1 = cand & not_ig
+        sel = np.where(tier1.any(axis=-1, keepdims=True), tier1, cand)
+        val = np.where(sel, iou_d, -1.0)
+        m = G - 1 - np.argmax(val[:, :, ::-1], axis=-1)   # iou相同时取靠后的gt
+        found = sel.any(axis=-1) & d_valid[:, d, None]
+        dtm[:, :, d] = found
+        dt_ig[:, :, d] = found & g_ignore[b_idx, m]
+        matched[b_idx, t_idx, m] |= found
+    return dtm, dt_ig
+
+
+def _eval_category(args):
+    '''
+    评测一个类别。
+    :return:  precision [T, R, A, M]，recall [T, A, M]
+    '''
+    dt_img, dt_box, dt_score, gt_img, gt_box, gt_area, gt_crowd, p, max_elements = args
+    T, R, A, M = len(p.iouThrs), len(p.recThrs), len(p.areaRng), len(p.maxDets)
+    precision = -np.ones((T, R, A, M))
+    recall = -np.ones((T, A, M))
+    thrs = np.minimum(p.iouThrs, 1 - 1e-10)
+
+    # 同一张图片的预测框按分数降序（分数相同时保持原来的顺序），只保留前maxDets[-1]个
+    order = np.lexsort((np.arange(len(dt_img)), -dt_score, dt_img))
+    dt_img, dt_box, dt_score = dt_img[order], dt_box[order], dt_score[order]
+    _, _, dt_rank = _group_starts(dt_img)
+    keep = dt_rank < p.maxDets[-1]
+    dt_img, dt_box, dt_score, dt_rank = dt_img[keep], dt_box[keep], dt_score[keep], dt_rank[keep]
+    dt_area = dt_box[:, 2] * dt_box[:, 3]
+    nd = len(dt_img)
+
+    order = np.argsort(gt_img, kind='mergesort')
+    gt_img, gt_box, gt_area, gt_crowd = gt_img[order], gt_box[order], gt_area[order], gt_crowd[order]
+
+    # 每个面积范围下，预测框是否匹配上、是否被忽略
+    det_m = np.zeros((A, T, nd), dtype=bool)
+    det_ig = np.zeros((A, T, nd), dtype=bool)
+    if nd > 0 and len(gt_img) > 0:
+        d_starts, d_counts, _ = _group_starts(dt_img)
+        g_starts, g_counts, _ = _group_starts(gt_img)
+        d_keys = dt_img[d_starts]
+        g_keys = gt_img[g_starts]
+        _, di, gi = np.intersect1d(d_keys, g_keys, assume_unique=True, return_indices=True)
+        d_starts, d_counts, g_starts, g_counts = d_starts[di], d_counts[di], g_starts[gi], g_counts[gi]
+        # 按gt数分桶（2的幂），减少填充
+        buckets = np.ceil(np.log2(np.maximum(g_counts, 1))).astype(np.int64)
+        for bucket in np.unique(buckets):
+            ids = np.where(buckets == bucket)[0]
+            G = int(g_counts[ids].max())
+            D = int(d_counts[ids].max())
+            chunk = max(1, max_elements // (D * G))
+            for c in range(0, len(ids), chunk):
+                cids = ids[c:c + chunk]
+                d_ar = np.arange(D)[None, :]
+                g_ar = np.arange(G)[None, :]
+                d_valid = d_ar < d_counts[cids, None]
+                g_valid = g_ar < g_counts[cids, None]
+                d_idx = np.where(d_valid, d_starts[cids, None] + d_ar, 0)
+                g_idx = np.where(g_valid, g_starts[cids, None] + g_ar, 0)
+                c_crowd = gt_crowd[g_idx] & g_valid
+                ious = _bbox_iou(dt_box[d_idx], gt_box[g_idx], c_crowd)
+                c_area = gt_area[g_idx]
+                for a, (lo, hi) in enumerate(p.areaRng):
+                    g_ignore = c_crowd | (c_area < lo) | (c_area > hi)
+                    dtm, dt_ig = _match(ious, d_valid, g_valid, g_ignore, c_crowd, thrs)
+                    sel_b, sel_d = np.where(d_valid)
+                    det_m[a][:, d_idx[sel_b, sel_d]] = dtm[sel_b, :, sel_d].T
+                    det_ig[a][:, d_idx[sel_b, sel_d]] = dt_ig[sel_b, :, sel_d].T
+
+    for a, (lo, hi) in enumerate(p.areaRng):
+        # 没匹配上并且面积不在范围内的预测框也忽略
+        det_ig[a] |= ~det_m[a] & ((dt_area < lo) | (dt_area > hi))[None, :]
+        npig = np.count_nonzero(~(gt_crowd | (gt_area < lo) | (gt_area > hi)))
+        if npig == 0:
+            continue
+        for m, max_det in enumerate(p.maxDets):
+            sel = dt_rank < max_det
+            scores = dt_score[sel]
+            inds = np.argsort(-scores, kind='mergesort')
+            dtm = det_m[a][:, sel][:, inds]
+            dt_ig = det_ig[a][:, sel][:, inds]
+            tps = dtm & ~dt_ig
+            fps = ~dtm & ~dt_ig
+            tp_sum = np.cumsum(tps, axis=1).astype(np.float64)
+            fp_sum = np.cumsum(fps, axis=1).astype(np.float64)
+            n = tp_sum.shape[1]
+            if n == 0:
+                recall[:, a, m] = 0
+                precision[:, :, a, m] = 0
+                continue
+            rc = tp_sum / npig
+            pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+            recall[:, a, m] = rc[:, -1]
+            # 精度改成单调不增
+            pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+            for t in range(T):
+                ri = np.searchsorted(rc[t], p.recThrs, side='left')
+                precision[t, :, a, m] = np.where(ri < n, pr[t, np.minimum(ri, n - 1)], 0.0)
+    return precision, recall
+
+
+class FastCOCOeval(object):
+    """
+    COCOeval(coco_gt, coco_dt, 'bbox')的向量化版本，evaluate()、accumulate()、summarize()的结果与pycocotools相同。
+    pycocotools在python里对每个(图片, 类别, 面积范围, iou阈值, 预测框, gt)逐个循环，
+    这里把IoU计算和贪心匹配对一批(图片, 类别)同时做，precision/recall的累计对所有iou阈值同时做。
+    类别之间互相独立，num_workers > 0时用进程池按类别并行。
+    """
+    def __init__(self, coco_gt, detections, num_workers=0, max_elements=1 << 22):
+        '''
+        :param coco_gt:     pycocotools.coco.COCO
+        :param detections:  [N, 7]，每行是[image_id, x, y, w, h, score, category_id]
+        '''
+        self.coco_gt = coco_gt
+        self.detections = np.asarray(detections, dtype=np.float64)
+        self.num_workers = num_workers
+        self.max_elements = max_elements
+        self.params = Params()
+        self.params.imgIds = sorted(coco_gt.getImgIds())
+        self.params.catIds = sorted(coco_gt.getCatIds())
+        self.eval = {}
+        self.stats = []
+        self._per_cat = None
+
+    def evaluate(self):
+        tic = time.time()
+        p = self.params
+        img_ids = np.array(p.imgIds, dtype=np.int64)
+        cat_ids = np.array(p.catIds, dtype=np.int64)
+
+        anns = [self.coco_gt.anns[ann_id] for ann_id in self.coco_gt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds)]
+        gt_img = np.searchsorted(img_ids, np.array([ann['image_id'] for ann in anns], dtype=np.int64))
+        gt_cat = np.searchsorted(cat_ids, np.array([ann['category_id'] for ann in anns], dtype=np.int64))
+        gt_box = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape((-1, 4))
+        gt_area = np.array([ann['area'] for ann in anns], dtype=np.float64)
+        gt_crowd = np.array([bool(ann.get('iscrowd', 0)) for ann in anns], dtype=bool)
+
+        dets = self.detections
+        dt_img_id = dets[:, 0].astype(np.int64)
+        dt_cat_id = dets[:, 6].astype(np.int64)
+        dt_img = np.searchsorted(img_ids, dt_img_id)
+        dt_img_ok = (dt_img < len(img_ids)) & (img_ids[np.minimum(dt_img, len(img_ids) - 1)] == dt_img_id)
+        assert dt_img_ok.all(), 'Results do not correspond to current coco set'
+        dt_cat = np.searchsorted(cat_ids, dt_cat_id)
+        # 不在标注文件里的类别，pycocotools也不会评测
+        dt_cat_ok = (dt_cat < len(cat_ids)) & (cat_ids[np.minimum(dt_cat, len(cat_ids) - 1)] == dt_cat_id)
+        dt_cat = np.where(dt_cat_ok, dt_cat, -1)
+
+        # 逐个类别取出预测框。detections是np.memmap（DetectionBuffer.get()）时，不开进程的话同时只有一个类别的框在内存里
+        def category_args():
+            for k in range(len(cat_ids)):
+                dk = np.where(dt_cat == k)[0]
+                gk = np.where(gt_cat == k)[0]
+                dets_k = dets[dk]
+                yield (dt_img[dk], dets_k[:, 1:5], dets_k[:, 5], gt_img[gk], gt_box[gk], gt_area[gk], gt_crowd[gk],
+                       p, self.max_elements)
+        args = category_args()
+        if self.num_workers > 0:
+            pool = multiprocessing.Pool(self.num_workers)
+            self._per_cat = pool.map(_eval_category, args)
+            pool.close()
+            pool.join()
+        else:
+            self._per_cat = [_eval_category(arg) for arg in args]
+        logger.info('FastCOCOeval evaluate DONE (t={:0.2f}s).'.format(time.time() - tic))
+
+    def accumulate(self):
+        p = self.params
+        precision = np.stack([pc[0] for pc in self._per_cat], axis=2)   # [T, R, K, A, M]
+        recall = np.stack([pc[1] for pc in self._per_cat], axis=1)      # [T, K, A, M]
+        self.eval = {'params': p, 'precision': precision, 'recall': recall}
+
+    def summarize(self):
+        p = self.params
+
+        def _summarize(ap=1, iouThr=None, areaRng='all', maxDets=100):
+            iStr = ' {:<18} {} @[ IoU={:<9} | area={:>6s} | maxDets={:>3d} ] = {:0.3f}'
+            titleStr = 'Average Precision' if ap == 1 else 'Average Recall'
+            typeStr = '(AP)' if ap == 1 else '(AR)'
+            iouStr = '{:0.2f}:{:0.2f}'.format(p.iouThrs[0], p.iouThrs[-1]) \
+                if iouThr is None else '{:0.2f}'.format(iouThr)
+            aind = [i for i, aRng in enumerate(p.areaRngLbl) if aRng == areaRng]
+            mind = [i for i, mDet in enumerate(p.maxDets) if mDet == maxDets]
+            if ap == 1:
+                s = self.eval['precision']
+                if iouThr is not None:
+                    t = np.where(iouThr == p.iouThrs)[0]
+                    s = s[t]
+                s = s[:, :, :, aind, mind]
+            else:
+                s = self.eval['recall']
+                if iouThr is not None:
+                    t = np.where(iouThr == p.iouThrs)[0]
+                    s = s[t]
+                s = s[:, :, aind, mind]
+            if len(s[s > -1]) == 0:
+                mean_s = -1
+            else:
+                mean_s = np.mean(s[s > -1])
+            print(iStr.format(titleStr, typeStr, iouStr, areaRng, maxDets, mean_s))
+            return mean_s
+
+        stats = np.zeros((12, ))
+        stats[0] = _summarize(1)
+        stats[1] = _summarize(1, iouThr=.5, maxDets=p.maxDets[2])
+        stats[2] = _summarize(1, iouThr=.75, maxDets=p.maxDets[2])
+        stats[3] = _summarize(1, areaRng='small', maxDets=p.maxDets[2])
+        stats[4] = _summarize(1, areaRng='medium', maxDets=p.maxDets[2])
+        stats[5] = _summarize(1, areaRng='large', maxDets=p.maxDets[2])
+        stats[6] = _summarize(0, maxDets=p.maxDets[0])
+        stats[7] = _summarize(0, maxDets=p.maxDets[1])
+        stats[8] = _summarize(0, maxDets=p.maxDets[2])
+        stats[9] = _summarize(0, areaRng='small', maxDets=p.maxDets[2])
+        stats[10] = _summarize(0, areaRng='medium', maxDets=p.maxDets[2])
+        stats[11] = _summarize(0, areaRng='large', maxDets=p.maxDets[2])
+        self.stats = stats
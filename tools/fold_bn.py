@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-09-03 09:42:18
+#   Description : 导出时把batch_norm融合进卷积
+#
+# ================================================================
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+CONV_TYPES = ['conv2d', 'depthwise_conv2d']
+
+
+def _consumers(block, name):
+    return [op for op in block.ops if name in op.input_arg_names]
+
+
+def _users(block, name):
+    return [op for op in block.ops if name in op.input_arg_names or name in op.output_arg_names]
+
+
+def _get(scope, name):
+    return np.array(scope.find_var(name).get_tensor())
+
+
+def _set(scope, name, value, place):
+    scope.var(name).get_tensor().set(value.astype(np.float32), place)
+
+
+def fold_batch_norm(program, scope, place):
+    '''
+    推理时batch_norm是y = (x - mean) / sqrt(var + eps) * scale + offset，是逐通道的乘加，可以合并进前面的卷积：
+        W' = W * scale / sqrt(var + eps)（按输出通道）
+        b' = offset + (b - mean) * scale / sqrt(var + eps)（卷积没有偏移时b = 0）
+    model/yolov4.py的conv2d_unit()、model/custom_layers.py的Conv2dUnit()（bn=1）都是 卷积(+偏移) + batch_norm，
+    融合后每一层少一个batch_norm，只剩 卷积 + elementwise_add。
+    直接修改program和scope（卷积的权重被覆盖），所以要在load_params()之后、保存之前调用，之后不能再训练。
+    只融合卷积的输出只被batch_norm（或者偏移的elementwise_add）使用的情况。
+    :param program:  for_test=True的program
+    :return:  融合的batch_norm个数
+    '''
+    block = program.global_block()
+    count = 0
+    idx = 0
+    while idx < len(block.ops):
+        op = block.ops[idx]
+        if op.type != 'batch_norm' or not (op.attr('is_test') or op.attr('use_global_stats')):
+            idx += 1
+            continue
+        x_name = op.input('X')[0]
+        producer = None
+        for k in range(idx - 1, -1, -1):
+            if x_name in block.ops[k].output_arg_names:
+                producer = k
+                break
+        if producer is None or len(_consumers(block, x_name)) != 1:
+            idx += 1
+            continue
+        # 卷积 + batch_norm，或者 卷积 + 偏移的elementwise_add + batch_norm
+        add_op = None
+        conv_idx = producer
+        if block.ops[producer].type == 'elementwise_add':
+            add_op = block.ops[producer]
+            conv_out = add_op.input('X')[0]
+            conv_idx = None
+            for k in range(producer - 1, -1, -1):
+                if conv_out in block.ops[k].output_arg_names:
+                    conv_idx = k
+                    break
+            if conv_idx is None or len(_consumers(block, conv_out)) != 1 or \
+                    not block.var(add_op.input('Y')[0]).persistable:
+                idx += 1
+                continue
+        conv_op = block.ops[conv_idx]
+        if conv_op.type not in CONV_TYPES:
+            idx += 1
+            continue
+
+        w_name = conv_op.input('Filter')[0]
+        w = _get(scope, w_name)
+        gamma = _get(scope, op.input('Scale')[0])
+        beta = _get(scope, op.input('Bias')[0])
+        mean = _get(scope, op.input('Mean')[0])
+        var = _get(scope, op.input('Variance')[0])
+        alpha = gamma / np.sqrt(var + op.attr('epsilon'))
+        b = _get(scope, add_op.input('Y')[0]) if add_op is not None else np.zeros_like(mean)
+        _set(scope, w_name, w * alpha.reshape((-1, 1, 1, 1)), place)
+        bn_names = [op.input(k)[0] for k in ['Scale', 'Bias', 'Mean', 'Variance']]
+        y_name = op.output('Y')[0]
+        saved_names = op.output('SavedMean') + op.output('SavedVariance')
+        if add_op is not None:
+            # 已有的偏移改成b'，elementwise_add直接输出batch_norm的输出
+            _set(scope, add_op.input('Y')[0], beta + (b - mean) * alpha, place)
+            add_op._rename_output(x_name, y_name)
+            block._remove_op(idx)
+        else:
+            # batch_norm换成加偏移，偏移存在batch_norm的offset里
+            bias_name = op.input('Bias')[0]
+            _set(scope, bias_name, beta + (b - mean) * alpha, place)
+            bn_names.remove(bias_name)
+            block._remove_op(idx)
+            block._insert_op(idx, type='elementwise_add', inputs={'X': [x_name], 'Y': [bias_name]},
+                             outputs={'Out': [y_name]}, attrs={'axis': 1})
+        # 不再被任何op使用的batch_norm参数、中间结果
+        for name in bn_names + [x_name] + saved_names:
+            if name != y_name and not _users(block, name) and block.has_var(name):
+                block._remove_var(name)
+        count += 1
+        idx += 1
+    logger.info('Folded {} batch_norm into convolutions.'.format(count))
+    return count
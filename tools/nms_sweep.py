@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-28 16:22:10
+#   Description : 保存nms之前的候选框，只重跑nms和评测来搜索阈值
+#
+# ================================================================
+import os
+import json
+import time
+import itertools
+import multiprocessing
+import numpy as np
+
+from model.decode_np import nms_candidates
+from tools.cocotools import load_coco_gt, dets_to_array, bbox_eval
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CandidateWriter(object):
+    """
+    边验证边把每张图片nms之前的候选框（Decode._yolo_candidates()的结果）追加写进cand_dir下的几个二进制文件：
+    boxes.f64（归一化的xywh）、scores.f32、classes.i16，最后写meta.npz（每张图片的id、原图宽高、候选框数）。
+    都按原来的精度保存（boxes是float64，scores是float32），所以读回去重做nms，结果和直接验证完全一样。
+    meta.npz最后写，作为候选框完整的标记。
+    """
+    def __init__(self, cand_dir, catid_lut, conf_thresh):
+        if not os.path.exists(cand_dir): os.makedirs(cand_dir)
+        self.cand_dir = cand_dir
+        self.catid_lut = catid_lut
+        self.conf_thresh = conf_thresh
+        self.f_boxes = open(os.path.join(cand_dir, 'boxes.f64'), 'wb')
+        self.f_scores = open(os.path.join(cand_dir, 'scores.f32'), 'wb')
+        self.f_classes = open(os.path.join(cand_dir, 'classes.i16'), 'wb')
+        self.image_ids = []
+        self.shapes = []
+        self.counts = []
+
+    def write(self, im, shape, boxes, scores, classes):
+        np.ascontiguousarray(boxes, dtype=np.float64).tofile(self.f_boxes)
+        np.ascontiguousarray(scores, dtype=np.float32).tofile(self.f_scores)
+        np.ascontiguousarray(classes, dtype=np.int16).tofile(self.f_classes)
+        self.image_ids.append(im['id'])
+        self.shapes.append(shape[:2])
+        self.counts.append(len(scores))
+
+    def close(self):
+        self.f_boxes.close()
+        self.f_scores.close()
+        self.f_classes.close()
+        tmp_path = os.path.join(self.cand_dir, 'meta.tmp.npz')
+        np.savez(tmp_path, image_ids=np.array(self.image_ids, dtype=np.int64),
+                 shapes=np.array(self.shapes, dtype=np.int64).reshape((-1, 2)),
+                 counts=np.array(self.counts, dtype=np.int64), catid_lut=self.catid_lut,
+                 conf_thresh=np.array(self.conf_thresh))
+        os.replace(tmp_path, os.path.join(self.cand_dir, 'meta.npz'))
+        logger.info('{} candidates of {} images saved to {}.'.format(sum(self.counts), len(self.counts), self.cand_dir))
+
+
+class CandidateReader(object):
+    """
+    读CandidateWriter写的候选框，用内存映射，多个进程同时读也不占多少内存。
+    """
+    def __init__(self, cand_dir):
+        meta_path = os.path.join(cand_dir, 'meta.npz')
+        assert os.path.exists(meta_path), 'Candidates in {} are not complete.'.format(cand_dir)
+        with np.load(meta_path) as meta:
+            self.image_ids = meta['image_ids']
+            self.shapes = meta['shapes']
+            self.counts = meta['counts']
+            self.catid_lut = meta['catid_lut']
+            self.conf_thresh = float(meta['conf_thresh'])
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        n = int(self.offsets[-1])
+        self.boxes = np.memmap(os.path.join(cand_dir, 'boxes.f64'), dtype=np.float64, mode='r', shape=(n, 4))
+        self.scores = np.memmap(os.path.join(cand_dir, 'scores.f32'), dtype=np.float32, mode='r', shape=(n, ))
+        self.classes = np.memmap(os.path.join(cand_dir, 'classes.i16'), dtype=np.int16, mode='r', shape=(n, ))
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def get(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return np.array(self.boxes[start:end]), np.array(self.scores[start:end]), np.array(self.classes[start:end])
+
+    def detections(self, conf_thresh, nms_thresh, keep_top_k=-1, class_top_k=-1, top_k=-1):
+        '''
+        用新的阈值重新做nms，返回检测结果[N, 7]，与用这组阈值直接验证得到的一样。
+        :param keep_top_k:   每张图片最多保留的框数，-1表示不限制
+        :param class_top_k:  nms之前每个类别最多保留的候选框数，-1表示不限制
+        :param top_k:        nms之前所有类别一共最多保留的候选框数，-1表示不限制
+        '''
+        dets = []
+        for i in range(len(self)):
+            boxes, scores, classes = self.get(i)
+            if conf_thresh > self.conf_thresh:
+                keep = scores >= conf_thresh
+                boxes, scores, classes = boxes[keep], scores[keep], classes[keep]
+            boxes, scores, classes = nms_candidates(boxes, scores, classes, self.shapes[i], nms_thresh, keep_top_k,
+                                                    class_top_k, top_k)
+            if boxes is None:
+                continue
+            dets.append(dets_to_array(self.image_ids[i], boxes, scores, classes, self.catid_lut))
+        if not dets:
+            return np.zeros((0, 7), dtype=np.float64)
+        return np.concatenate(dets, axis=0)
+
+
+# 每个子进程只打开一次候选框和标注
+_worker = {}
+
+def _init_worker(cand_dir, anno_file, fast_eval, pre_nms_class_top_k=-1, pre_nms_top_k=-1):
+    _worker['reader'] = CandidateReader(cand_dir)
+    _worker['anno_file'] = anno_file
+    _worker['fast_eval'] = fast_eval
+    _worker['pre_nms'] = (pre_nms_class_top_k, pre_nms_top_k)
+    load_coco_gt(anno_file)
+
+def _eval_setting(setting):
+    conf_thresh, nms_thresh, keep_top_k = setting
+    t0 = time.time()
+    dets = _worker['reader'].detections(conf_thresh, nms_thresh, keep_top_k, *_worker['pre_nms'])
+    stats = bbox_eval(_worker['anno_file'], dets, fast_eval=_worker['fast_eval'])
+    return {'conf_thresh': conf_thresh, 'nms_thresh': nms_thresh, 'keep_top_k': keep_top_k,
+            'num_dets': len(dets), 'stats': [float(x) for x in stats], 'time': time.time() - t0}
+
+
+def sweep(cand_dir, anno_file, conf_threshs, nms_threshs, keep_top_ks=(-1, ), num_workers=4, fast_eval=True,
+          pre_nms_class_top_k=-1, pre_nms_top_k=-1):
+    '''
+    对conf_threshs × nms_threshs × keep_top_ks里的每一组设置，只重跑nms和COCO评测，不跑网络。
+    各组设置互相独立，用进程池并行。nms之前的候选框个数限制pre_nms_class_top_k、pre_nms_top_k对所有设置都一样。
+    :return:  每组设置的结果，按AP从高到低排序
+    '''
+    reader = CandidateReader(cand_dir)
+    low = [t for t in conf_threshs if t < reader.conf_thresh]
+    if low:
+        logger.warning('Candidates were saved with conf_thresh={}, conf_thresh {} behave like {}.'.format(
+            reader.conf_thresh, low, reader.conf_thresh))
+    settings = list(itertools.product(conf_threshs, nms_threshs, keep_top_ks))
+    logger.info('Sweep {} settings over {} images...'.format(len(settings), len(reader)))
+    if num_workers > 0:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(cand_dir, anno_file, fast_eval,
+                                                                                    pre_nms_class_top_k, pre_nms_top_k))
+        results = pool.map(_eval_setting, settings, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        _init_worker(cand_dir, anno_file, fast_eval, pre_nms_class_top_k, pre_nms_top_k)
+        results = [_eval_setting(setting) for setting in settings]
+    results.sort(key=lambda r: -r['stats'][0])
+    return results
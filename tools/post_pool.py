@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-31 15:08:44
+#   Description : 常驻进程池做后处理
+#
+# ================================================================
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# 每个子进程里的Decode（不带exe、program，只做后处理）和已经打开的共享内存
+_worker = {}
+
+def _init_worker(decode_args, decode_kwargs):
+    from model.decode_np import Decode
+    _worker['decode'] = Decode(*decode_args, **decode_kwargs)
+    _worker['shm'] = {}
+
+def _attach(name):
+    shm = _worker['shm'].get(name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        _worker['shm'][name] = shm
+    return shm
+
+def _post_image(name, layouts, i, shape):
+    '''
+    子进程里对一批输出中的第i张图片解码、nms。
+    :param layouts:  每个输出层在共享内存里的(偏移, shape, dtype)
+    '''
+    buf = _attach(name).buf
+    outs = [np.ndarray(s, dtype=d, buffer=buf, offset=o)[i:i + 1] for o, s, d in layouts]
+    _decode = _worker['decode']
+    boxes, scores, classes = _decode.candidates_batch(outs, [shape])[0]
+    return _decode.nms(boxes, scores, classes, shape)
+
+
+class PostFuture(object):
+    '''
+    PostprocessPool.submit()的返回值。result()等这一批所有图片后处理完，释放共享内存，返回每张图片的结果。
+    '''
+    def __init__(self, pool, slot, async_results):
+        self.pool = pool
+        self.slot = slot
+        self.async_results = async_results
+
+    def result(self):
+        try:
+            results = [r.get() for r in self.async_results]
+        finally:
+            self.pool._release(self.slot)
+        result_boxes = [r[0] for r in results]
+        result_scores = [r[1] for r in results]
+        result_classes = [r[2] for r in results]
+        return result_boxes, result_scores, result_classes
+
+
+class PostprocessPool(object):
+    """
+    常驻进程池做后处理（解码、nms）。
+    numpy的sigmoid、nms大部分时间都拿着GIL，每张图片开一个线程基本是串行的，而且每一批都要重新创建线程。
+    这里子进程只创建一次；网络的输出写进共享内存，只把共享内存的名字和偏移发给子进程，不pickle整个输出。
+    submit()立即返回，主线程可以接着跑下一批的网络，后处理与网络计算重叠。
+    共享内存分成num_slots块，每块放一批输出；块都被占用时submit()会等最早的一批处理完。
+    """
+    def __init__(self, _decode, num_workers=4, num_slots=2):
+        decode_args = (_decode.algorithm, _decode.anchors, _decode._t1, _decode._t2, _decode.input_shape,
+                       None, None, _decode.all_classes)
+        decode_kwargs = {'pre_nms_class_top_k': _decode.pre_nms_class_top_k,
+                         'pre_nms_top_k': _decode.pre_nms_top_k,
+                         'max_dets': _decode.max_dets,
+                         'letterbox': _decode.letterbox}
+        # 主进程里可能已经初始化了CUDA，fork出来的子进程不安全，用spawn
+        ctx = multiprocessing.get_context('spawn')
+        self.pool = ctx.Pool(num_workers, initializer=_init_worker, initargs=(decode_args, decode_kwargs))
+        self.num_slots = num_slots
+        self.slots = [None] * num_slots
+        self.free_slots = queue.Queue()
+        for k in range(num_slots):
+            self.free_slots.put(k)
+        logger.info('Postprocess pool started with {} workers.'.format(num_workers))
+
+    def _slot_buffer(self, k, nbytes):
+        shm = self.slots[k]
+        if shm is None or shm.size < nbytes:
+            # 这一块是空闲的，没有子进程在读，可以直接换成更大的
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.slots[k] = shm
+        return shm
+
+    def _release(self, k):
+        self.free_slots.put(k)
+
+    def submit(self, outs, batch_shape):
+        '''
+        :param outs:         网络的输出（Decode.run_batch()的结果）
+        :param batch_shape:  原图的shape
+        :return:  PostFuture
+        '''
+        outs = [np.ascontiguousarray(o) for o in outs]
+        layouts, nbytes = [], 0
+        for o in outs:
+            layouts.append((nbytes, o.shape, o.dtype.str))
+            nbytes += (o.nbytes + 63) // 64 * 64
+        k = self.free_slots.get()
+        try:
+            shm = self._slot_buffer(k, nbytes)
+            for o, (offset, shape, dtype) in zip(outs, layouts):
+                np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = o
+            async_results = [self.pool.apply_async(_post_image, (shm.name, layouts, i, batch_shape[i]))
+                             for i in range(len(batch_shape))]
+        except Exception:
+            self._release(k)
+            raise
+        return PostFuture(self, k, async_results)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for shm in self.slots:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.slots = []
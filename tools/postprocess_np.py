@@ -50,32 +50,42 @@ def _sigmoid(x):
     return 1 / (1 + np.exp(-x))
 
 
-def _process_feats(out, anchors, mask, input_shape):
+def conf_logit_threshold(_t1):
+    '''
+    score = conf * prob <= conf，所以sigmoid(objectness) < _t1的框一定会被过滤掉。
+    sigmoid(x) >= _t1  <=>  x >= log(_t1 / (1 - _t1))，直接在logit空间里比较，不用先算sigmoid。
+    阈值放宽一点点，不会因为舍入误差漏掉框；多放进来的框之后会按真正的分数再过滤一次。
+    '''
+    if _t1 <= 0. or _t1 >= 1.:
+        return -np.inf
+    return np.log(_t1 / (1. - _t1)) - 1e-3
+
+
+def _process_feats(out, anchors, mask, input_shape, _t1):
     grid_h, grid_w, num_boxes = map(int, out.shape[1: 4])
 
     anchors = [anchors[i] for i in mask]
-    anchors_tensor = np.array(anchors).reshape(1, 1, len(anchors), 2)
+    anchors_tensor = np.array(anchors).reshape(len(anchors), 2)
 
     # Reshape to batch, height, width, num_anchors, box_params.
     out = out[0]
-    box_xy = _sigmoid(out[..., :2])
-    box_wh = np.exp(out[..., 2:4])
-    box_wh = box_wh * anchors_tensor
+    # 先按objectness过滤，只对留下来的框解码坐标、算类别概率。
+    rows, cols, ans = np.where(out[..., 4] >= conf_logit_threshold(_t1))
+    out = out[rows, cols, ans]   # [n, box_params]
 
-    box_confidence = _sigmoid(out[..., 4])
-    box_confidence = np.expand_dims(box_confidence, axis=-1)
-    box_class_probs = _sigmoid(out[..., 5:])
+    box_xy = _sigmoid(out[:, :2])
+    box_wh = np.exp(out[:, 2:4])
+    box_wh = box_wh * anchors_tensor[ans]
 
-    col = np.tile(np.arange(0, grid_w), grid_w).reshape(-1, grid_w)
-    row = np.tile(np.arange(0, grid_h).reshape(-1, 1), grid_h)
+    box_confidence = _sigmoid(out[:, 4])
+    box_confidence = np.expand_dims(box_confidence, axis=-1)
+    box_class_probs = _sigmoid(out[:, 5:])
 
-    col = col.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-    row = row.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-    grid = np.concatenate((col, row), axis=-1)
+    grid = np.stack((cols, rows), axis=-1)
 
     box_xy += grid
     box_xy /= (grid_w, grid_h)
-    box_wh /= input_shape
+    box_wh /= (input_shape[1], input_shape[0])   # input_shape是先h再w，box_wh是先w再h
     box_xy -= (box_wh / 2.)  # 坐标格式是左上角xy加矩形宽高wh，xywh都除以图片边长归一化了。
     boxes = np.concatenate((box_xy, box_wh), axis=-1)
 
@@ -95,40 +105,123 @@ def _filter_boxes(boxes, box_confidences, box_class_probs, _t1):
     return boxes, classes, scores
 
 
-def _nms_boxes(boxes, scores):
-    x = boxes[:, 0]
-    y = boxes[:, 1]
+def _greedy_nms(boxes, nms_thresh, bounds, block=64):
+    '''
+    贪心nms。boxes已经按类别分段（第k个类别是boxes[bounds[k]:bounds[k + 1]]），每段内按分数从高到低排好。
+    每个类别按block行一块，一次算出这一块和同类别后面所有框的IoU矩阵，扫描时只需要把保留下来的行并进被抑制的掩码，
+    不用像逐个保留框那样每次都重新算一遍交并比。IoU的算法（包括+1）与原来逐类别的while循环一模一样。
+    :return:  保留下来的框在boxes里的下标
+    '''
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
     w = boxes[:, 2]
     h = boxes[:, 3]
-
+    x2 = x1 + w
+    y2 = y1 + h
     areas = w * h
-    order = scores.argsort()[::-1]
 
+    removed = np.zeros((len(boxes), ), dtype=bool)
     keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-
-        xx1 = np.maximum(x[i], x[order[1:]])
-        yy1 = np.maximum(y[i], y[order[1:]])
-        xx2 = np.minimum(x[i] + w[i], x[order[1:]] + w[order[1:]])
-        yy2 = np.minimum(y[i] + h[i], y[order[1:]] + h[order[1:]])
+    for k in range(len(bounds) - 1):
+        cs, ce = bounds[k], bounds[k + 1]
+        for s in range(cs, ce, block):
+            e = min(s + block, ce)
+            # 已经被抑制的框不用再算IoU，只保留还活着的行和列
+            alive = s + np.flatnonzero(~removed[s:ce])
+            nr = int(np.searchsorted(alive, e))
+            if nr == 0:
+                continue
+            rows, cols = alive[:nr], alive
+            # 原地计算，少分配临时数组。运算顺序与原来一样：max(0, xx2 - xx1 + 1)，inter / ((area_i + area_j) - inter)
+            w1 = np.minimum(x2[rows, np.newaxis], x2[np.newaxis, cols])
+            w1 -= np.maximum(x1[rows, np.newaxis], x1[np.newaxis, cols])
+            w1 += 1
+            np.maximum(w1, 0.0, out=w1)
+            h1 = np.minimum(y2[rows, np.newaxis], y2[np.newaxis, cols])
+            h1 -= np.maximum(y1[rows, np.newaxis], y1[np.newaxis, cols])
+            h1 += 1
+            np.maximum(h1, 0.0, out=h1)
+            inter = w1
+            inter *= h1
+            union = np.add(areas[rows, np.newaxis], areas[np.newaxis, cols], out=h1)
+            union -= inter
+            ovr = np.divide(inter, union, out=inter)
+            suppress = ~(ovr <= nms_thresh)   # 与原来一样，ovr是nan时也抑制
+            rem = np.zeros((len(cols), ), dtype=bool)
+            for i in range(nr):
+                if rem[i]:
+                    continue
+                keep.append(rows[i])
+                rem |= suppress[i]
+            removed[cols] = rem
+    return np.array(keep, dtype=np.int64)
+
+
+def nms_boxes(boxes, scores, nms_thresh):
+    '''
+    单个类别的nms。boxes是xywh（左上角坐标、宽高），返回保留下来的框的下标，按分数从高到低。
+    '''
+    order = scores.argsort()[::-1]
+    return order[_greedy_nms(boxes[order], nms_thresh, [0, len(order)])]
+
+
+def pre_nms_top_k(scores, classes, class_top_k=-1, top_k=-1):
+    '''
+    nms之前限制候选框的个数：每个类别最多class_top_k个，所有类别一共最多top_k个（都按分数，-1表示不限制）。
+    conf_thresh很低（例如验证时的0.001）时，一个类别可能有几千个候选框，nms的耗时没有上限；
+    用np.argpartition()只挑出前k个，不用整体排序。
+    :return:  保留下来的候选框的下标，升序（保持原来的相对顺序）
+    '''
+    keep = np.arange(len(scores))
+    if class_top_k > 0 and len(scores) > class_top_k:
+        counts = np.bincount(classes)
+        over = np.where(counts > class_top_k)[0]
+        if len(over) > 0:
+            mask = np.ones((len(scores), ), dtype=bool)
+            for c in over:
+                inds = np.where(classes == c)[0]
+                drop = np.argpartition(-scores[inds], class_top_k - 1)[class_top_k:]
+                mask[inds[drop]] = False
+            keep = np.where(mask)[0]
+    if top_k > 0 and len(keep) > top_k:
+        top = np.argpartition(-scores[keep], top_k - 1)[:top_k]
+        keep = keep[np.sort(top)]
+    return keep
 
-        w1 = np.maximum(0.0, xx2 - xx1 + 1)
-        h1 = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w1 * h1
 
-        ovr = inter / (areas[i] + areas[order[1:]] - inter)
-        _t2 = 0.45
-        inds = np.where(ovr <= _t2)[0]
-        order = order[inds + 1]
+def multiclass_nms(boxes, scores, classes, nms_thresh, keep_top_k=-1):
+    '''
+    所有类别一起做nms（类别之间互不抑制）。
+    框的处理顺序与原来逐类别的nms一样：类别按set(classes)的顺序，类别内按scores.argsort()[::-1]，
+    所以分数相同的框也会得到完全一样的保留集合和输出顺序。
+    :param boxes:  xywh（左上角坐标、宽高）
+    :param keep_top_k:  nms之后最多保留的框数（按分数），-1表示不限制
+    :return:  boxes（换成左上角坐标、右下角坐标）, scores, classes。没有框时返回None, None, None
+    '''
+    if len(scores) == 0:
+        return None, None, None
+    orders, bounds = [], [0]
+    for c in set(classes):
+        inds = np.where(classes == c)[0]
+        orders.append(inds[scores[inds].argsort()[::-1]])
+        bounds.append(bounds[-1] + len(inds))
+    order = np.concatenate(orders)
+    keep = order[_greedy_nms(boxes[order], nms_thresh, bounds)]
+    if keep_top_k > 0 and len(keep) > keep_top_k:
+        top = np.argsort(-scores[keep], kind='mergesort')[:keep_top_k]
+        keep = keep[np.sort(top)]
+
+    boxes = boxes[keep]
+    scores = scores[keep]
+    classes = classes[keep]
 
-    keep = np.array(keep)
+    # 换坐标
+    boxes[:, [2, 3]] = boxes[:, [0, 1]] + boxes[:, [2, 3]]
 
-    return keep
+    return boxes, scores, classes
 
 
-def _yolo_out(outs, shape, input_shape, _t1):
+def _yolo_out(outs, shape, input_shape, _t1, _t2=0.45, keep_top_k=-1):
     masks = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
     anchors = [[12, 16], [19, 36], [40, 28], [36, 75], [76, 55],
                [72, 146], [142, 110], [192, 243], [459, 401]]
@@ -136,7 +229,7 @@ def _yolo_out(outs, shape, input_shape, _t1):
     boxes, classes, scores = [], [], []
 
     for out, mask in zip(outs, masks):
-        b, c, s = _process_feats(out, anchors, mask, input_shape)
+        b, c, s = _process_feats(out, anchors, mask, input_shape, _t1)
         b, c, s = _filter_boxes(b, c, s, _t1)
         boxes.append(b)
         classes.append(c)
@@ -152,32 +245,165 @@ def _yolo_out(outs, shape, input_shape, _t1):
     image_dims = [w, h, w, h]
     boxes = boxes * image_dims
 
-    nboxes, nclasses, nscores = [], [], []
-    for c in set(classes):
-        inds = np.where(classes == c)
-        b = boxes[inds]
-        c = classes[inds]
-        s = scores[inds]
-
-        keep = _nms_boxes(b, s)
+    boxes, scores, classes = multiclass_nms(boxes, scores, classes, _t2, keep_top_k)
 
-        nboxes.append(b[keep])
-        nclasses.append(c[keep])
-        nscores.append(s[keep])
-
-    if not nclasses and not nscores:
+    if boxes is None:
         boxes = np.zeros((1, 4), 'float32')
         scores = np.zeros((1, ), 'float32') - 2.0
         classes = np.zeros((1, ), 'float32')
         # return None, None, None
         return boxes, scores, classes
 
-    boxes = np.concatenate(nboxes)
-    classes = np.concatenate(nclasses)
-    scores = np.concatenate(nscores)
-
-    # 换坐标
-    boxes[:, [2, 3]] = boxes[:, [0, 1]] + boxes[:, [2, 3]]
-
     return boxes, scores, classes
 
+
+def yolo_box(outs, shape, input_shape, conf_thresh, anchors, masks=((6, 7, 8), (3, 4, 5), (0, 1, 2))):
+    '''
+    numpy版的fluid.layers.yolo_box()（clip_bbox=False），给fast_nms()、matrix_nms()准备输入。
+    yolo_box()把sigmoid(objectness) < conf_thresh的框整个置0，这些框的分数全是0，之后一定会被过滤掉，
+    所以这里先在logit空间按objectness过滤，只解码留下来的框。框的顺序与yolo_box()一样是(先验框, 行, 列)。
+    :param outs:   output_l, output_m, output_s，每个是[1, grid_h, grid_w, 3, 5 + num_classes]
+    :param shape:  原图的shape
+    :return:  boxes [n, 4]（原图上的左上角坐标、右下角坐标）, scores [n, num_classes]，都是float32
+    '''
+    img_h, img_w = float(shape[0]), float(shape[1])
+    all_boxes, all_scores = [], []
+    for out, mask in zip(outs, masks):
+        grid_h, grid_w = map(int, out.shape[1: 3])
+        out = out[0].transpose(2, 0, 1, 3)   # [3, grid_h, grid_w, box_params]
+        ans, rows, cols = np.where(out[..., 4] >= conf_logit_threshold(conf_thresh))
+        out = out[ans, rows, cols].astype(np.float32)
+        conf = _sigmoid(out[:, 4])
+        pos = np.where(conf >= conf_thresh)[0]
+        out, conf, ans, rows, cols = out[pos], conf[pos], ans[pos], rows[pos], cols[pos]
+
+        anchors_tensor = np.array([anchors[i] for i in mask], np.float32)[ans]
+        cx = (cols.astype(np.float32) + _sigmoid(out[:, 0])) * np.float32(img_w) / np.float32(grid_w)
+        cy = (rows.astype(np.float32) + _sigmoid(out[:, 1])) * np.float32(img_h) / np.float32(grid_h)
+        w = np.exp(out[:, 2]) * anchors_tensor[:, 0] * np.float32(img_w) / np.float32(input_shape[1])
+        h = np.exp(out[:, 3]) * anchors_tensor[:, 1] * np.float32(img_h) / np.float32(input_shape[0])
+        all_boxes.append(np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=-1))
+        all_scores.append(conf[:, np.newaxis] * _sigmoid(out[:, 5:]))
+    return np.concatenate(all_boxes), np.concatenate(all_scores)
+
+
+def _pairwise_iou(boxes):
+    '''
+    与model/fastnms.py里的_iou()算法一样（不加1，分母加1e-9）。
+    :param boxes:  [c, k, 4]  左上角坐标、右下角坐标
+    :return:   [c, k, k]  同一类别内两两之间的iou
+    '''
+    x0, y0, x1, y1 = [np.ascontiguousarray(boxes[:, :, i]) for i in range(4)]
+    area = (x1 - x0) * (y1 - y0)
+    # 每个坐标分开算，[c, k, 1]与[c, 1, k]广播，中间结果都原地计算
+    w = np.minimum(x1[:, :, np.newaxis], x1[:, np.newaxis, :])
+    w -= np.maximum(x0[:, :, np.newaxis], x0[:, np.newaxis, :])
+    np.maximum(w, 0.0, out=w)
+    h = np.minimum(y1[:, :, np.newaxis], y1[:, np.newaxis, :])
+    h -= np.maximum(y0[:, :, np.newaxis], y0[:, np.newaxis, :])
+    np.maximum(h, 0.0, out=h)
+    inter = w
+    inter *= h
+    union = np.add(area[:, :, np.newaxis], area[:, np.newaxis, :], out=h)
+    union -= inter
+    union += np.float32(1e-9)
+    return np.divide(inter, union, out=inter)
+
+
+def _sort_per_class(boxes, scores, conf_thresh, top_k):
+    '''
+    每个类别的候选框按分数降序排列，只保留分数 > conf_thresh的前top_k个，补齐成[c, k]的矩阵（补的位置valid是False）。
+    分数 <= conf_thresh的框一定排在后面，最后也一定会被过滤掉，不用参与iou矩阵的计算。
+    :param boxes:   [n, 4]
+    :param scores:  [num_classes, n]
+    :return:  cls [c, ]（有候选框的类别）, boxes [c, k, 4], scores [c, k], valid [c, k]
+    '''
+    # 只对分数 > conf_thresh的(类别, 框)排序，比对整个[num_classes, n]矩阵逐行排序快得多。
+    # 同分时按框的下标升序，与逐行argsort(kind='stable')的顺序一样。
+    c_idx, b_idx = np.where(scores > conf_thresh)
+    s = scores[c_idx, b_idx]
+    order = np.lexsort((b_idx, -s, c_idx))
+    c_idx, b_idx, s = c_idx[order], b_idx[order], s[order]
+    cls, starts, counts = np.unique(c_idx, return_index=True, return_counts=True)
+    k = int(counts.max()) if len(cls) > 0 else 0
+    if top_k > 0:
+        k = min(k, top_k)
+    row = np.repeat(np.arange(len(cls)), counts)
+    rank = np.arange(len(c_idx)) - np.repeat(starts, counts)
+    pos = rank < k
+    row, rank = row[pos], rank[pos]
+    valid = np.zeros((len(cls), k), dtype=bool)
+    valid[row, rank] = True
+    sorted_scores = np.zeros((len(cls), k), dtype=scores.dtype)
+    sorted_scores[row, rank] = s[pos]
+    sorted_boxes = np.zeros((len(cls), k, 4), dtype=boxes.dtype)
+    sorted_boxes[row, rank] = boxes[b_idx[pos]]
+    return cls, sorted_boxes, sorted_scores, valid
+
+
+def _gather_top(cls, boxes, scores, keep, top_k):
+    '''
+    取出keep为True的框，所有类别一起按分数降序排列，保留前top_k个。
+    '''
+    rows, ranks = np.where(keep)
+    if len(rows) == 0:
+        return None, None, None
+    scores = scores[rows, ranks]
+    order = np.argsort(-scores, kind='stable')
+    if top_k > 0:
+        order = order[:top_k]
+    return boxes[rows, ranks][order], scores[order], cls[rows][order].astype(np.int32)
+
+
+def fast_nms(boxes, scores, conf_thresh, nms_thresh, keep_top_k, nms_top_k):
+    '''
+    numpy版的Fast-NMS，与model/fastnms.py里的fastnms()结果一致：
+    每个类别取分数最高的keep_top_k个框，算出c×k×k的iou矩阵，只看上三角（分数比它高的框），
+    与分数比它高的框的最大iou超过nms_thresh的就丢弃。没有逐个保留框的串行循环，整个过程都是矩阵运算。
+    :param boxes:   yolo_box()的输出，[n, 4]  左上角坐标、右下角坐标
+    :param scores:  yolo_box()的输出，[n, num_classes]
+    :return:  boxes（左上角坐标、右下角坐标）, scores, classes，所有类别一起按分数降序，最多nms_top_k个。
+              没有框时返回None, None, None
+    '''
+    # 与图里一样先换成cx_cy_w_h格式再换回来，保证坐标的舍入一模一样
+    boxes = np.concatenate([(boxes[:, :2] + boxes[:, 2:]) * np.float32(0.5), boxes[:, 2:] - boxes[:, :2]], axis=-1)
+    boxes = np.concatenate([boxes[:, :2] - boxes[:, 2:] * np.float32(0.5),
+                            boxes[:, :2] + boxes[:, 2:] * np.float32(0.5)], axis=-1)
+    cls, boxes, scores, valid = _sort_per_class(boxes, scores.T, conf_thresh, keep_top_k)
+    if len(cls) == 0:
+        return None, None, None
+
+    iou = np.triu(_pairwise_iou(boxes), k=1)
+    keep = valid & (iou.max(axis=1) <= nms_thresh)
+    return _gather_top(cls, boxes, scores, keep, nms_top_k)
+
+
+def matrix_nms(boxes, scores, conf_thresh, post_thresh, nms_top_k, keep_top_k,
+               use_gaussian=False, gaussian_sigma=2.0):
+    '''
+    numpy版的Matrix-NMS（SOLOv2），不丢弃框而是衰减分数：
+    框j的衰减系数 = min_{i排在j前面} f(iou_ij) / f(max_iou_i)，max_iou_i是框i与分数比它高的框的最大iou。
+    线性：f(iou) = 1 - iou；高斯：f(iou) = exp(-sigma * iou^2)。衰减后分数 > post_thresh的框保留。
+    :param boxes:   yolo_box()的输出，[n, 4]  左上角坐标、右下角坐标
+    :param scores:  yolo_box()的输出，[n, num_classes]
+    :param nms_top_k:   每个类别最多取多少个框参与计算
+    :param keep_top_k:  所有类别一起最多保留多少个框
+    :return:  boxes, scores（衰减后）, classes，按分数降序。没有框时返回None, None, None
+    '''
+    cls, boxes, scores, valid = _sort_per_class(boxes, scores.T, conf_thresh, nms_top_k)
+    if len(cls) == 0:
+        return None, None, None
+
+    iou = np.triu(_pairwise_iou(boxes), k=1)   # iou[c, i, j]，只保留i排在j前面的部分
+    max_iou = iou.max(axis=1)[:, :, np.newaxis]   # [c, k, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if use_gaussian:
+            decay = np.exp((max_iou ** 2 - iou ** 2) * np.float32(gaussian_sigma))
+        else:
+            decay = (1 - iou) / (1 - max_iou)
+    # i >= j的位置是f(0) / f(max_iou_i) >= 1，不影响最小值；0/0（重合的框）是nan，fmin会忽略它
+    decay = np.fmin.reduce(decay, axis=1)
+    np.minimum(decay, 1.0, out=decay)
+    scores = decay * scores
+    keep = valid & (scores > post_thresh)
+    return _gather_top(cls, boxes, scores, keep, keep_top_k)
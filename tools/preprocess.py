@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-09-01 10:21:36
+#   Description : 推理、验证时的预处理
+#
+# ================================================================
+import cv2
+import numpy as np
+
+
+INTERPS = {
+    'nearest': cv2.INTER_NEAREST,
+    'linear': cv2.INTER_LINEAR,
+    'area': cv2.INTER_AREA,
+    'cubic': cv2.INTER_CUBIC,
+    'lanczos': cv2.INTER_LANCZOS4,
+}
+
+
+def get_interp(interp):
+    '''
+    :param interp:  'nearest'、'linear'、'area'、'cubic'、'lanczos'，或者cv2.INTER_XXX
+    '''
+    if isinstance(interp, str):
+        if interp not in INTERPS:
+            raise ValueError('Unknown interpolation {}, expect one of {}.'.format(interp, list(INTERPS.keys())))
+        return INTERPS[interp]
+    return interp
+
+
+class BatchPreprocessor(object):
+    """
+    网络输入的预处理。原来每张图片要np.copy、cvtColor、resize、转float、归一化、transpose、expand_dims，
+    再把整批np.concatenate起来，一张图片被完整复制6次以上。
+    这里BGR原图只缩放一次（得到uint8、HWC、BGR的图片，可以缓存），
+    然后每个通道一次乘加，直接写进复用的float32 NCHW批缓冲区，交换通道、归一化、HWC转CHW都在这一遍里完成。
+
+    letterbox=True时不把图片拉伸成input_shape，而是保持宽高比缩放到input_shape以内，
+    整批只填充到这一批里最大的宽、高向上取stride的倍数（右边、下边填像素值0即黑色，归一化之后的值），
+    例如16:9的图片在608下是608x352而不是608x608。
+    """
+    def __init__(self, input_shape, algorithm, interp='cubic', letterbox=False, stride=32):
+        self.input_shape = input_shape
+        self.interp = get_interp(interp)
+        self.letterbox = letterbox
+        self.stride = stride
+        # 网络的输入 = 像素值 * scale + bias，按RGB的顺序
+        if algorithm == 'YOLOv4':
+            self.scale = np.array([1. / 255.] * 3, dtype=np.float32)
+            self.bias = None
+        elif algorithm == 'YOLOv3':
+            mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+            std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+            self.scale = 1. / std
+            self.bias = -mean / std
+        # 填充部分是像素值0归一化之后的值。导出的uint8输入的模型（客户端填0，在图里归一化）、
+        # deploy_infer.py的PadStride也是这样填充，几种输入的填充部分一样
+        self.pad = np.zeros((3, ), dtype=np.float32) if self.bias is None else self.bias.astype(np.float32)
+        self._buffer = None
+
+    # 原图的shape -> 缩放后的(h, w)
+    def resized_shape(self, shape):
+        if not self.letterbox:
+            return tuple(self.input_shape)
+        return letterbox_shape(shape, self.input_shape)
+
+    # 一批缩放后的(h, w) -> 网络输入的(h, w)
+    def pad_shape(self, resized_shapes):
+        if not self.letterbox:
+            return tuple(self.input_shape)
+        return pad_to_stride(np.max(np.array(resized_shapes)[:, :2], axis=0), self.stride)
+
+    # 一批原图的shape -> 网络输入的(h, w)。letterbox时宽图、高图的输入shape不同，可以用来分组凑批
+    def input_shape_of(self, batch_shape):
+        return self.pad_shape([self.resized_shape(shape) for shape in batch_shape])
+
+    # BGR原图 -> 缩放后的uint8、HWC、BGR图片
+    def resize(self, img):
+        h, w = self.resized_shape(img.shape)
+        return cv2.resize(img, (w, h), interpolation=self.interp)
+
+    # 复用的[n, 3, h, w]批缓冲区，需要的元素变多时才重新分配。下一次调用batch()之前要用完（交给网络）
+    def batch(self, n, input_shape=None):
+        h, w = self.input_shape if input_shape is None else input_shape
+        size = n * 3 * h * w
+        if self._buffer is None or len(self._buffer) < size:
+            self._buffer = np.empty((size, ), dtype=np.float32)
+        return self._buffer[:size].reshape((n, 3, h, w))
+
+    # 把resize()的结果交换通道、归一化后写进batch[i]的左上角，右边、下边填self.pad
+    def fill(self, batch, i, resized):
+        h, w = resized.shape[:2]
+        for c in range(3):
+            np.multiply(resized[:, :, 2 - c], self.scale[c], out=batch[i, c, :h, :w])
+            if self.bias is not None:
+                batch[i, c, :h, :w] += self.bias[c]
+        if h < batch.shape[2]:
+            batch[i, :, h:, :] = self.pad[:, np.newaxis, np.newaxis]
+        if w < batch.shape[3]:
+            batch[i, :, :h, w:] = self.pad[:, np.newaxis, np.newaxis]
+
+    # 一批resize()的结果 -> 网络的输入（复用的批缓冲区）
+    def normalize(self, batch_resized):
+        batch = self.batch(len(batch_resized), self.pad_shape([r.shape for r in batch_resized]))
+        for i, resized in enumerate(batch_resized):
+            self.fill(batch, i, resized)
+        return batch
+
+    # 一批BGR原图 -> 网络的输入（复用的批缓冲区）
+    def process(self, batch_img):
+        return self.normalize([self.resize(img) for img in batch_img])
+
+    def box_scale(self, batch_shape, input_shape):
+        '''
+        网络输出的框坐标除以网络输入的宽高归一化；乘上这个系数之后变成除以原图的宽高归一化。
+        不是letterbox时是None（不用乘）。
+        :return:  [n, 2]  每张图片的(输入的w / 缩放后的w, 输入的h / 缩放后的h)
+        '''
+        if not self.letterbox:
+            return None
+        resized = np.array([self.resized_shape(shape) for shape in batch_shape], dtype=np.float64)
+        return np.array([input_shape[1], input_shape[0]], dtype=np.float64) / resized[:, ::-1]
+
+
+def letterbox_shape(shape, target_shape):
+    '''
+    保持宽高比缩放到target_shape以内之后的(h, w)
+    '''
+    h, w = shape[:2]
+    scale = min(float(target_shape[0]) / h, float(target_shape[1]) / w)
+    return max(int(round(h * scale)), 1), max(int(round(w * scale)), 1)
+
+
+def pad_to_stride(shape, stride=32):
+    return tuple(int(np.ceil(float(x) / stride) * stride) for x in shape[:2])
+
+
+def letterbox_box_shape(shape, resized_shape, input_shape):
+    '''
+    letterbox时给yolo_box()的img_size（图里的fastnms、multiclass_nms，以及tools/postprocess_np.py的yolo_box()、_yolo_out()）。
+    它们把除以网络输入宽高归一化的坐标乘上img_size，用这个shape代替原图的shape，就直接得到原图上的坐标。
+    '''
+    return (float(input_shape[0]) * shape[0] / resized_shape[0], float(input_shape[1]) * shape[1] / resized_shape[1])
@@ -0,0 +1,322 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-09-07 10:15:33
+#   Description : 按BN的scale剪掉卷积的通道
+#
+# ================================================================
+import json
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# 逐通道的op，输出的第i个通道只来自输入的第i个通道。(输入名, 输出名)
+CHANNEL_WISE_OPS = {
+    'batch_norm': ('X', 'Y'),
+    'leaky_relu': ('X', 'Out'),
+    'relu': ('X', 'Out'),
+    'mish': ('X', 'Out'),
+    'softplus': ('X', 'Out'),
+    'tanh': ('X', 'Out'),
+    'exp': ('X', 'Out'),
+    'log': ('X', 'Out'),
+    'clip': ('X', 'Out'),
+    'scale': ('X', 'Out'),
+    'sigmoid': ('X', 'Out'),
+    'swish': ('X', 'Out'),
+    'pool2d': ('X', 'Out'),
+    'nearest_interp': ('X', 'Out'),
+    'bilinear_interp': ('X', 'Out'),
+    'dropout': ('X', 'Out'),
+}
+ELEMENTWISE_OPS = ['elementwise_add', 'elementwise_sub', 'elementwise_mul']
+
+
+def load_channels(path):
+    '''
+    prune.py保存的每个卷积的输出通道数，传给YOLOv4()的channels。path是None时返回None（不剪枝的模型）
+    '''
+    if path is None:
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_channels(path, channels):
+    with open(path, 'w') as f:
+        json.dump(channels, f, indent=2, sort_keys=True)
+
+
+class _UnionFind(object):
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        self.parent.setdefault(x, x)
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[rb] = ra
+
+
+class ChannelGraph(object):
+    """
+    分析for_test的program里每个通道的来源：网络里每个张量的第j个通道来自哪个卷积的第几个输出通道。
+    concat按通道拼接来源；逐通道的op（batch_norm、激活、池化、上采样）原样传递；
+    残差的elementwise_add把两边对应的通道绑在一起（要剪就一起剪，否则相加的shape对不上）。
+    送进其它op（transpose、split、reshape、fetch等）的通道不剪。
+    剪枝的单位是unit：通过残差连在一起的一组卷积，每一组绑在一起的通道叫一个class，一个unit里按class剪。
+    只剪后面跟着batch_norm的卷积（conv2d_unit(bn=1)），输出层的卷积不剪。
+    """
+    def __init__(self, program):
+        block = program.global_block()
+        self.convs = {}      # 卷积名 -> {'weight', 'bias', 'bn', 'out', 'in_prov', 'shape'}
+        self.order = []
+        self.param_owner = {}     # 参数名 -> (卷积名, 'weight' / 'out')，'out'表示按输出通道剪的一维参数
+        uf = _UnionFind()
+        fixed = set()
+        prov = {}
+        conv_out = {}
+        for op in block.ops:
+            t = op.type
+            if t == 'conv2d' and op.attr('groups') == 1:
+                w_name = op.input('Filter')[0]
+                name = w_name[:-len('.conv.weights')] if w_name.endswith('.conv.weights') else w_name
+                shape = block.var(w_name).shape
+                x = op.input('Input')[0]
+                out = op.output('Output')[0]
+                self.convs[name] = {'weight': w_name, 'bias': None, 'bn': None, 'out': out,
+                                    'in_prov': prov.get(x, [None] * shape[1]), 'shape': list(shape)}
+                self.order.append(name)
+                self.param_owner[w_name] = (name, 'weight')
+                prov[out] = [(name, i) for i in range(shape[0])]
+                conv_out[out] = name
+                for i in range(shape[0]):
+                    uf.find((name, i))
+            elif t in CHANNEL_WISE_OPS:
+                in_key, out_key = CHANNEL_WISE_OPS[t]
+                x = op.input(in_key)[0]
+                if x not in prov:
+                    continue
+                prov[op.output(out_key)[0]] = prov[x]
+                if t == 'batch_norm' and x in conv_out:
+                    name = conv_out[x]
+                    self.convs[name]['bn'] = op
+                    for key in ['Scale', 'Bias', 'Mean', 'Variance']:
+                        self.param_owner[op.input(key)[0]] = (name, 'out')
+            elif t in ELEMENTWISE_OPS:
+                x, y = op.input('X')[0], op.input('Y')[0]
+                px, py = prov.get(x), prov.get(y)
+                if px is None and py is None:
+                    continue
+                if px is not None and py is not None:
+                    if len(px) == len(py):
+                        for a, b in zip(px, py):
+                            if a is not None and b is not None:
+                                uf.union(a, b)
+                            elif a is not None or b is not None:
+                                fixed.add((a or b)[0])
+                    else:
+                        fixed.update([c[0] for c in px + py if c is not None])
+                elif px is not None and x in conv_out and block.var(y).persistable:
+                    # 卷积的偏移
+                    name = conv_out[x]
+                    self.convs[name]['bias'] = y
+                    self.param_owner[y] = (name, 'out')
+                prov[op.output('Out')[0]] = px if px is not None else py
+            elif t == 'concat' and op.attr('axis') == 1 and all(x in prov for x in op.input('X')):
+                prov[op.output('Out')[0]] = sum([prov[x] for x in op.input('X')], [])
+            else:
+                for x in op.input_arg_names:
+                    if x in prov:
+                        fixed.update([c[0] for c in prov[x] if c is not None])
+        self.uf = uf
+
+        # 通过残差连在一起的卷积是一个unit
+        conv_uf = _UnionFind()
+        for name in self.order:
+            conv_uf.find(name)
+            for i in range(self.convs[name]['shape'][0]):
+                conv_uf.union(uf.find((name, i))[0], name)
+        units = {}
+        for name in self.order:
+            units.setdefault(conv_uf.find(name), []).append(name)
+        self.units = {}
+        for members in units.values():
+            if any(m in fixed or self.convs[m]['bn'] is None for m in members):
+                continue
+            classes = {}
+            for m in members:
+                for i in range(self.convs[m]['shape'][0]):
+                    classes.setdefault(uf.find((m, i)), []).append((m, i))
+            self.units[members[0]] = {'convs': members, 'classes': list(classes.values())}
+        logger.info('{} convs, {} prunable units.'.format(len(self.order), len(self.units)))
+
+    def scores(self, scope):
+        '''
+        每个unit每个class的重要性：class里各个通道BN的|scale|的平均值
+        '''
+        scores = {}
+        for unit, info in self.units.items():
+            gammas = {m: np.abs(np.array(scope.find_var(self.convs[m]['bn'].input('Scale')[0]).get_tensor()))
+                      for m in info['convs']}
+            scores[unit] = np.array([np.mean([gammas[m][i] for m, i in cls]) for cls in info['classes']])
+        return scores
+
+    def prune_classes(self, unit, ratio, scores, align=8):
+        '''
+        unit剪掉ratio比例的class（分数最低的），保留的个数取align的倍数，至少保留align个（不超过class数）。
+        :return:  被剪掉的(卷积名, 通道)
+        '''
+        classes = self.units[unit]['classes']
+        n = len(classes)
+        keep = int(round(n * (1.0 - ratio)))
+        if align > 1:
+            keep = int(round(float(keep) / align)) * align
+        keep = min(max(keep, min(align, n), 1), n)
+        order = np.argsort(-scores[unit], kind='stable')
+        removed = []
+        for k in order[keep:]:
+            removed += classes[k]
+        return removed
+
+    def kept_channels(self, removed):
+        '''
+        :return:  {卷积名: 保留的输出通道下标（升序）}
+        '''
+        removed = set(removed)
+        return {name: [i for i in range(self.convs[name]['shape'][0]) if (name, i) not in removed]
+                for name in self.order}
+
+    def kept_inputs(self, name, kept, kept_sets=None):
+        # 卷积输入里保留的通道下标：来自网络输入的通道都保留
+        if kept_sets is None:
+            kept_sets = {n: set(k) for n, k in kept.items()}
+        return [j for j, c in enumerate(self.convs[name]['in_prov']) if c is None or c[1] in kept_sets[c[0]]]
+
+    def flops(self, out_hw, kept=None):
+        '''
+        所有卷积的乘加次数。
+        :param out_hw:  {卷积名: 输出的(h, w)}
+        :param kept:    kept_channels()的结果，None表示不剪枝
+        '''
+        total = 0
+        kept_sets = {n: set(k) for n, k in kept.items()} if kept is not None else None
+        for name in self.order:
+            cout, cin, kh, kw = self.convs[name]['shape']
+            if kept is not None:
+                cout = len(kept[name])
+                cin = len(self.kept_inputs(name, kept, kept_sets))
+            h, w = out_hw[name]
+            total += cout * cin * kh * kw * h * w
+        return total
+
+    def channels(self, kept):
+        # 给YOLOv4()的channels：只写通道数变了的卷积
+        return {name: len(kept[name]) for name in self.order if len(kept[name]) != self.convs[name]['shape'][0]}
+
+    def mask(self, scope, place, removed):
+        '''
+        把removed的通道在BN里的scale、offset置0，这些通道的输出（激活之后）就是0，与剪掉它们等价。
+        :return:  恢复用的备份
+        '''
+        backup = {}
+        by_conv = {}
+        for name, i in removed:
+            by_conv.setdefault(name, []).append(i)
+        for name, idx in by_conv.items():
+            bn = self.convs[name]['bn']
+            for key in ['Scale', 'Bias']:
+                var_name = bn.input(key)[0]
+                tensor = scope.find_var(var_name).get_tensor()
+                value = np.array(tensor)
+                backup[var_name] = value.copy()
+                value[idx] = 0.
+                tensor.set(value, place)
+        return backup
+
+    def restore(self, scope, place, backup):
+        for var_name, value in backup.items():
+            scope.find_var(var_name).get_tensor().set(value, place)
+
+    def copy_pruned(self, program, src_scope, dst_scope, place, kept):
+        '''
+        把src_scope里（没剪枝）的参数剪掉通道之后写进dst_scope（剪枝后的program已经初始化过的scope）。
+        '''
+        for var in program.list_vars():
+            if not var.persistable or src_scope.find_var(var.name) is None or dst_scope.find_var(var.name) is None:
+                continue
+            value = np.array(src_scope.find_var(var.name).get_tensor())
+            if var.name in self.param_owner:
+                name, kind = self.param_owner[var.name]
+                value = value[kept[name]]
+                if kind == 'weight':
+                    value = value[:, self.kept_inputs(name, kept)]
+            dst = dst_scope.find_var(var.name).get_tensor()
+            if tuple(np.array(dst).shape) != value.shape:
+                raise ValueError('Shape of {} mismatch: pruned {}, program {}.'.format(
+                    var.name, value.shape, np.array(dst).shape))
+            dst.set(np.ascontiguousarray(value), place)
+
+
+def _ratio_at_loss(sensitivity, loss):
+    '''
+    这个unit的损失不超过loss时最多能剪掉的比例（在相邻两个剪枝比例之间线性插值）
+    :param sensitivity:  {剪枝比例: 精度损失}
+    '''
+    ratios = sorted(sensitivity.keys())
+    best = 0.0
+    prev_r, prev_l = 0.0, 0.0
+    for r in ratios:
+        l = max(sensitivity[r], prev_l)
+        if l <= loss:
+            best = r
+        else:
+            if l > prev_l:
+                best = prev_r + (r - prev_r) * (loss - prev_l) / (l - prev_l)
+            break
+        prev_r, prev_l = r, l
+    return best
+
+
+def ratios_by_flops(graph, sensitivities, scores, out_hw, pruned_flops, align=8, iters=30):
+    '''
+    对所有unit用同一个精度损失的上限，每个unit剪掉损失不超过上限的最大比例；二分查找这个上限，
+    使得剪掉的乘加次数占比达到pruned_flops。
+    :return:  ({unit: 剪枝比例}, 被剪掉的(卷积名, 通道), 剪枝后的乘加次数占比)
+    '''
+    base = float(graph.flops(out_hw))
+
+    def prune(loss):
+        ratios = {u: _ratio_at_loss(sensitivities[u], loss) for u in sensitivities}
+        removed = []
+        for u, r in ratios.items():
+            if r > 0:
+                removed += graph.prune_classes(u, r, scores, align)
+        return ratios, removed, graph.flops(out_hw, graph.kept_channels(removed)) / base
+
+    lo, hi = 0.0, max([max(s.values()) for s in sensitivities.values()] + [0.0]) + 1e-6
+    result = prune(hi)
+    if 1.0 - result[2] < pruned_flops:
+        logger.warning('Can not prune {:.1%} FLOPs with the sensitivity ratios, pruned {:.1%}.'.format(
+            pruned_flops, 1.0 - result[2]))
+        return result
+    for _ in range(iters):
+        mid = (lo + hi) / 2.0
+        r = prune(mid)
+        if 1.0 - r[2] >= pruned_flops:
+            hi, result = mid, r
+        else:
+            lo = mid
+    return result
@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-28 11:05:36
+#   Description : 多进程、多机分片验证、test-dev预测
+#
+# ================================================================
+import os
+import sys
+import time
+import hashlib
+import subprocess
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def shard_range(num_images, num_shards, shard_id):
+    '''
+    第shard_id个分片负责images[start:end]。只和图片数、分片数有关，所以不同进程、不同机器上算出来的都一样。
+    '''
+    start = num_images * shard_id // num_shards
+    end = num_images * (shard_id + 1) // num_shards
+    return start, end
+
+
+def _shard_path(shard_dir, num_shards, shard_id):
+    return os.path.join(shard_dir, 'shard_%d_of_%d.npz' % (shard_id, num_shards))
+
+
+def _images_key(images):
+    md5 = hashlib.md5()
+    for im in images:
+        md5.update(('%d\n' % im['id']).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def is_shard_done(shard_dir, num_shards, shard_id, images):
+    '''
+    分片文件存在，而且是用同样的图片跑出来的，才算完成。
+    :param images:  整个图片列表
+    '''
+    path = _shard_path(shard_dir, num_shards, shard_id)
+    if not os.path.exists(path):
+        return False
+    start, end = shard_range(len(images), num_shards, shard_id)
+    with np.load(path) as data:
+        return str(data['key']) == _images_key(images[start:end])
+
+
+def save_shard(shard_dir, num_shards, shard_id, images, dets):
+    '''
+    先写临时文件再改名，所以分片文件只要存在就是完整的。
+    :param dets:  这个分片的检测结果，[N, 7]，每行是[image_id, x, y, w, h, score, category_id]
+    '''
+    if not os.path.exists(shard_dir): os.makedirs(shard_dir)
+    start, end = shard_range(len(images), num_shards, shard_id)
+    path = _shard_path(shard_dir, num_shards, shard_id)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, dets=dets, key=np.array(_images_key(images[start:end])))
+    os.replace(tmp_path, path)
+    logger.info('Shard {}/{} saved to {}, {} detections.'.format(shard_id, num_shards, path, len(dets)))
+
+
+def load_shards(shard_dir, num_shards, images):
+    '''
+    合并所有分片的检测结果，按分片顺序拼接。有分片没完成时报错。
+    '''
+    dets = []
+    for shard_id in range(num_shards):
+        if not is_shard_done(shard_dir, num_shards, shard_id, images):
+            raise RuntimeError('Shard {}/{} is not complete.'.format(shard_id, num_shards))
+        with np.load(_shard_path(shard_dir, num_shards, shard_id)) as data:
+            dets.append(data['dets'])
+    return np.concatenate(dets, axis=0)
+
+
+def launch_shards(script, num_shards, shard_dir, images, gpus, max_procs=None, extra_args=()):
+    '''
+    为每个还没完成的分片启动一个子进程 python script --num_shards n --shard_id k --shard_dir shard_dir，
+    每个子进程建自己的执行器，通过FLAGS_selected_gpus轮流分到gpus里的卡上，日志写到shard_dir/shard_k.log。
+    已经完成的分片直接跳过，所以中断之后重新运行会接着跑。
+    :param gpus:       GPU编号的list，例如[0, 1]
+    :param max_procs:  同时运行的子进程数，默认是len(gpus)
+    '''
+    if not os.path.exists(shard_dir): os.makedirs(shard_dir)
+    todo = [k for k in range(num_shards) if not is_shard_done(shard_dir, num_shards, k, images)]
+    logger.info('{} of {} shards to run: {}'.format(len(todo), num_shards, todo))
+    max_procs = max_procs or len(gpus)
+    running = []
+    failed = []
+    i = 0
+    while todo or running:
+        while todo and len(running) < max_procs:
+            shard_id = todo.pop(0)
+            env = dict(os.environ)
+            env['FLAGS_selected_gpus'] = str(gpus[i % len(gpus)])
+            i += 1
+            log = open(os.path.join(shard_dir, 'shard_%d.log' % shard_id), 'w')
+            cmd = [sys.executable, script, '--num_shards', str(num_shards), '--shard_id', str(shard_id),
+                   '--shard_dir', shard_dir] + list(extra_args)
+            running.append((shard_id, subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT), log))
+        time.sleep(1)
+        for item in running[:]:
+            shard_id, proc, log = item
+            if proc.poll() is not None:
+                log.close()
+                running.remove(item)
+                if proc.returncode != 0:
+                    failed.append(shard_id)
+                    logger.error('Shard {}/{} failed, see {}.'.format(shard_id, num_shards, log.name))
+                else:
+                    logger.info('Shard {}/{} done.'.format(shard_id, num_shards))
+    if failed:
+        raise RuntimeError('Shards {} failed. Run again to resume.'.format(failed))
@@ -27,9 +27,11 @@ from model.head import YOLOv3Head
 from model.resnet import Resnet50Vd
 from model.yolov3 import YOLOv3
 from model.yolov4 import YOLOv4
+from tools.prune import load_channels
 from tools.cocotools import get_classes, catid2clsid, clsid2catid
 from model.decode_np import Decode
-from tools.cocotools import eval
+from tools.cocotools import eval, load_coco_gt
+from tools.eval_cache import EvalImageCache
 from tools.data_process import data_clean, get_samples
 from tools.transform import *
 from pycocotools.coco import COCO
@@ -291,6 +293,7 @@ if __name__ == '__main__':
 
     # 选择配置
     cfg = YOLOv4_Config_1()
+    # cfg = YOLOv4_Tiny_Config_1()
     # cfg = YOLOv3_Config_1()
 
 
@@ -314,7 +317,9 @@ if __name__ == '__main__':
             # 多尺度训练
             inputs = P.data(name='input_1', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
             if algorithm == 'YOLOv4':
-                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True)
+                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True,
+                                                      width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                                      channels=load_channels(cfg.prune_channels))
             elif algorithm == 'YOLOv3':
                 backbone = Resnet50Vd()
                 head = YOLOv3Head()
@@ -340,7 +345,9 @@ if __name__ == '__main__':
             # 多尺度训练
             inputs = P.data(name='input_1', shape=[-1, 3, -1, -1], append_batch_size=False, dtype='float32')
             if algorithm == 'YOLOv4':
-                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True)
+                output_l, output_m, output_s = YOLOv4(inputs, num_classes, num_anchors, is_test=False, trainable=True,
+                                                      width_mult=cfg.width_mult, depth_mult=cfg.depth_mult, tiny=cfg.tiny,
+                                                      channels=load_channels(cfg.prune_channels))
             elif algorithm == 'YOLOv3':
                 backbone = Resnet50Vd()
                 head = YOLOv3Head(keep_prob=1.0)   # 一定要设置keep_prob=1.0, 为了得到一致的推理结果
@@ -356,7 +363,9 @@ if __name__ == '__main__':
     exe.run(startup_prog)
 
     compiled_eval_prog = fluid.compiler.CompiledProgram(eval_prog)
-    _decode = Decode(algorithm, cfg.anchors, cfg.conf_thresh, cfg.nms_thresh, cfg.input_shape, exe, compiled_eval_prog, class_names)
+    _decode = Decode(algorithm, cfg.anchors, cfg.conf_thresh, cfg.nms_thresh, cfg.input_shape, exe, compiled_eval_prog, class_names,
+                     cfg.pre_nms_class_top_k, cfg.pre_nms_top_k, cfg.max_dets, cfg.interp, cfg.letterbox)
+    _decode.start_post_pool(cfg.post_workers)
 
     if cfg.pattern == 1:
         fluid.load(train_prog, cfg.model_path, executor=exe)
@@ -380,11 +389,12 @@ if __name__ == '__main__':
     num_train = len(train_records)
     train_indexes = [i for i in range(num_train)]
     # 验证集
-    with open(cfg.val_path, 'r', encoding='utf-8') as f2:
-        for line in f2:
-            line = line.strip()
-            dataset = json.loads(line)
-            val_images = dataset['images']
+    # 验证集标注只解析一次，每次验证时bbox_eval()直接复用这个COCO对象
+    val_images = load_coco_gt(cfg.val_path, cfg.eval_cache_dir).dataset['images']
+    eval_cache = None
+    if cfg.eval_cache_dir is not None:
+        eval_cache = EvalImageCache(cfg.eval_cache_dir, val_images, cfg.val_pre_path, cfg.input_shape, cfg.interp,
+                                    cfg.letterbox)
 
     batch_size = cfg.batch_size
     with_mixup = cfg.with_mixup
@@ -482,7 +492,8 @@ if __name__ == '__main__':
             # ==================== eval ====================
             if iter_id % cfg.eval_iter == 0:
                 box_ap = eval(_decode, eval_fetch_list, val_images, cfg.val_pre_path, cfg.val_path, cfg.eval_batch_size,
-                              _clsid2catid, cfg.draw_image)
+                              _clsid2catid, cfg.draw_image, eval_cache,
+                              fast_eval=cfg.fast_eval, fast_eval_workers=cfg.fast_eval_workers)
                 logger.info("box ap: %.3f" % (box_ap[0],))
 
                 # 以box_ap作为标准
@@ -500,5 +511,6 @@ if __name__ == '__main__':
             # ==================== exit ====================
             if iter_id == cfg.max_iters:
                 logger.info('Done.')
+                _decode.close_post_pool()
                 exit(0)
 